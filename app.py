@@ -1,30 +1,92 @@
 from data_processing import *
-from generate_heatmaps import *
 from sat_agent import *
-from fastapi import FastAPI, HTTPException
-from fastapi.staticfiles import StaticFiles
+from report_pipeline import *
+from batch_reports import BatchRequest, generate_batch
+from report_jobs import ReportJobRequest, job_queue
+from attempt_store import attempt_writer
+from heatmaps import read_image, image_version
+from warmup import warm_up, WARMUP_ENABLED
+from dataclasses import asdict
+from fastapi import FastAPI, HTTPException, Request, Response
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse, PlainTextResponse, FileResponse
+from metrics import metrics
+from logging_config import setup_logging, log_context
+from profiling import RequestProfile, authorized, list_profiles, read_profile, profile_data_path
 from dotenv import load_dotenv
+import asyncio
 import logging
+import uuid
 
 app = FastAPI()
 
 load_dotenv()
 
-logging.basicConfig(
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('Data/logs/logger.log')
-    ],
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
+# Queue-based: the console and the rotating log file are written by a background thread
+setup_logging()
 
 logger = logging.getLogger(__name__)
 
 
+class RequestContext:
+    # Tags every log record of a request with its ID, taken from X-Request-ID or generated, and echoes it back
+
+    def __init__(self, app):
+        self.app = app
+
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        request_id = dict(scope['headers']).get(b'x-request-id', b'').decode('latin-1')[:64] or uuid.uuid4().hex[:16]
+
+        async def send_with_id(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', [])) + [(b'x-request-id', request_id.encode())]
+            await send(message)
+
+        with log_context(request_id=request_id):
+            await self.app(scope, receive, send_with_id)
+
+
+app.add_middleware(RequestContext)
+
+HEATMAP_FILES = {f"{subject}_heatmap.{ext}": media_type for subject in ('math', 'writing', 'reading')
+                 for ext, media_type in (('png', 'image/png'), ('svg', 'image/svg+xml'))}
+
+
+@app.on_event('startup')
+async def start_job_workers():
+    job_queue.start()
+
+
+@app.on_event('startup')
+async def start_warm_up():
+    # Not awaited, so the server accepts requests while the heavy imports load in the background
+    if WARMUP_ENABLED:
+        app.state.warmup = asyncio.get_running_loop().run_in_executor(None, warm_up)
+
+
+@app.on_event('shutdown')
+async def stop_job_workers():
+    await job_queue.stop()
+
+
+@app.on_event('shutdown')
+async def stop_cpu_pool():
+    await shutdown_cpu_pool()
+
+
+@app.on_event('shutdown')
+async def flush_attempts():
+    # After the job workers, so attempts of the reports they finished are written too
+    await asyncio.to_thread(attempt_writer.flush)
+
 
 @app.get('/generate_report')
-def get_report(user: str, course: str):
+async def get_report(user: str, course: str, request: Request, response: Response):
 
     # Get User and Class ID
     if not user:
@@ -39,135 +101,236 @@ def get_report(user: str, course: str):
     class_id = course
     logger.info(f"[OK] Starting Report Generation Process for user: {user_id}, Class: {class_id}")
 
-    # Initiate Data Processing
-    try:
-        student_data = FetchStudentData(user_id, class_id)
-        logger.info(f"[OK] Instantiate Data Class for user={user_id}, class={class_id}")
-    except Exception as e:
-        logger.exception(f"[FAIL] Instantiate Data Class for user={user_id}, class={class_id}")
-        raise
+    # Profiled on request, with the admin token in X-Profile. A report already being generated for the user and course
+    # is joined instead, unprofiled, like any other request
+    if authorized(request.headers.get('x-profile')):
+        if not in_flight(user_id, class_id):
+            return await profiled_report(user_id, class_id, response)
+        logger.info(f"[OK] Report for user={user_id}, class={class_id} already in flight, joined without a profile")
 
-    # Acquire Data
+    # Concurrent requests for the same user and course share one generation, with the stream, jobs and batches
     try:
-        performance_data = data_segregation(student_data.master_loop())
-        logger.info(f"[OK] Acquire performance data for user={user_id}, class={class_id}")
+        result = await generate_report(user_id, class_id)
     except Exception as e:
-        logger.exception(f"[FAIL] Acquire performance data for user={user_id}, class={class_id}")
-        raise
+        raise HTTPException(status_code=500, detail=f"{type(e).__name__}: {e}")
 
-    # Get SAT Exam Details
-    try:
-        context = get_context()
-        logger.info(f"[OK] Get context for SAT Exam")
-    except Exception as e:
-        logger.exception(f"[FAIL] Get context for SAT Exam")
-        raise
+    return jsonable_encoder(result)
 
-    # Segregate Student Progress
-    overall_progress = performance_data['overall_progress']
-    mathematics = performance_data['Mathematics']
-    writing = performance_data['Writing']
-    reading = performance_data['Reading']
 
-    # Check previous attempt
-    try:
-        attempt = check_attempt(user_id, class_id)
-        logger.info(f"[OK] Find previous attempt data for user={user_id}, class={class_id}")
-    except Exception as e:
-        logger.exception(f"[FAIL] Find previous attempt data for user={user_id}, class={class_id}")
-        raise
+async def profiled_report(user_id, class_id, response):
+    request_profile = RequestProfile(user_id, class_id)
+    response.headers['X-Profile-ID'] = request_profile.id
+    status = 'error'
 
-    # Generate Prompts
     try:
-        user, system = generate_prompts(overall_progress, mathematics, writing, reading, context, attempt, user_id, class_id)
-        logger.info(f"[OK] Generate prompt if attempt status is {attempt}")
+        with request_profile.activate():
+            result = await generate_report(user_id, class_id)
+        status = 'ok' if result is not None else 'no_result'
     except Exception as e:
-        logger.exception(f"[FAIL] Generate prompt if attempt status is {attempt}")
-        raise
+        raise HTTPException(status_code=500, detail=f"{type(e).__name__}: {e}")
+    finally:
+        await asyncio.to_thread(request_profile.save, status)
 
-    # Get response from Agent
-    try:
-        key = os.getenv('GEMINI_API')
-
-        response = agent(user, system, 'gemini-2.5-flash-lite', key, 1024, 0.2, 16000)
-        logger.info(f"[OK] Call Agent for user={user_id}, class={class_id}")
-
-        # Sort out the response
-        response_id = response.response_id
-        token_usage = response.usage_metadata
-        report = response.parsed
-        if report == None:
-            logger.error("[FAIL] LLM Response is not parsed. Retry in progress.")
-            count = 0
-            max_retry = 3
-            while report == None and count < max_retry:
-                response = agent(user, system, 'gemini-2.5-flash-lite', key, 1024, 0.2, 16000)
-                report = response.parsed
-                count += 1
-
-        if report != None:
-            logger.info(f"[OK] Response Parsed: {report}")
-
-        else:
-            logger.error(f"[FAIL] Max retries reach, no parsed response received. {response}")
-            return None
-    except Exception as e:
-        logger.exception(f"[FAIL] Call Agent for user={user_id}, class={class_id}")
-        raise
+    return jsonable_encoder(result)
+
+
+@app.get('/generate_report_stream')
+async def get_report_stream(user: str, course: str, format: str = 'sse'):
+
+    # Get User and Class ID
+    if not user:
+        logger.error('[FAIL] user_id not provided')
+        raise HTTPException(status_code=400, detail="user_id not provided")
+
+    if not course:
+        logger.error('[FAIL] class_id not provided')
+        raise HTTPException(status_code=400, detail="course_id not provided")
+
+    if format not in ('sse', 'ndjson'):
+        logger.error(f'[FAIL] Unknown stream format {format}')
+        raise HTTPException(status_code=400, detail="format must be sse or ndjson")
+
+    user_id = user
+    class_id = course
+    logger.info(f"[OK] Starting Streamed Report Generation Process for user: {user_id}, Class: {class_id}")
+
+    def encode(event, data):
+        data = json.dumps(jsonable_encoder(data))
+        if format == 'sse':
+            return f"event: {event}\ndata: {data}\n\n"
+        return f'{{"event": "{event}", "data": {data}}}\n'
+
+    # Events are sent as each part of the report is ready, a failure ends the stream with an error event
+    async def events():
+        finished = False
+        try:
+            async for event, data in report_events(user_id, class_id):
+                finished = event == 'meta_data'
+                yield encode(event, data)
+        except Exception as e:
+            yield encode('error', {'detail': f"{type(e).__name__}: {e}"})
+            return
+
+        if not finished:
+            yield encode('error', {'detail': "No parsed response received from the model"})
+
+    media_type = "text/event-stream" if format == 'sse' else "application/x-ndjson"
+    return StreamingResponse(events(), media_type=media_type,
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def not_modified(request, etag, modified):
+    # If-None-Match wins over If-Modified-Since, as in RFC 9110
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return etag in tags or '*' in tags
+
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            return int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    return False
 
-    report_dict = create_dictionary(report)
 
-    # Save Data in JSON files
+@app.get('/images/{user}/{course}/{file_name}')
+async def get_heatmap(user: str, course: str, file_name: str, request: Request, v: str = None):
+
+    if file_name not in HEATMAP_FILES:
+        raise HTTPException(status_code=404, detail="Heatmap not found")
+
     try:
-        subjects_name_list, subjects_details_list = save_json(user_id, class_id, performance_data, report_dict)
-        logger.info(f"[OK] Save data for user={user_id}, class={class_id}")
-    except Exception as e:
-        logger.exception(f"[FAIL] Save data for user={user_id}, class={class_id}")
-        raise
+        image, modified = await asyncio.to_thread(
+            read_image, f"Data/saved_progress_report/{user}-{course}/previous/heatmaps/{file_name}")
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Heatmap not found")
+
+    etag = f'"{image_version(image)}"'
+
+    # Report URLs carry the content hash in ?v=, so those can be cached for good. Anything else revalidates
+    headers = {
+        'ETag': etag,
+        'Last-Modified': formatdate(modified, usegmt=True),
+        'Cache-Control': 'public, max-age=31536000, immutable' if v is not None and f'"{v}"' == etag else 'no-cache'
+    }
+
+    if not_modified(request, etag, modified):
+        return Response(status_code=304, headers=headers)
+
+    return Response(image, media_type=HEATMAP_FILES[file_name], headers=headers)
+
+
+@app.post('/report_jobs', status_code=202)
+async def submit_report_job(request: ReportJobRequest):
+
+    if not request.user:
+        logger.error('[FAIL] user_id not provided')
+        raise HTTPException(status_code=400, detail="user_id not provided")
+
+    if not request.course:
+        logger.error('[FAIL] class_id not provided')
+        raise HTTPException(status_code=400, detail="course_id not provided")
+
+    job, joined = job_queue.submit(request.user, request.course)
+
+    return {'id': job.id, 'status': job.status, 'deduplicated': joined}
+
+
+@app.get('/report_jobs/{job_id}')
+async def get_report_job(job_id: str):
+
+    job = job_queue.get(job_id)
+
+    if job is None:
+        logger.error(f'[FAIL] Report job {job_id} not found')
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return asdict(job)
+
+
+@app.get('/metrics')
+async def get_metrics():
+    # Prometheus text format: report and stage latency histograms, Gemini calls and tokens, cache and job counters
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+@app.get('/profiles')
+async def get_profiles(request: Request):
+    # Saved request profiles, newest first. Needs the profiling token in X-Profile, like profiling a request
+    if not authorized(request.headers.get('x-profile')):
+        raise HTTPException(status_code=404, detail="Not found")
+
+    return await asyncio.to_thread(list_profiles)
+
+
+@app.get('/profiles/{profile_id}')
+async def get_profile(profile_id: str, request: Request, format: str = 'json'):
+    # format=json: stage timings, hook timings and the top functions; format=pstats: the cProfile data
+    if not authorized(request.headers.get('x-profile')):
+        raise HTTPException(status_code=404, detail="Not found")
+
+    if format == 'pstats':
+        path = profile_data_path(profile_id)
+        if path is None:
+            raise HTTPException(status_code=404, detail="Profile not found")
+        return FileResponse(path, media_type='application/octet-stream', filename=f"{profile_id}.prof")
+
+    summary = await asyncio.to_thread(read_profile, profile_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+
+    return summary
+
+
+@app.post('/batch_reports')
+async def batch_reports(request: BatchRequest):
+
+    if not request.course:
+        logger.error('[FAIL] class_id not provided')
+        raise HTTPException(status_code=400, detail="course_id not provided")
+
+    if not request.users:
+        logger.error('[FAIL] user_ids not provided')
+        raise HTTPException(status_code=400, detail="user_ids not provided")
+
+    logger.info(f"[OK] Starting Batch Report Generation for {len(request.users)} users, Class: {request.course}")
+
+    # One JSON line per student, sent as each report finishes
+    async def results():
+        async for result in generate_batch(request.course, request.users, request.fetch_concurrency,
+                                           request.llm_concurrency, request.cpu_workers):
+            yield json.dumps(jsonable_encoder(result)) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+
+@app.get('/cohort_report')
+async def get_cohort_report(course: str, users: str = None, limit: int = 10):
+
+    if not course:
+        logger.error('[FAIL] class_id not provided')
+        raise HTTPException(status_code=400, detail="course_id not provided")
+
+    user_ids = set(users.split(',')) if users else None
+
+    # pandas is only needed here, it is loaded on the first cohort request (or by warmup)
+    from cohort_analytics import cohort_report
 
-    # Generate Subject Progress Heatmaps
     try:
-        math_data_path = f"Data/saved_progress_report/{user_id}-{class_id}/previous/MATHEMATICS.json"
-        math_heatmap_output_path = f'Data/saved_progress_report/{user_id}-{class_id}/previous/heatmaps/math_heatmap.png'
-        math_title = "SAT Math Progress Heatmap"
-        math_fig_size = (8, 14)
-
-        writing_data_path = f"Data/saved_progress_report/{user_id}-{class_id}/previous/WRITING.json"
-        writing_heatmap_output_path = f'Data/saved_progress_report/{user_id}-{class_id}/previous/heatmaps/writing_heatmap.png'
-        writing_title = "SAT Writing Progress Heatmap"
-        writing_fig_size = (8,8)
-
-        reading_data_path = f"Data/saved_progress_report/{user_id}-{class_id}/previous/READING.json"
-        reading_heatmap_output_path = f'Data/saved_progress_report/{user_id}-{class_id}/previous/heatmaps/reading_heatmap.png'
-        reading_title = "SAT Reading Progress Heatmap"
-        reading_fig_size = (8,4)
-
-        generate_heatmap(math_data_path, math_heatmap_output_path, math_title, math_fig_size) # Math
-        generate_heatmap(writing_data_path, writing_heatmap_output_path, writing_title, writing_fig_size) # Writing
-        generate_heatmap(reading_data_path, reading_heatmap_output_path, reading_title, reading_fig_size) # Reading
-
-        app.mount("/images", StaticFiles(directory=f"Data/saved_progress_report/{user_id}-{class_id}/previous/heatmaps/"),
-                  name="heatmaps")
-        logger.info(f"[OK] Generate Heatmaps for user={user_id}, class={class_id}")
+        report = await asyncio.to_thread(cohort_report, course, user_ids, limit)
+        logger.info(f"[OK] Compile cohort analytics for class={course}")
     except Exception as e:
-        logger.exception(f"[FAIL] Generate Heatmaps for user={user_id}, class={class_id}")
+        logger.exception(f"[FAIL] Compile cohort analytics for class={course}")
         raise
 
-    logger.info(f"[OK] Report Generated for user={user_id}, class={class_id}")
+    if report is None:
+        logger.error(f"[FAIL] No saved progress found for class={course}")
+        raise HTTPException(status_code=404, detail="No saved progress found for course")
 
-    return {
-        'report_json': report_dict,
-        'heatmaps': {
-            'math' : f"/images/{os.path.basename(math_heatmap_output_path)}",
-            'writing' : f"/images/{os.path.basename(writing_heatmap_output_path)}",
-            'reading' : f"/images/{os.path.basename(reading_heatmap_output_path)}",
-        },
-        'meta_data': {
-            'data_analyzed': subjects_name_list,
-            "id": response_id,
-            'token_usage': token_usage
-        }
-    }
+    return report
 
 
 @app.get('/documentation')
@@ -183,10 +346,12 @@ def api_structure():
             'Writing Heatmap' : 'Download Link',
             'Reading Heatmap' : 'Download Link',
             },
+        'trends': 'Progress per topic and difficulty over the last attempts, with the change since the previous one, the change per attempt and the streak, or null before the second attempt',
         'meta_data': {
             'subject_names': 'A list of subjects analyzed in the report',
             "id": 'An ID to save the response by',
-            'token_usage': 'Complete Tokens usage data, input, output, thinking and cache.'
+            'token_usage': 'Tokens spent on this report, input, output, thinking and cache. Null when every part was reused or cached.',
+            'cached_usage': 'Tokens of the parts served from the report cache, as first spent on them, not spent again by this report.'
             }
         },
         'Nested JSON Schema' : {
@@ -226,5 +391,16 @@ def api_structure():
               },
               "priority_roadmap": "string",
               "next_steps": "string"
+        },
+        'Other Endpoints': {
+            'POST url/report_jobs': 'Queue a report in the background. Body: {"user": "User ID", "course": "Course ID"}. Responds with {"id": "Job ID", "status": "queued", "deduplicated": false}, a request for a user and course already queued or running joins that job.',
+            'url/report_jobs/(Enter Job ID here)': 'Job status (queued, running, done or failed), timestamps, and the report in the same shape as generate_report once done.',
+            'url/generate_report_stream?user=(Enter User ID here)&course=(Enter course ID here)': 'The same report, streamed as events while it is generated: progress (the progress data), trends, section (one per subject, as each analysis is ready), summary, heatmaps and meta_data, or error. Server-sent events by default, format=ndjson for one JSON line per event.',
+            'POST url/batch_reports': 'Generate reports for a list of users in a course. Body: {"course": "Course ID", "users": ["User IDs"], "fetch_concurrency": 10, "llm_concurrency": 4, "cpu_workers": 2}, the concurrency fields are optional. Responds with one JSON line per student as each report finishes.',
+            'url/cohort_report?course=(Enter course ID here)': 'Class-level topic averages by difficulty, score and completion distributions and the weakest topics. Optional queries: users=(Comma separated user IDs), limit=(Number of weakest topics)',
+            'url/metrics': 'Prometheus metrics: report and per-stage latency histograms, report outcomes, section reuse, Gemini requests, retries, hedges and tokens, cache hits and misses, report jobs and attempt writes.',
+            'url/generate_report?user=...&course=... with an X-Profile: (Profiling token) header': 'Only when PROFILE_TOKEN is set. Generates the report with a profile of the request, its ID is returned in the X-Profile-ID header.',
+            'url/profiles with an X-Profile: (Profiling token) header': 'Saved request profiles, newest first.',
+            'url/profiles/(Enter Profile ID here) with an X-Profile: (Profiling token) header': 'Stage timings, time in fetch, FetchStudentData, trends, plan_sections, agent and generate_heatmap, and the top functions by cumulative time. format=pstats downloads the cProfile data.'
         }
     }
\ No newline at end of file
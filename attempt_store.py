@@ -0,0 +1,346 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import threading
+import logging
+import sqlite3
+import json
+import time
+import sys
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# Attempt store settings, overridable through the environment
+ATTEMPT_DB = os.getenv('ATTEMPT_DB', 'Data/attempts.db')
+# 0 saves attempts inside the request, as before
+ATTEMPT_WRITER_WORKERS = int(os.getenv('ATTEMPT_WRITER_WORKERS', 2))
+REPORTS_DIR = "Data/saved_progress_report"
+
+# Saved snapshot files of the JSON layout and their keys in the progress data
+SNAPSHOT_FILES = {
+    "overall_progress": "OVERALL_PROGRESS.json",
+    "Mathematics": "MATHEMATICS.json",
+    "Writing": "WRITING.json",
+    "Reading": "READING.json"
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS attempts (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    class_id TEXT NOT NULL,
+    created REAL NOT NULL,
+    progress TEXT NOT NULL,
+    report TEXT
+);
+CREATE INDEX IF NOT EXISTS attempts_user_class_created ON attempts (user_id, class_id, created);
+CREATE INDEX IF NOT EXISTS attempts_class_user_created ON attempts (class_id, user_id, created);
+'''
+
+
+class AttemptStore:
+    # Every saved attempt, with its progress snapshot and report, in one SQLite database instead of a directory
+    # of JSON files per student that each run overwrote. WAL mode lets readers run alongside the single writer,
+    # and lookups are indexed by (user, class, time).
+
+    def __init__(self, path=ATTEMPT_DB, legacy_dir=REPORTS_DIR):
+        self.path = path
+        self.legacy_dir = legacy_dir
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.ready = False
+        # Classes whose JSON layout was imported by this process
+        self.imported = set()
+        self.import_lock = threading.Lock()
+
+
+    def connection(self):
+        # sqlite3 connections are not shared between threads, each thread of the pools gets its own
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            return connection
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+
+        with self.lock:
+            if not self.ready:
+                connection.executescript(SCHEMA)
+                self.ready = True
+
+        self.local.connection = connection
+        return connection
+
+
+    def save(self, user_id, class_id, progress, report, created=None):
+        # progress: the stored form of each part of the progress data, keyed like SNAPSHOT_FILES
+        cursor = self.connection().execute(
+            "INSERT INTO attempts (user_id, class_id, created, progress, report) VALUES (?, ?, ?, ?, ?)",
+            (user_id, class_id, time.time() if created is None else created, json.dumps(progress),
+             None if report is None else json.dumps(report)))
+
+        return cursor.lastrowid
+
+
+    def has_attempt(self, user_id, class_id):
+        row = self.connection().execute("SELECT 1 FROM attempts WHERE user_id = ? AND class_id = ? LIMIT 1",
+                                        (user_id, class_id)).fetchone()
+
+        return row is not None or self.import_legacy(user_id, class_id)
+
+
+    def latest(self, user_id, class_id):
+        # The most recent attempt as a dict, or None when there is none
+        row = self.connection().execute(
+            "SELECT id, created, progress, report FROM attempts WHERE user_id = ? AND class_id = ? "
+            "ORDER BY created DESC, id DESC LIMIT 1", (user_id, class_id)).fetchone()
+
+        if row is None and self.import_legacy(user_id, class_id):
+            return self.latest(user_id, class_id)
+
+        return self.attempt(row)
+
+
+    def history(self, user_id, class_id, limit=None):
+        # Every attempt, oldest first
+        rows = self.connection().execute(
+            "SELECT id, created, progress, report FROM attempts WHERE user_id = ? AND class_id = ? "
+            "ORDER BY created, id", (user_id, class_id)).fetchall()
+
+        if not rows and self.import_legacy(user_id, class_id):
+            return self.history(user_id, class_id, limit)
+
+        return [self.attempt(row) for row in (rows[-limit:] if limit else rows)]
+
+
+    def attempt_ids(self, user_id, class_id, limit=None):
+        # (id, created) of the latest attempts, oldest first, without reading their snapshots
+        rows = self.connection().execute(
+            "SELECT id, created FROM attempts WHERE user_id = ? AND class_id = ? ORDER BY created DESC, id DESC "
+            "LIMIT ?", (user_id, class_id, -1 if limit is None else limit)).fetchall()
+
+        if not rows and self.import_legacy(user_id, class_id):
+            return self.attempt_ids(user_id, class_id, limit)
+
+        return rows[::-1]
+
+
+    def get(self, attempt_id):
+        return self.attempt(self.connection().execute(
+            "SELECT id, created, progress, report FROM attempts WHERE id = ?", (attempt_id,)).fetchone())
+
+
+    def progress_by_ids(self, attempt_ids):
+        # attempt ID -> stored progress of many attempts in one query, without parsing their reports.
+        # The IDs go in as one JSON array, so there is no limit on bound parameters
+        rows = self.connection().execute(
+            "SELECT id, progress FROM attempts WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(attempt_ids)),)).fetchall()
+
+        return {attempt_id: json.loads(progress) for attempt_id, progress in rows}
+
+
+    def latest_ids(self, class_id, user_ids=None):
+        # user_id -> ID of the latest attempt of every student in the class, read from the index alone.
+        # SQLite takes the bare id column from the row holding the MAX
+        self.import_class(class_id)
+        rows = self.connection().execute(
+            "SELECT user_id, id, MAX(created) FROM attempts WHERE class_id = ? GROUP BY user_id",
+            (class_id,)).fetchall()
+
+        return {user_id: attempt_id for user_id, attempt_id, _ in rows if user_ids is None or user_id in user_ids}
+
+
+    def attempt(self, row):
+        if row is None:
+            return None
+
+        attempt_id, created, progress, report = row
+        return {
+            'id': attempt_id,
+            'created': created,
+            'progress': json.loads(progress),
+            'report': None if report is None else json.loads(report)
+        }
+
+
+    def read_legacy(self, path):
+        progress = {}
+
+        for key, file_name in SNAPSHOT_FILES.items():
+            try:
+                with open(os.path.join(path, file_name), "r") as fp:
+                    progress[key] = json.load(fp)
+            except FileNotFoundError:
+                return None
+
+        try:
+            with open(os.path.join(path, "report.json"), "r") as fp:
+                report = json.load(fp)
+        except (FileNotFoundError, json.JSONDecodeError):
+            report = None
+
+        created = os.stat(os.path.join(path, SNAPSHOT_FILES["overall_progress"])).st_mtime
+
+        return progress, report, created
+
+
+    def import_legacy(self, user_id, class_id):
+        # Students saved in the JSON layout are moved over on first lookup
+        if not self.legacy_dir:
+            return False
+
+        path = os.path.join(self.legacy_dir, f"{user_id}-{class_id}", "previous")
+        if not os.path.isfile(os.path.join(path, SNAPSHOT_FILES["overall_progress"])):
+            return False
+
+        legacy = self.read_legacy(path)
+        if legacy is None:
+            return False
+
+        progress, report, created = legacy
+        connection = self.connection()
+
+        # Checked again inside the transaction, two requests for the same student may both get here
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            exists = connection.execute("SELECT 1 FROM attempts WHERE user_id = ? AND class_id = ? LIMIT 1",
+                                        (user_id, class_id)).fetchone()
+            if exists is None:
+                self.save(user_id, class_id, progress, report, created)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        logger.info(f"[OK] Import saved attempt for user={user_id}, class={class_id}")
+
+        return True
+
+
+    def import_class(self, class_id):
+        # Students of a class still in the JSON layout are moved over before its first cohort query. Once per class
+        # and process, nothing writes that layout any more
+        with self.import_lock:
+            if class_id in self.imported:
+                return 0
+            imported = self.migrate([class_id])
+            self.imported.add(class_id)
+
+        return imported
+
+
+    def migrate(self, class_ids):
+        # Bulk import of the JSON layout. Directories are named "{user_id}-{class_id}" and both IDs may contain
+        # "-", so the class IDs to import are given
+        if not self.legacy_dir or not os.path.isdir(self.legacy_dir):
+            return 0
+
+        entries = [entry for entry in os.scandir(self.legacy_dir) if entry.is_dir()]
+        imported = 0
+
+        for class_id in class_ids:
+            saved = {user_id for user_id, in self.connection().execute(
+                "SELECT DISTINCT user_id FROM attempts WHERE class_id = ?", (class_id,))}
+
+            for entry in entries:
+                if entry.name.endswith(f"-{class_id}"):
+                    user_id = entry.name[:-len(class_id) - 1]
+                    if user_id not in saved and self.import_legacy(user_id, class_id):
+                        imported += 1
+
+        logger.info(f"[OK] Migrated {imported} saved attempts for {', '.join(class_ids)} from {self.legacy_dir}")
+
+        return imported
+
+
+attempt_store = AttemptStore()
+
+
+class AttemptWriter:
+    # Attempts are saved in the background (write-behind), so a response never waits for the database. Writes for
+    # one student are chained and applied in order, a read of a student's history first waits for that student's
+    # pending writes, and flush() waits for all of them on shutdown. Each write is one SQLite transaction, so a
+    # reader sees either the whole attempt or none of it.
+
+    def __init__(self, store=attempt_store, workers=ATTEMPT_WRITER_WORKERS):
+        self.store = store
+        self.workers = workers
+        self.executor = None
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+
+
+    def submit(self, user_id, class_id, progress, report):
+        if self.workers <= 0:
+            self.store.save(user_id, class_id, progress, report)
+            return None
+
+        key = (user_id, class_id)
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='attempt-writer')
+            future = self.executor.submit(self.write, self.pending.get(key), user_id, class_id, progress, report)
+            self.pending[key] = future
+
+        future.add_done_callback(lambda future: self.done(key, future))
+
+        return future
+
+
+    def write(self, previous, user_id, class_id, progress, report):
+        # The previous write of the student was submitted first, so it is already running or finished
+        if previous is not None:
+            wait([previous])
+
+        try:
+            return self.store.save(user_id, class_id, progress, report)
+        except Exception:
+            logger.exception(f"[FAIL] Save attempt for user={user_id}, class={class_id}")
+            raise
+
+
+    def done(self, key, future):
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+            if future.exception() is None:
+                self.written += 1
+            else:
+                self.failed += 1
+
+
+    def wait(self, user_id, class_id):
+        with self.lock:
+            future = self.pending.get((user_id, class_id))
+
+        if future is not None:
+            wait([future])
+
+
+    def flush(self):
+        with self.lock:
+            futures = list(self.pending.values())
+
+        wait(futures)
+        logger.info(f"[OK] Flushed {len(futures)} pending attempt writes")
+
+
+    def stats(self):
+        return {'pending': len(self.pending), 'written': self.written, 'failed': self.failed}
+
+
+attempt_writer = AttemptWriter()
+
+
+if __name__ == '__main__':
+    # python attempt_store.py <class_id> [<class_id> ...]
+    logging.basicConfig(level=logging.INFO)
+    print(attempt_store.migrate(sys.argv[1:]))
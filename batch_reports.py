@@ -0,0 +1,139 @@
+from report_pipeline import generate_report, cpu_pool, shutdown_cpu_pool, CPU_WORKERS
+from attempt_store import attempt_writer
+from concurrent.futures import Executor, Future
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from collections import deque
+from dotenv import load_dotenv
+import threading
+import argparse
+import asyncio
+import logging
+import json
+import time
+import os
+
+
+logger = logging.getLogger(__name__)
+
+FETCH_CONCURRENCY = int(os.getenv('BATCH_FETCH_CONCURRENCY', 10))
+LLM_CONCURRENCY = int(os.getenv('BATCH_LLM_CONCURRENCY', 4))
+
+
+class BatchRequest(BaseModel):
+    course: str = Field(description="Course/class ID the reports are generated for")
+    users: List[str] = Field(description="User IDs to generate reports for")
+    fetch_concurrency: Optional[int] = Field(default=None, ge=1, description="Maximum concurrent upstream fetches")
+    llm_concurrency: Optional[int] = Field(default=None, ge=1, description="Maximum concurrent Gemini calls")
+    cpu_workers: Optional[int] = Field(default=None, ge=1, description="Processes for aggregation and heatmaps")
+
+
+class BatchExecutor(Executor):
+    # One batch's share of the shared pool (report_pipeline.cpu_pool): at most `workers` of its tasks in the pool at a
+    # time, the rest wait here. A task cancelled while waiting (the client went away) never reaches the pool
+
+    def __init__(self, executor, workers):
+        self.executor = executor
+        self.workers = workers
+        self.running = 0
+        self.pending = deque()
+        self.lock = threading.Lock()
+
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        with self.lock:
+            self.pending.append((future, fn, args, kwargs))
+        self.dispatch()
+        return future
+
+
+    def dispatch(self):
+        while True:
+            with self.lock:
+                if self.running >= self.workers or not self.pending:
+                    return
+                future, fn, args, kwargs = self.pending.popleft()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self.running += 1
+
+            try:
+                self.executor.submit(fn, *args, **kwargs).add_done_callback(
+                    lambda inner, future=future: self.finish(future, inner))
+            except Exception as e:
+                with self.lock:
+                    self.running -= 1
+                future.set_exception(e)
+
+
+    def finish(self, future, inner):
+        with self.lock:
+            self.running -= 1
+
+        if inner.cancelled():
+            future.set_exception(asyncio.CancelledError())
+        elif inner.exception() is not None:
+            future.set_exception(inner.exception())
+        else:
+            future.set_result(inner.result())
+
+        self.dispatch()
+
+
+async def generate_batch(class_id, user_ids, fetch_concurrency=None, llm_concurrency=None, cpu_workers=None):
+    # Yields one result per student as soon as it finishes, failures included
+    fetch_limit = asyncio.Semaphore(fetch_concurrency or FETCH_CONCURRENCY)
+    llm_limit = asyncio.Semaphore(llm_concurrency or LLM_CONCURRENCY)
+
+    executor = BatchExecutor(cpu_pool(), min(cpu_workers or CPU_WORKERS, CPU_WORKERS))
+
+    async def run(user_id):
+        start = time.perf_counter()
+        try:
+            report = await generate_report(user_id, class_id, fetch_limit, llm_limit, executor)
+        except Exception as e:
+            logger.exception(f"[FAIL] Batch report for user={user_id}, class={class_id}")
+            return {'user': user_id, 'status': 'failed', 'error': f"{type(e).__name__}: {e}",
+                    'seconds': round(time.perf_counter() - start, 3)}
+
+        status = 'failed' if report is None else 'ok'
+        return {'user': user_id, 'status': status, 'report': report,
+                'seconds': round(time.perf_counter() - start, 3)}
+
+    tasks = [asyncio.create_task(run(user_id)) for user_id in dict.fromkeys(user_ids)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def main(args):
+    completed = failed = 0
+
+    async for result in generate_batch(args.course, args.users, args.fetch_concurrency, args.llm_concurrency,
+                                       args.cpu_workers):
+        completed += 1
+        failed += result['status'] != 'ok'
+        print(json.dumps(jsonable_encoder(result)), flush=True)
+
+    await shutdown_cpu_pool()
+    await asyncio.to_thread(attempt_writer.flush)
+    logger.info(f"[OK] Batch finished for class={args.course}: {completed - failed} generated, {failed} failed")
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Generate progress reports for a whole course")
+    parser.add_argument('course', help="Course/class ID")
+    parser.add_argument('users', nargs='+', help="User IDs")
+    parser.add_argument('--fetch-concurrency', type=int, default=None)
+    parser.add_argument('--llm-concurrency', type=int, default=None)
+    parser.add_argument('--cpu-workers', type=int, default=None)
+
+    asyncio.run(main(parser.parse_args()))
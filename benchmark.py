@@ -0,0 +1,618 @@
+import asyncio
+import copy
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import data_processing
+from benchmark_fakes import synthetic_payloads, FakeUpstream, FakeGeminiClient
+from data_processing import FetchStudentData, data_segregation, fetch_student_payloads_async
+
+
+# Simulated latencies (seconds) for the upstream student API and the Gemini call
+UPSTREAM_LATENCY = 0.15
+LLM_LATENCY = 1.0
+
+# Matches the default threadpool size FastAPI uses for sync endpoints
+SYNC_WORKERS = 40
+
+# Suite results, one JSON file per run, compared with `python benchmark.py compare`
+BENCHMARK_DIR = os.getenv('BENCHMARK_DIR', 'Data/benchmarks')
+# Student sizes of the function benchmarks: topics per subject x practices per topic
+SUITE_SIZES = {"small": (10, 9), "large": (60, 15)}
+SUITE_STUDENTS = 40
+SUITE_CONCURRENCY = 10
+
+
+def simulate_upstream(payloads):
+    responses = dict(zip(data_processing.student_endpoints("user", "class"), payloads))
+
+    def fake_fetch_json(url, header):
+        time.sleep(UPSTREAM_LATENCY)
+        return responses[url]
+
+    data_processing.fetch_json = fake_fetch_json
+
+
+def sync_report():
+    # Previous request path: sequential upstream calls and a blocking LLM call in a worker thread
+    student_data = FetchStudentData("user", "class")
+    data_segregation(student_data.master_loop())
+    time.sleep(LLM_LATENCY)
+
+
+async def async_report():
+    payloads = await fetch_student_payloads_async("user", "class")
+    student_data = FetchStudentData("user", "class", payloads)
+    data_segregation(await asyncio.to_thread(student_data.master_loop))
+    await asyncio.sleep(LLM_LATENCY)
+
+
+def timed(func, start):
+    # Measured from submission, so time spent queued for a worker thread counts too
+    func()
+    return time.perf_counter() - start
+
+
+async def timed_async(coroutine):
+    start = time.perf_counter()
+    await coroutine
+    return time.perf_counter() - start
+
+
+def latency_stats(latencies):
+    latencies = sorted(latencies)
+    return {
+        'p50_ms': round(statistics.median(latencies) * 1000, 3),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3)
+    }
+
+
+def summarize(name, latencies):
+    stats = latency_stats(latencies)
+    print(f"{name:<8} p50={stats['p50_ms']:8.1f}ms  p99={stats['p99_ms']:8.1f}ms  max={stats['max_ms']:8.1f}ms")
+
+
+def compare_report_latency(concurrency):
+    print(f"Report pipeline latency with {concurrency} concurrent requests "
+          f"(upstream={UPSTREAM_LATENCY}s, llm={LLM_LATENCY}s)")
+
+    with ThreadPoolExecutor(max_workers=SYNC_WORKERS) as pool:
+        start = time.perf_counter()
+        futures = [pool.submit(timed, sync_report, start) for _ in range(concurrency)]
+        summarize("sync", [future.result() for future in futures])
+
+    async def run_async():
+        return await asyncio.gather(*[timed_async(async_report()) for _ in range(concurrency)])
+
+    summarize("async", asyncio.run(run_async()))
+
+
+def aggregation_scaling(sizes=(50, 100, 200, 400, 800), repeats=3):
+    # master_loop should cost the same per test whether a topic has ten tests or a thousand
+    print("master_loop scaling (topics per subject x tests per topic)")
+
+    for size in sizes:
+        topics, tests = size, size // 5
+        payloads = synthetic_payloads(topics, tests, quizzes=0, exams=0)
+        elapsed = min(timed(FetchStudentData("user", "class", payloads).master_loop, time.perf_counter())
+                      for _ in range(repeats))
+        total_tests = 3 * topics * tests
+        print(f"{topics:>5} x {tests:<5} tests={total_tests:>8}  {elapsed * 1000:9.1f}ms  "
+              f"{elapsed / total_tests * 1e6:6.2f}us/test")
+
+
+def earlier_payloads(payloads, share=0.1, seed=1):
+    # The same student some time ago: the last test in a share of the topics had not been attempted yet
+    rng = random.Random(seed)
+    overall, completion, scores = copy.deepcopy(payloads)
+
+    for completed, scored in zip(completion["topics"], scores["topics"]):
+        if scored["latestPracticesDone"] and rng.random() < share:
+            test = scored["latestPracticesDone"].pop()
+            completed["attemptedPractices"] = [t for t in completed["attemptedPractices"] if t["name"] != test["name"]]
+            completed["unAttemptedPractices"].append({"name": test["name"]})
+
+    return [overall, completion, scores]
+
+
+def prompt_size(sizes=((10, 9), (30, 12), (60, 15))):
+    from prompt_format import estimate_tokens, format_progress, format_changes
+
+    print("Prompt progress data size, repr of the dictionaries vs compact tables (estimated tokens)")
+
+    for topics, tests in sizes:
+        payloads = synthetic_payloads(topics, tests)
+        current = data_segregation(FetchStudentData("user", "class", payloads).master_loop())
+        previous = {k: v.stored() for k, v in
+                    data_segregation(FetchStudentData("user", "class", earlier_payloads(payloads)).master_loop()).items()}
+        subjects = {k: v for k, v in current.items() if k != 'overall_progress'}
+
+        # Layout the prompt used before: the repr of the display dictionaries, plus the full previous snapshot
+        first_repr = "\n".join(f"{k} = {v.display()}" for k, v in current.items())
+        subsequent_repr = first_repr + "\n" + "\n".join(f"Previous_{k} = {v}" for k, v in previous.items())
+
+        first_compact = format_progress(current['overall_progress'], subjects)
+        subsequent_compact = first_compact + "\n" + format_changes(current['overall_progress'], subjects, previous)
+
+        for name, before, after in (("first", first_repr, first_compact),
+                                    ("subsequent", subsequent_repr, subsequent_compact)):
+            print(f"{topics:>3} topics x {tests:<3} tests  {name:<10}  repr={estimate_tokens(before):>7}  "
+                  f"compact={estimate_tokens(after):>7}  ({estimate_tokens(after) / estimate_tokens(before):.0%})")
+
+
+def pyplot_heatmap(file_path, output_path, title, size):
+    # generate_heatmap as it was before render_heatmap: pyplot's global figure, drawn from the saved JSON.
+    # Only the baseline of heatmap_rendering, the app no longer renders this way
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn as sns
+    from matplotlib.colors import LinearSegmentedColormap
+    from heatmaps import flatten_data, BLUE_SHADES
+
+    with open(file_path, 'r') as f:
+        data = json.load(f)
+
+    custom_cmap = LinearSegmentedColormap.from_list('Blue Shades', BLUE_SHADES, N=256)
+
+    plt.figure(figsize=size)
+    plt.title(title, fontsize=20, pad=23)
+
+    ax = sns.heatmap(pd.DataFrame.from_dict(flatten_data(data), orient='index'), vmin=0.0, vmax=100.0,
+                     cmap=custom_cmap, annot=True, fmt='.1f', cbar_kws={'label': 'Progress (%)'})
+
+    ax.set(xlabel="Difficulty Level", ylabel="Topics")
+    ax.xaxis.tick_top()
+    ax.tick_params(axis='x', labelsize=12)
+    ax.tick_params(axis='y', labelsize=10)
+    ax.xaxis.set_label_position('top')
+    ax.xaxis.label.set_size(16)
+    ax.xaxis.labelpad = 15
+    ax.yaxis.label.set_size(16)
+    ax.yaxis.labelpad = 10
+
+    plt.savefig(output_path, bbox_inches='tight')
+    plt.close()
+
+
+def heatmap_rendering(reports=5):
+    # Per-report render time for the three subject heatmaps: the original pyplot renderer reading back the saved
+    # JSON, one after another, against renders from memory on threads and on a process pool (what reports use)
+    from concurrent.futures import ProcessPoolExecutor
+    from generate_heatmaps import render_heatmap
+    import heatmaps
+    import multiprocessing
+    import tempfile
+    import json
+    import os
+
+    print(f"Heatmap rendering, three subjects per report, best of {reports} reports")
+
+    performance_data = data_segregation(FetchStudentData("user", "class", synthetic_payloads()).master_loop())
+    subjects = [(performance_data[subject].stored(), f"SAT {subject} Progress Heatmap", size)
+                for subject, size in (("Mathematics", (8, 14)), ("Writing", (8, 8)), ("Reading", (8, 4)))]
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        def pyplot_sequential():
+            for i, (data, title, size) in enumerate(subjects):
+                path = os.path.join(base_dir, f"{i}.json")
+                with open(path, "w") as fp:
+                    json.dump(data, fp)
+                pyplot_heatmap(path, os.path.join(base_dir, f"pyplot_{i}.png"), title, size)
+
+        def parallel_figures(executor):
+            futures = [executor.submit(render_heatmap, data, title, size, os.path.join(base_dir, f"figure_{i}.png"))
+                       for i, (data, title, size) in enumerate(subjects)]
+            for future in futures:
+                future.result()
+
+        with ThreadPoolExecutor(max_workers=3) as threads, \
+                ProcessPoolExecutor(max_workers=3, mp_context=multiprocessing.get_context('spawn')) as processes:
+            # Warm the process pool, the first task in each worker pays for importing matplotlib
+            list(processes.map(render_heatmap, *zip(*subjects)))
+
+            heatmaps.heatmap_cache = heatmaps.HeatmapCache(os.path.join(base_dir, "cache"))
+
+            def cached(format):
+                for i, (data, title, size) in enumerate(subjects):
+                    heatmaps.heatmap(data, title, size, os.path.join(base_dir, f"cached_{i}.{format}"), format)
+
+            def svg_uncached():
+                for data, title, size in subjects:
+                    heatmaps.render_svg(heatmaps.flatten_data(data), title, size)
+
+            for name, render in (("pyplot, sequential", pyplot_sequential),
+                                 ("figures, threads", lambda: parallel_figures(threads)),
+                                 ("figures, processes", lambda: parallel_figures(processes)),
+                                 ("png, cache hit", lambda: cached("png")),
+                                 ("svg, uncached", svg_uncached)):
+                elapsed = min(timed(render, time.perf_counter()) for _ in range(reports))
+                print(f"{name:<20} {elapsed * 1000:9.1f}ms")
+
+
+def startup_time(runs=5):
+    # Import time of the app, and time from launching uvicorn to the first /documentation response,
+    # with the heavy imports lazy (current) and loaded up front (as before)
+    import subprocess
+    import socket
+    import urllib.request
+    import os
+
+    print(f"Startup time, median of {runs} runs")
+
+    modes = {
+        "lazy": "import app",
+        "eager": "import app, warmup; warmup.warm_up()"
+    }
+
+    for mode, statement in modes.items():
+        code = f"import time; start = time.perf_counter(); {statement}; print(time.perf_counter() - start)"
+        imports = [float(subprocess.check_output([sys.executable, "-c", code], stderr=subprocess.DEVNULL,
+                                                 env=dict(os.environ, WARMUP="0")).split()[-1])
+                   for _ in range(runs)]
+
+        first_responses = []
+        for _ in range(runs):
+            with socket.socket() as sock:
+                sock.bind(("127.0.0.1", 0))
+                port = sock.getsockname()[1]
+
+            # WARMUP=1 runs the eager imports in the startup hook, in the background
+            env = dict(os.environ, WARMUP="1" if mode == "eager" else "0")
+            start = time.perf_counter()
+            server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app:app", "--port", str(port),
+                                       "--log-level", "warning"], env=env, stderr=subprocess.DEVNULL)
+            try:
+                while True:
+                    try:
+                        urllib.request.urlopen(f"http://127.0.0.1:{port}/documentation", timeout=1).read()
+                        break
+                    except OSError:
+                        time.sleep(0.01)
+                first_responses.append(time.perf_counter() - start)
+            finally:
+                server.terminate()
+                server.wait()
+
+        print(f"{mode:<6} import={statistics.median(imports) * 1000:8.1f}ms  "
+              f"first_response={statistics.median(first_responses) * 1000:8.1f}ms")
+
+
+def persistence_latency(students=100, concurrency=SUITE_CONCURRENCY, upstream_latency=UPSTREAM_LATENCY,
+                        llm_latency=0.2):
+    # Whole reports against the fake student APIs and Gemini client, with the attempt saved inside the report
+    # (ATTEMPT_WRITER_WORKERS=0, as before) and written behind. Each mode gets its own students, so neither reuses
+    # the other's cached parts or heatmaps. Runs in a temporary directory, so attempts and heatmaps stay out of Data/
+    import tempfile
+    import shutil
+
+    cwd = os.getcwd()
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        os.makedirs(os.path.join(base_dir, "Data", "exam_context"))
+        shutil.copy(os.path.join(repo_dir, "Data", "exam_context", "details.md"),
+                    os.path.join(base_dir, "Data", "exam_context", "details.md"))
+        os.chdir(base_dir)
+
+        import heatmaps
+        from report_pipeline import generate_report, shutdown_cpu_pool
+        from attempt_store import attempt_writer
+        from gemini_client import gemini_agent
+
+        heatmaps.heatmap_cache = heatmaps.HeatmapCache(os.path.join(base_dir, "Data", "heatmap_cache"))
+        workers = attempt_writer.workers
+        gemini = FakeGeminiClient(latency=llm_latency)
+        original_factory = gemini.install()
+
+        print(f"Report latency, {students} students per mode, {concurrency} concurrent "
+              f"(upstream={upstream_latency}s, llm={llm_latency}s, heatmaps={heatmaps.HEATMAP_FORMAT})")
+
+        try:
+            with FakeUpstream(latency=upstream_latency):
+                async def run(name):
+                    limit = asyncio.Semaphore(concurrency)
+
+                    async def report(user):
+                        async with limit:
+                            start = time.perf_counter()
+                            await generate_report(user, "class")
+                            return time.perf_counter() - start
+
+                    # Not timed: loads the context, the client and the heatmap renderer
+                    await generate_report(f"{name}_warmup", "class")
+                    latencies = await asyncio.gather(*[report(f"{name}{i}") for i in range(students)])
+                    await shutdown_cpu_pool()
+                    return latencies
+
+                for name, mode_workers in [("inline", 0), ("behind", workers or 2)]:
+                    attempt_writer.workers = mode_workers
+                    latencies = asyncio.run(run(name))
+                    results[f"persistence[{name}]"] = latency_stats(latencies)
+                    summarize(name, latencies)
+
+                    start = time.perf_counter()
+                    attempt_writer.flush()
+                    print(f"{'':<8} flush={(time.perf_counter() - start) * 1000:8.1f}ms")
+        finally:
+            attempt_writer.workers = workers
+            gemini_agent.client_factory = original_factory
+            os.chdir(cwd)
+
+    return results
+
+
+def cohort_scaling(students=3000):
+    from attempt_store import AttemptStore
+    import cohort_analytics
+    import tempfile
+    import os
+
+    print(f"Cohort analytics over {students} students")
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        store = AttemptStore(os.path.join(base_dir, "attempts.db"), legacy_dir=None)
+        for i in range(students):
+            performance_data = data_segregation(FetchStudentData("user", "class", synthetic_payloads(seed=i)).master_loop())
+            store.save(f"user{i}", "class", {k: v.stored() for k, v in performance_data.items()}, None)
+
+        for run in ["cold", "warm"]:
+            start = time.perf_counter()
+            cohort_analytics.cohort_report("class", store=store)
+            print(f"{run:<5} {(time.perf_counter() - start) * 1000:9.1f}ms")
+
+
+def upstream_cache_latency(students=50):
+    # Time to fetch a student's three payloads from the fake student API: without the cache, from a fresh copy,
+    # revalidated with a conditional GET (304), and from a stale copy while it refreshes in the background
+    from upstream_cache import UpstreamCache
+
+    modes = {
+        "no cache": dict(max_entries=0),
+        "fresh": dict(fresh=3600),
+        "304": dict(fresh=0, stale=0),
+        "stale": dict(fresh=0, stale=3600)
+    }
+    users = [f"student{i}" for i in range(students)]
+    original = data_processing.upstream_cache
+
+    print(f"Upstream fetch, {students} concurrent students (upstream={UPSTREAM_LATENCY}s)")
+
+    async def run():
+        return await asyncio.gather(*[timed_async(fetch_student_payloads_async(user, "class")) for user in users])
+
+    try:
+        with FakeUpstream(latency=UPSTREAM_LATENCY) as upstream:
+            for name, settings in modes.items():
+                cache = data_processing.upstream_cache = UpstreamCache(**settings)
+                # The first pass fills the cache, the second is measured
+                asyncio.run(run())
+                requests, not_modified = upstream.requests, upstream.not_modified
+                summarize(name, asyncio.run(run()))
+                # Counts the background refreshes the measured pass started too
+                if cache.executor is not None:
+                    cache.executor.shutdown(wait=True)
+                print(f"{'':<8} upstream requests={upstream.requests - requests}  "
+                      f"not_modified={upstream.not_modified - not_modified}")
+    finally:
+        data_processing.upstream_cache = original
+
+
+def measure(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return {'median_ms': round(statistics.median(times) * 1000, 3), 'min_ms': round(min(times) * 1000, 3),
+            'runs': repeats}
+
+
+def function_benchmarks(repeats=20, heatmap_repeats=5):
+    # The CPU-bound steps of a report, on a small and a large synthetic student
+    from generate_heatmaps import generate_heatmap
+    from heatmaps import flatten_data, render_svg
+    from sat_agent import generate_section_prompt
+    import tempfile
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        for size, (topics, tests) in SUITE_SIZES.items():
+            payloads = synthetic_payloads(topics, tests)
+            performance_data = data_segregation(FetchStudentData("user", "class", payloads).master_loop())
+            overall = performance_data['overall_progress']
+            mathematics = performance_data['Mathematics'].stored()
+            title = "SAT Mathematics Progress Heatmap"
+
+            data_path = os.path.join(base_dir, f"{size}.json")
+            with open(data_path, "w") as fp:
+                json.dump(mathematics, fp)
+
+            # Percentages are no longer cleaned on dictionaries (clean_percentage_values), progress records
+            # are converted for display and for storage instead
+            cases = {
+                'master_loop': lambda: FetchStudentData("user", "class", payloads).master_loop(),
+                'progress_display': lambda: {k: v.display() for k, v in performance_data.items()},
+                'progress_stored': lambda: {k: v.stored() for k, v in performance_data.items()},
+                'flatten_data': lambda: flatten_data(mathematics),
+                'generate_heatmap': lambda: generate_heatmap(data_path, os.path.join(base_dir, f"{size}.png"),
+                                                             title, (8, 14)),
+                'render_svg': lambda: render_svg(flatten_data(mathematics), title, (8, 14)),
+                'section_prompts': lambda: [generate_section_prompt(subject, performance_data[subject], overall)
+                                            for subject in ("Mathematics", "Writing", "Reading")]
+            }
+
+            for name, func in cases.items():
+                # One untimed run for imports and first-use caches
+                func()
+                result = measure(func, heatmap_repeats if name == 'generate_heatmap' else repeats)
+                results[f"{name}[{size}]"] = result
+                print(f"{name + '[' + size + ']':<28} median={result['median_ms']:9.2f}ms  "
+                      f"min={result['min_ms']:9.2f}ms")
+
+    return results
+
+
+def endpoint_latency(students=SUITE_STUDENTS, concurrency=SUITE_CONCURRENCY, upstream_latency=UPSTREAM_LATENCY, llm_latency=LLM_LATENCY):
+    # /generate_report end to end on a local uvicorn server, against the fake student APIs and Gemini client.
+    # Each student is requested twice: first with no history, then again with nothing new (the attempt path).
+    # Runs in a temporary directory, so attempts, heatmaps, jobs and logs stay out of Data/
+    import tempfile
+    import shutil
+    import socket
+    import threading
+
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    cwd = os.getcwd()
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    context_path = os.path.join(repo_dir, "Data", "exam_context", "details.md")
+    # The app is imported from the temporary directory
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+    results = {}
+
+    print(f"/generate_report, {students} students, {concurrency} concurrent "
+          f"(upstream={upstream_latency}s, llm={llm_latency}s)")
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        os.makedirs(os.path.join(base_dir, "Data", "exam_context"))
+        shutil.copy(context_path, os.path.join(base_dir, "Data", "exam_context", "details.md"))
+        os.chdir(base_dir)
+
+        import httpx
+        import uvicorn
+        import heatmaps
+        import app
+        from gemini_client import gemini_agent
+
+        # The heatmap cache may already have been set up in the working directory, start from an empty one
+        heatmaps.heatmap_cache = heatmaps.HeatmapCache(os.path.join(base_dir, "Data", "heatmap_cache"))
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+
+        server = uvicorn.Server(uvicorn.Config(app.app, host="127.0.0.1", port=port, log_level="warning"))
+        thread = threading.Thread(target=server.run, daemon=True)
+        gemini = FakeGeminiClient(latency=llm_latency)
+        original_factory = gemini.install()
+
+        try:
+            with FakeUpstream(latency=upstream_latency):
+                thread.start()
+                while not server.started:
+                    time.sleep(0.01)
+
+                async def run(users):
+                    limit = asyncio.Semaphore(concurrency)
+
+                    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=300) as client:
+                        async def request(user):
+                            async with limit:
+                                start = time.perf_counter()
+                                response = await client.get("/generate_report",
+                                                            params={'user': user, 'course': "class"})
+                                return time.perf_counter() - start, response.status_code
+
+                        start = time.perf_counter()
+                        responses = await asyncio.gather(*[request(user) for user in users])
+                        return responses, time.perf_counter() - start
+
+                # Not timed: the first report waits for the background warm up and opens the connections
+                asyncio.run(run(["warmup"]))
+
+                users = [f"student{i}" for i in range(students)]
+                for name in ("first", "repeat"):
+                    responses, elapsed = asyncio.run(run(users))
+                    result = latency_stats([latency for latency, _ in responses])
+                    result['errors'] = sum(status != 200 for _, status in responses)
+                    result['throughput_rps'] = round(len(responses) / elapsed, 2)
+                    results[f"endpoint[{name}]"] = result
+                    print(f"{name:<8} p50={result['p50_ms']:8.1f}ms  p99={result['p99_ms']:8.1f}ms  "
+                          f"max={result['max_ms']:8.1f}ms  {result['throughput_rps']:6.2f} req/s  "
+                          f"errors={result['errors']}")
+        finally:
+            server.should_exit = True
+            thread.join()
+            gemini_agent.client_factory = original_factory
+            os.chdir(cwd)
+
+    return results
+
+
+def git_commit():
+    import subprocess
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(baseline=None):
+    # Every run uses the same seeds and settings, so two result files differ only by the code and the machine
+    from heatmaps import HEATMAP_FORMAT
+
+    settings = {'sizes': SUITE_SIZES, 'students': SUITE_STUDENTS, 'concurrency': SUITE_CONCURRENCY,
+                'upstream_latency': UPSTREAM_LATENCY, 'llm_latency': LLM_LATENCY, 'heatmap_format': HEATMAP_FORMAT}
+    results = {**function_benchmarks(), **endpoint_latency()}
+
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    path = os.path.join(BENCHMARK_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w") as fp:
+        json.dump({'created': time.time(), 'commit': git_commit(), 'python': sys.version.split()[0],
+                   'settings': settings, 'results': results}, fp, indent=2)
+    print(f"Saved {path}")
+
+    if baseline:
+        compare_results(baseline, path)
+
+
+def compare_results(baseline_path, current_path):
+    # Median time of the functions and p50 latency of the endpoint, lower is better
+    with open(baseline_path) as fp:
+        baseline = json.load(fp)
+    with open(current_path) as fp:
+        current = json.load(fp)
+
+    print(f"{'':<28} {baseline.get('commit') or baseline_path:>12} {current.get('commit') or current_path:>12}")
+    for name, result in current['results'].items():
+        key = 'median_ms' if 'median_ms' in result else 'p50_ms'
+        before = baseline['results'].get(name, {}).get(key)
+        if not before:
+            print(f"{name:<28} {'-':>12} {result[key]:10.2f}ms")
+            continue
+        print(f"{name:<28} {before:10.2f}ms {result[key]:10.2f}ms  {result[key] / before:6.2f}x")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'suite':
+        run_suite(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        compare_results(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'upstream':
+        upstream_cache_latency()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'aggregation':
+        aggregation_scaling()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'persistence':
+        persistence_latency()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'startup':
+        startup_time()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'heatmaps':
+        heatmap_rendering()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'prompt':
+        prompt_size()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'cohort':
+        cohort_scaling(int(sys.argv[2]) if len(sys.argv) > 2 else 3000)
+    else:
+        simulate_upstream(synthetic_payloads())
+        compare_report_latency(int(sys.argv[-1]) if len(sys.argv) > 1 and sys.argv[-1].isdigit() else 100)
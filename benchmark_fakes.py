@@ -0,0 +1,295 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+from email.utils import formatdate
+from typing import get_args, get_origin
+from types import SimpleNamespace
+from pydantic import BaseModel
+import data_processing
+import threading
+import asyncio
+import random
+import json
+import time
+import zlib
+
+
+SUBJECTS = ["Mathematics", "Writing", "Reading"]
+DIFFICULTIES = ["easy", "medium", "hard"]
+
+# Upstream endpoints served by FakeUpstream, in the order of data_processing.student_endpoints
+UPSTREAM_KINDS = ["overall", "completion", "scores"]
+
+
+def synthetic_payloads(topics=10, tests=9, seed=0, quizzes=None, exams=1, attempted=0.6):
+    # The three upstream payloads of one student. Per subject: `topics` topics, each with `tests` practices and
+    # `quizzes` timed tests (default a third of the practices), plus `exams` full length tests, which only
+    # have a score and sit in their own section as upstream. About `attempted` of everything has been done
+    rng = random.Random(seed)
+    quizzes = tests // 3 if quizzes is None else quizzes
+    completion = []
+    scores = []
+    answered = {"Practices": [0, 0], "Tests": [0, 0]}
+
+    def take(names, points):
+        done = [name for name in names if rng.random() < attempted]
+        results = [{"name": name, "obtainedPoints": rng.randint(0, points), "totalPoints": points} for name in done]
+        return done, [name for name in names if name not in done], results
+
+    for subject in SUBJECTS:
+        for t in range(topics):
+            name = f"{subject} Topic {t}"
+            practices = take([f"{name} Practice {i} ({DIFFICULTIES[i % 3]})" for i in range(tests)], 10)
+            timed = take([f"{name} Quiz {i} ({DIFFICULTIES[i % 3]})" for i in range(quizzes)], 20)
+
+            completion.append({
+                "name": name,
+                "attemptedPractices": [{"name": n} for n in practices[0]],
+                "attemptedTests": [{"name": n} for n in timed[0]],
+                "unAttemptedPractices": [{"name": n} for n in practices[1]],
+                "unAttemptedTests": [{"name": n} for n in timed[1]]
+            })
+            scores.append({
+                "name": name,
+                "courseName": "SAT",
+                "subjectName": subject,
+                "sectionName": f"{subject} Domain {t % 3}",
+                "latestPracticesDone": practices[2],
+                "latestTestsDone": timed[2]
+            })
+
+            for kind, (_, _, results) in (("Practices", practices), ("Tests", timed)):
+                answered[kind][0] += sum(r["totalPoints"] for r in results)
+                answered[kind][1] += sum(r["obtainedPoints"] for r in results)
+
+        for e in range(exams):
+            name = f"{subject} Full Length Test {e}"
+            done, missed, results = take([name], 100)
+
+            completion.append({
+                "name": name,
+                "attemptedPractices": [],
+                "attemptedTests": [{"name": n} for n in done],
+                "unAttemptedPractices": [],
+                "unAttemptedTests": [{"name": n} for n in missed]
+            })
+            scores.append({
+                "name": name,
+                "courseName": "SAT",
+                "subjectName": subject,
+                "sectionName": "Full Length Exams - Section Wise",
+                "latestPracticesDone": [],
+                "latestTestsDone": results
+            })
+
+    total = len(completion)
+    overall = {
+        "timeSpentPractice": answered["Practices"][0] * 45,
+        "timeSpentTest": answered["Tests"][0] * 60,
+        "totalQ_AnsweredOfPractices": answered["Practices"][0],
+        "totalCorrectAnsweredOfPractices": answered["Practices"][1],
+        "totalQ_AnsweredOfTests": answered["Tests"][0],
+        "totalCorrectAnsweredOfTests": answered["Tests"][1],
+        "percentageCourseWork": round(sum(bool(c["attemptedPractices"] or c["attemptedTests"])
+                                          for c in completion) / max(total, 1) * 100, 1)
+    }
+
+    return [overall, {"topics": completion}, {"topics": scores}]
+
+
+def student_seed(user_id, class_id):
+    # Stable across runs and processes, unlike hash()
+    return zlib.crc32(f"{user_id}-{class_id}".encode())
+
+
+class FakeUpstream:
+    # The three student APIs on a local HTTP server, each student with their own synthetic payloads.
+    # install() points data_processing at it, so requests go through http_client's pooled session as in production
+
+    def __init__(self, latency=0.15, topics=10, tests=9, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.topics = topics
+        self.tests = tests
+        self.payloads = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+        self.last_modified = formatdate(time.time(), usegmt=True)
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+        self.original_endpoints = None
+
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+    def handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so connection reuse in http_client is exercised
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                parts = [unquote(part) for part in self.path.strip("/").split("/")]
+                if len(parts) != 3 or parts[0] not in UPSTREAM_KINDS:
+                    self.send_error(404)
+                    return
+
+                time.sleep(upstream.latency)
+                body = upstream.payload(*parts)
+                etag = f'"{zlib.crc32(body):08x}"'
+
+                # Validators as a real API would send them, so conditional requests get 304 Not Modified
+                if self.headers.get("If-None-Match") == etag:
+                    upstream.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", upstream.last_modified)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+    def payload(self, kind, user_id, class_id):
+        key = (user_id, class_id)
+
+        with self.lock:
+            self.requests += 1
+            if key not in self.payloads:
+                payloads = synthetic_payloads(self.topics, self.tests, student_seed(user_id, class_id))
+                self.payloads[key] = [json.dumps(payload).encode() for payload in payloads]
+
+            return self.payloads[key][UPSTREAM_KINDS.index(kind)]
+
+
+    def endpoints(self, student_id, classroom_id):
+        return tuple(f"{self.url}/{kind}/{quote(str(student_id), safe='')}/{quote(str(classroom_id), safe='')}"
+                     for kind in UPSTREAM_KINDS)
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-upstream", daemon=True)
+        self.thread.start()
+        return self
+
+
+    def install(self):
+        self.original_endpoints = data_processing.student_endpoints
+        data_processing.student_endpoints = self.endpoints
+
+
+    def stop(self):
+        if self.original_endpoints is not None:
+            data_processing.student_endpoints = self.original_endpoints
+            self.original_endpoints = None
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def __enter__(self):
+        self.start()
+        self.install()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def filler(rng, words):
+    return " ".join(rng.choice(("student", "practice", "score", "topic", "review", "focus", "improve", "accuracy",
+                                "timing", "difficulty", "questions", "strategy")) for _ in range(words))
+
+
+def fake_output(schema, rng, items=3, words=40):
+    # A valid instance of a response schema: every string field filled with words, every list with items entries
+    values = {}
+
+    for name, field in schema.model_fields.items():
+        annotation = field.annotation
+        if get_origin(annotation) is list:
+            item = get_args(annotation)[0]
+            values[name] = [fake_output(item, rng, items, words) if issubclass(item, BaseModel) else filler(rng, 3)
+                            for _ in range(items)]
+        elif name.endswith("_name"):
+            values[name] = f"{name.removesuffix('_name').title()} {rng.randint(1, 99)}"
+        else:
+            values[name] = filler(rng, words)
+
+    return schema(**values)
+
+
+class FakeGeminiClient:
+    # Stands in for google.genai.Client behind GeminiAgent: the calls sleep for latency (plus up to jitter) and
+    # return a parsed, valid response of the requested schema with usage metadata, without a key or network.
+    # Context cache calls succeed, so the cached prompt path runs too
+
+    def __init__(self, latency=1.0, jitter=0.0, items=3, words=40, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.items = items
+        self.words = words
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.aio = SimpleNamespace(
+            models=SimpleNamespace(generate_content=self.generate_content),
+            caches=SimpleNamespace(create=self.create_cache, update=self.update_cache)
+        )
+
+
+    async def generate_content(self, model, contents, config):
+        from google.genai import types
+
+        self.calls += 1
+        await asyncio.sleep(self.latency + self.rng.uniform(0, self.jitter))
+
+        parsed = fake_output(config.response_schema, self.rng, self.items, self.words)
+        text = parsed.model_dump_json()
+        prompt_tokens = (len(contents) + len(str(config.system_instruction or ""))) // 4
+
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]),
+                                        finish_reason="STOP")],
+            response_id=f"fake-{self.calls}",
+            model_version=model,
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=prompt_tokens,
+                candidates_token_count=len(text) // 4,
+                total_token_count=prompt_tokens + len(text) // 4
+            ),
+            parsed=parsed
+        )
+
+
+    async def create_cache(self, model, config):
+        return SimpleNamespace(name=f"cachedContents/fake-{zlib.crc32(str(config.system_instruction).encode())}")
+
+
+    async def update_cache(self, name, config):
+        return SimpleNamespace(name=name)
+
+
+    def install(self, agent=None):
+        # Every call of the agent (the shared gemini_agent by default) goes to this client
+        if agent is None:
+            from gemini_client import gemini_agent as agent
+
+        original = agent.client_factory
+        agent.client_factory = lambda api: self
+
+        return original
@@ -0,0 +1,156 @@
+from attempt_store import attempt_store
+from progress_model import DIFFICULTIES
+from trends import read_snapshot
+from collections import OrderedDict
+import pandas as pd
+import numpy as np
+import threading
+import os
+
+
+# Parsed snapshots kept between cohort reports, overridable through the environment
+COHORT_CACHE_MAX_ENTRIES = int(os.getenv('COHORT_CACHE_MAX_ENTRIES', 10000))
+
+BINS = np.linspace(0, 100, 11)
+
+# (store path, user ID) -> (latest attempt ID, parsed snapshot rows), least recently used first
+_snapshot_cache = OrderedDict()
+_snapshot_lock = threading.Lock()
+
+
+def snapshot_rows(store, students):
+    # user ID -> parsed rows of each student's latest attempt. Parsing the JSON dominates load time, so rows are
+    # reused until the student saves a new attempt, and the rest are read in one query
+    rows, missing = {}, {}
+
+    with _snapshot_lock:
+        for user_id, attempt_id in students.items():
+            cached = _snapshot_cache.get((store.path, user_id))
+            if cached is not None and cached[0] == attempt_id:
+                _snapshot_cache.move_to_end((store.path, user_id))
+                rows[user_id] = cached[1]
+            else:
+                missing[user_id] = attempt_id
+
+    if missing:
+        progress = store.progress_by_ids(missing.values())
+        loaded = {user_id: read_snapshot(progress[attempt_id]) for user_id, attempt_id in missing.items()}
+        rows.update(loaded)
+
+        with _snapshot_lock:
+            for user_id, snapshot in loaded.items():
+                _snapshot_cache[(store.path, user_id)] = (missing[user_id], snapshot)
+                _snapshot_cache.move_to_end((store.path, user_id))
+            while len(_snapshot_cache) > COHORT_CACHE_MAX_ENTRIES:
+                _snapshot_cache.popitem(last=False)
+
+    return rows
+
+
+def category_column(values, codes):
+    return pd.Categorical.from_codes(values.cat.codes.to_numpy()[codes], categories=values.cat.categories)
+
+
+def load_cohort_frame(class_id, user_ids=None, store=attempt_store):
+    students = store.latest_ids(class_id, user_ids)
+
+    # Topics repeat across students, so rows carry integer codes into this lookup
+    topic_codes = {}
+    row_counts, topic_column, difficulty_column, completion_column, score_column = [], [], [], [], []
+
+    rows = snapshot_rows(store, students)
+
+    for user_id in students:
+        topics, difficulties, completion, score = rows[user_id]
+
+        row_counts.append(len(topics))
+        topic_column.extend([topic_codes.setdefault(topic, len(topic_codes)) for topic in topics])
+        difficulty_column.extend(difficulties)
+        completion_column.extend(completion)
+        score_column.extend(score)
+
+    keys = pd.DataFrame(list(topic_codes), columns=["subject", "section", "topic"], dtype="category")
+    codes = np.asarray(topic_column, dtype=np.int64)
+
+    frame = pd.DataFrame({
+        "user": pd.Categorical.from_codes(np.repeat(np.arange(len(students)), row_counts), categories=list(students)),
+        "subject": category_column(keys["subject"], codes),
+        "section": category_column(keys["section"], codes),
+        "topic": category_column(keys["topic"], codes),
+        "difficulty": pd.Categorical.from_codes(difficulty_column, categories=DIFFICULTIES, ordered=True),
+        "completion": np.asarray(completion_column, dtype=np.float64),
+        "score": np.asarray(score_column, dtype=np.float64),
+    })
+
+    # Saved snapshots store "No Attempt" as 0, so a score only counts where something was completed
+    frame["score"] = frame["score"].where(frame["completion"] > 0)
+    frame["progress"] = frame["score"].fillna(0) * frame["completion"] / 100
+
+    return frame
+
+
+def topic_summary(frame):
+    grouped = frame.groupby(["subject", "section", "topic", "difficulty"], observed=True)
+
+    summary = grouped.agg(
+        students=("user", "size"),
+        attempted=("score", "count"),
+        mean_completion=("completion", "mean"),
+        mean_score=("score", "mean"),
+        median_score=("score", "median"),
+        mean_progress=("progress", "mean")
+    ).reset_index()
+
+    return summary
+
+
+def distributions(frame):
+    # Histogram of completion and score in 10 point bins, per subject and difficulty
+    bins = pd.cut(frame["completion"], BINS, include_lowest=True, labels=False)
+    completion = frame.assign(bin=bins).groupby(["subject", "difficulty", "bin"], observed=True).size()
+
+    attempted = frame[frame["score"].notna()]
+    bins = pd.cut(attempted["score"], BINS, include_lowest=True, labels=False)
+    score = attempted.assign(bin=bins).groupby(["subject", "difficulty", "bin"], observed=True).size()
+
+    result = {}
+    for name, counts in (("completion", completion), ("score", score)):
+        for (subject, difficulty, bin_index), count in counts.items():
+            histogram = result.setdefault(subject, {}).setdefault(difficulty, {}).setdefault(name, [0] * (len(BINS) - 1))
+            histogram[int(bin_index)] = int(count)
+
+    return result
+
+
+def weakest_topics(frame, limit=10):
+    # Same measure as the heatmaps: average score weighted by completion, averaged over difficulty levels
+    per_topic = frame.groupby(["subject", "section", "topic"], observed=True).agg(
+        mean_progress=("progress", "mean"),
+        mean_completion=("completion", "mean"),
+        mean_score=("score", "mean"),
+        students=("user", "nunique")
+    )
+
+    return per_topic.nsmallest(limit, "mean_progress").reset_index()
+
+
+def records(frame):
+    # NaN is not valid JSON, missing values are reported as null
+    return frame.astype(object).where(frame.notna(), None).to_dict(orient="records")
+
+
+def cohort_report(class_id, user_ids=None, limit=10, store=attempt_store):
+    frame = load_cohort_frame(class_id, user_ids, store)
+
+    if frame.empty:
+        return None
+
+    return {
+        "students": int(frame["user"].nunique()),
+        "topics": records(topic_summary(frame)),
+        "distributions": {
+            "bins": BINS.tolist(),
+            "subjects": distributions(frame)
+        },
+        "weakest_topics": records(weakest_topics(frame, limit))
+    }
@@ -1,30 +1,79 @@
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from progress_model import *
+import contextvars
+import asyncio
+from upstream_cache import upstream_cache
+from attempt_store import attempt_writer
 import json
 import os
 
+
+# Dedicated pool for blocking upstream calls, so they don't queue behind the small default executor
+fetch_executor = ThreadPoolExecutor(max_workers=int(os.getenv('UPSTREAM_FETCH_WORKERS', 64)),
+                                    thread_name_prefix='upstream-fetch')
+
+
+def student_endpoints(student_id, classroom_id):
+    overall_performance = f"enter the API endpoint for student's Overall Performance"
+    topic_completion = f"enter the API for student's topicwise completion"
+    scores_obtained = f"enter the API endpoint for student's topicwise score"
+
+    return overall_performance, topic_completion, scores_obtained
+
+
+def request_header():
+    return {
+        "Authorization": f"Bearer {os.getenv('API_AUTH')}",
+        "Content-Type": "application/json"
+    }
+
+
+def fetch_json(url, header, timeout=None):
+    # Through the upstream cache: fresh payloads are reused, older ones revalidated with a conditional GET
+    return upstream_cache.get_json(url, header, timeout)
+
+
+def fetch_student_payloads(student_id, classroom_id):
+    header = request_header()
+    return [fetch_json(url, header) for url in student_endpoints(student_id, classroom_id)]
+
+
+async def fetch_student_payloads_async(student_id, classroom_id):
+    # The three upstream calls are independent, so issue them together instead of one after another
+    loop = asyncio.get_running_loop()
+    header = request_header()
+    # Run in a copy of the current context, so the upstream call logs carry the request's log fields
+    return await asyncio.gather(
+        *[loop.run_in_executor(fetch_executor, partial(contextvars.copy_context().run, fetch_json, url, header))
+          for url in student_endpoints(student_id, classroom_id)]
+    )
+
+
+def difficulty_level(test_name):
+    if "easy" in test_name:
+        return "easy"
+    elif "medium" in test_name:
+        return "medium"
+    else:
+        return "hard"
+
+
 ### Processing Completion Topics and Count ###
 class FetchStudentData:
 
 
-    def __init__(self, student_id, classroom_id):
-        header = {
-                    "Authorization": f"Bearer {os.getenv('API_AUTH')}",
-                    "Content-Type": "application/json"
-                }
+    def __init__(self, student_id, classroom_id, payloads=None):
+        if payloads is None:
+            payloads = fetch_student_payloads(student_id, classroom_id)
 
-        overall_performance = f"enter the API endpoint for student's Overall Performance"
-        topic_completion = f"enter the API for student's topicwise completion"
-        scores_obtained = f"enter the API endpoint for student's topicwise score"
-
-        self.overall_data = requests.get(overall_performance, headers=header).json()
-        self.completion_data = requests.get(topic_completion, headers=header).json()
-        self.scores_data = requests.get(scores_obtained, headers=header).json()
+        self.overall_data, self.completion_data, self.scores_data = payloads
 
         self.completion = {}
         self.unattempted_tests = {}
         self.attempted_tests = {}
         self.score = {}
-        self.progress = {}
+        self.progress = StudentProgress()
         self.attempted_keys = ["attemptedPractices", "attemptedTests"]
         self.unattempted_keys = ["unAttemptedPractices", "unAttemptedTests"]
 
@@ -47,23 +96,16 @@ class FetchStudentData:
         total_count = {"easy": 0, "medium": 0,"hard": 0}
         att_count = {"easy": 0, "medium": 0,"hard": 0}
 
+        attempted_set = set(attempted[data['name']])
 
         for t in attempted[data['name']]+unattempted[data['name']]:
-            if "easy" in t:
-                total_count["easy"] += 1
-                if t in attempted[data['name']]:
-                    att_count["easy"] += 1
-            elif "medium" in t:
-                total_count["medium"] += 1
-                if t in attempted[data['name']]:
-                    att_count["medium"] += 1
-            else:
-                total_count["hard"] += 1
-                if t in attempted[data['name']]:
-                    att_count["hard"] += 1
+            level = difficulty_level(t)
+            total_count[level] += 1
+            if t in attempted_set:
+                att_count[level] += 1
 
         def safe_div(num, den):
-            return f'{(num/den)*100: .0f}%' if den > 0 else "0%"
+            return (num/den)*100 if den > 0 else NO_ATTEMPT
 
         self.completion[data['name']] = {
             "Easy": safe_div(att_count['easy'], total_count['easy']),
@@ -80,128 +122,104 @@ class FetchStudentData:
         test = data["latestPracticesDone"] + data["latestTestsDone"]
 
         for item in test:
-            self.score[name].update({item['name']: f"{(item['obtainedPoints']/item['totalPoints'])*100: .0f}%"})
+            # Scores are reported as whole percentages, and topic averages are taken over the rounded values
+            self.score[name].update({item['name']: round((item['obtainedPoints']/item['totalPoints'])*100)})
 
 
     def compile_overall_progress(self):
-        self.progress.setdefault("overall_progress", {})
+        metrics = self.progress.overall.metrics
         for k, v in self.overall_data.items():
             if k == "timeSpentPractice":
-                self.progress["overall_progress"]["Total Time Spent on Practice Questions"] = f"{v / 60: .0f} Mins"
+                metrics["Total Time Spent on Practice Questions"] = OverallMetric(v / 60, "Mins")
 
             elif k == "timeSpentTest":
-                self.progress["overall_progress"]["Total Time Spent on Tests"] = f"{v / 60: .0f} Mins"
+                metrics["Total Time Spent on Tests"] = OverallMetric(v / 60, "Mins")
 
             elif k == "totalQ_AnsweredOfPractices":
-                self.progress["overall_progress"]["Total Practice Questions Attempted"] = v
+                metrics["Total Practice Questions Attempted"] = OverallMetric(v)
 
             elif k == "totalCorrectAnsweredOfPractices":
-                self.progress["overall_progress"]["Correctly Answered Practice Questions"] = v
+                metrics["Correctly Answered Practice Questions"] = OverallMetric(v)
 
             elif k == "totalQ_AnsweredOfTests":
-                self.progress["overall_progress"]["Total Test Questions Attempted"] = v
+                metrics["Total Test Questions Attempted"] = OverallMetric(v)
 
             elif k == "totalCorrectAnsweredOfTests":
-                self.progress["overall_progress"]["Correctly Answered Practice Questions"] = v
+                metrics["Correctly Answered Practice Questions"] = OverallMetric(v)
 
             elif k == "percentageCourseWork":
-                self.progress["overall_progress"]["Percentage of Coursework Completed"] = f"{v: .0f}%"
-
+                metrics["Percentage of Coursework Completed"] = OverallMetric(v, "%")
 
-    def calculate_score_by_difficulty(self, difficulty, data):
 
-        obtained = sum([int(v.strip().replace("%", "")) for k, v in
-                        self.progress[data['courseName']][data['subjectName']][data['sectionName']][data['name']][
-                            "details"].items() if difficulty.lower() in k and v != 'No Attempt'])
-        total = len([int(v.strip().replace("%", "")) for k, v in
-                     self.progress[data['courseName']][data['subjectName']][data['sectionName']][data['name']][
-                         "details"].items() if difficulty.lower() in k and v != 'No Attempt'])
+    def calculate_scores_by_difficulty(self, name, unattempted):
+        obtained = {"easy": 0, "medium": 0, "hard": 0}
+        total = {"easy": 0, "medium": 0, "hard": 0}
 
-        if total == 0:
-            return "No Attempt"
+        # Tests listed as unattempted count as "No Attempt", so they don't count towards the average
+        for t, v in self.score[name].items():
+            if t in unattempted:
+                continue
+            for level in obtained:
+                if level in t:
+                    obtained[level] += v
+                    total[level] += 1
 
-        else:
-            perc = obtained / total
-            return f"{perc: .0f}%"
+        return {level: obtained[level] / total[level] if total[level] else NO_ATTEMPT for level in obtained}
 
 
     def compile_all_data(self, data):
 
-        self.progress.setdefault(data['courseName'], {}).setdefault(data['subjectName'], {}).setdefault(data['sectionName'], {})
+        subject = self.progress.courses.setdefault(data['courseName'], {}).setdefault(data['subjectName'], SubjectProgress())
+        section = subject.sections.setdefault(data['sectionName'], {})
+
+        scores = {f"{k} Score": v for k, v in self.score[data['name']].items()} | \
+                 {f"{t} Score": NO_ATTEMPT for t in self.unattempted_tests[data['name']]}
 
         if 'test' not in data['name'].lower():
-            self.progress[data['courseName']][data['subjectName']][data['sectionName']].update(
-                {data['name']: {"details": {f"{k} Score": v for k, v in self.score[data['name']].items()} |
-                                              {f"{t} Score": "No Attempt" for t in self.unattempted_tests[data['name']]}}}
-            )
+            averages = self.calculate_scores_by_difficulty(data['name'], set(self.unattempted_tests[data['name']]))
 
-            self.progress[data['courseName']][data['subjectName']][data['sectionName']][data['name']]['summary'] =  \
-                                 {k1: {"Avg Score for Attempted Tests": self.calculate_score_by_difficulty(k1, data)} | {"Completion": v1} for k1, v1 in self.completion[data['name']].items()}
+            section[data['name']] = TopicProgress(scores, {
+                k1: DifficultyProgress(averages[k1.lower()], v1) for k1, v1 in self.completion[data['name']].items()
+            })
         else:
-            self.progress[data['courseName']][data['subjectName']][data['sectionName']].update(
-                {data['name']: {"summary": {f"{k} Score": v for k, v in self.score[data['name']].items()} |
-                                              {f"{t} Score": "No Attempt" for t in self.unattempted_tests[data['name']]}}}
-            )
+            section[data['name']] = TopicProgress(scores)
 
 
     def master_loop(self):
-        sorted_completion_data = sorted(self.completion_data['topics'], key=lambda x: x['name'])
-        self.compile_attempt_dicts(sorted_completion_data)
+        self.compile_attempt_dicts(self.completion_data['topics'])
+
+        # Overall progress only depends on overall_data, so it is compiled once rather than per topic
+        self.compile_overall_progress()
 
         sorted_score_data = sorted(self.scores_data['topics'], key=lambda x: x['name'])
-        for i, data in enumerate(sorted_score_data):
+        for data in sorted_score_data:
             self.compile_progress(data, self.attempted_tests, self.unattempted_tests)
             self.compile_scores(data)
-            self.compile_overall_progress()
             self.compile_all_data(data)
 
         return self.progress
 
 
-def clean_percentage_values(data):
-    if isinstance(data, dict):
-        return {k: clean_percentage_values(v) for k, v in data.items()}
-    elif isinstance(data, list):
-        return [clean_percentage_values(element) for element in data]
-    elif isinstance(data, str):
-        if '%' in data:
-            try:
-                return float(data.replace('%', '').strip())
-            except ValueError:
-                return data
-        elif "No Attempt" in data:
-            try:
-                return int(data.replace('No Attempt', '0').strip())
-            except ValueError:
-                return data
-        else:
-            return data
-    else:
-        return data
-
 def data_segregation(data):
-    overall, course = list(data.keys())
-    subjects = list(data[course].keys())
+    course, = list(data.courses.keys())
+    subjects = list(data.courses[course].keys())
 
-    segregated = {overall: data[overall], **{subject: data[course][subject] for subject in subjects}}
+    segregated = {'overall_progress': data.overall, **{subject: data.courses[course][subject] for subject in subjects}}
 
     return segregated
 
 
-def save_json(user_id, class_id, data, report):
+def save_attempt(user_id, class_id, data, report):
+    # Heatmaps are still files, the progress snapshot and the report are added to the attempt history in the
+    # background
     os.makedirs(os.path.dirname(f"Data/saved_progress_report/{user_id}-{class_id}/previous/heatmaps/"), exist_ok=True)
 
-    with open(f"Data/saved_progress_report/{user_id}-{class_id}/previous/report.json", "w") as fp:
-        json.dump(report, fp)
+    attempt_writer.submit(user_id, class_id, {k: v.stored() for k, v in data.items()}, report)
 
     variable_names = []
     variable_values = []
 
     for k, v in data.items():
-        str_to_float_data = clean_percentage_values(v)
-        with open(f"Data/saved_progress_report/{user_id}-{class_id}/previous/{k.upper()}.json", "w") as fp:
-            json.dump(str_to_float_data, fp)
-
         variable_names.append(k.upper())
         variable_values.append(v)
 
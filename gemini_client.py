@@ -0,0 +1,205 @@
+from sat_agent import agent_async, StudentProgressReport
+from metrics import metrics
+from dataclasses import dataclass
+from collections import deque
+import statistics
+import weakref
+import asyncio
+import logging
+import random
+import time
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# Retry, timeout and hedging settings, overridable through the environment
+MAX_ATTEMPTS = int(os.getenv('GEMINI_MAX_ATTEMPTS', 4))
+BACKOFF_BASE = float(os.getenv('GEMINI_BACKOFF_BASE', 1.0))
+BACKOFF_MAX = float(os.getenv('GEMINI_BACKOFF_MAX', 20.0))
+CALL_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', 120))
+HEDGE_ENABLED = os.getenv('GEMINI_HEDGE', '0') == '1'
+HEDGE_PERCENTILE = int(os.getenv('GEMINI_HEDGE_PERCENTILE', 95))
+HEDGE_DELAY = float(os.getenv('GEMINI_HEDGE_DELAY', 30))
+HEDGE_MIN_SAMPLES = int(os.getenv('GEMINI_HEDGE_MIN_SAMPLES', 20))
+
+CALL_SECONDS = metrics.histogram('gemini_call_seconds', "Time of each Gemini request (every retry and hedge is one)",
+                                 ['outcome'])
+
+# genai clients hold connection pools bound to the event loop they were used on, so they are shared per loop
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_client(api_key):
+    from google import genai
+
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+
+    if api_key not in clients:
+        clients[api_key] = genai.Client(api_key=api_key)
+
+    return clients[api_key]
+
+
+def retryable(error):
+    from google.genai import errors
+    import httpx
+
+    if isinstance(error, errors.ServerError):
+        return True
+    elif isinstance(error, errors.ClientError):
+        return error.code in (408, 429)
+    return isinstance(error, (asyncio.TimeoutError, httpx.TransportError))
+
+
+@dataclass(slots=True)
+class AgentResult:
+    response: object
+    attempts: int = 0
+    retries: int = 0
+    hedges: int = 0
+    seconds: float = 0.0
+
+    def meta_data(self):
+        return {
+            'attempts': self.attempts,
+            'retries': self.retries,
+            'hedges': self.hedges,
+            'seconds': round(self.seconds, 3)
+        }
+
+
+class GeminiAgent:
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX,
+                 timeout=CALL_TIMEOUT, hedge=HEDGE_ENABLED, hedge_percentile=HEDGE_PERCENTILE,
+                 hedge_delay=HEDGE_DELAY, client_factory=get_client):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.hedge = hedge
+        # statistics.quantiles(n=100) has 99 cut points, so 100 (or 0) would index past them
+        self.hedge_percentile = min(max(hedge_percentile, 1), 99)
+        self.default_hedge_delay = hedge_delay
+        self.client_factory = client_factory
+        self.latencies = deque(maxlen=500)
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+
+
+    def backoff(self, retry):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry))
+
+
+    def hedge_delay(self):
+        # Fire the hedge once the first call is slower than this percentile of recent calls
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return self.default_hedge_delay
+        return max(statistics.quantiles(self.latencies, n=100)[self.hedge_percentile - 1], 0.0)
+
+
+    async def call(self, client, result, args, schema):
+        result.attempts += 1
+        self.calls += 1
+        start = time.perf_counter()
+
+        try:
+            response = await asyncio.wait_for(agent_async(*args, client=client, response_schema=schema),
+                                              self.timeout)
+        except asyncio.CancelledError:
+            # The losing side of a hedge
+            CALL_SECONDS.observe(time.perf_counter() - start, 'cancelled')
+            raise
+        except Exception:
+            CALL_SECONDS.observe(time.perf_counter() - start, 'error')
+            raise
+
+        CALL_SECONDS.observe(time.perf_counter() - start, 'parsed' if response.parsed is not None else 'unparsed')
+        if response.parsed is not None:
+            self.latencies.append(time.perf_counter() - start)
+
+        return response
+
+
+    async def hedged_call(self, client, result, args, schema):
+        # The first parsed response wins, the other request is cancelled
+        tasks = {asyncio.create_task(self.call(client, result, args, schema))}
+        started = list(tasks)
+        response = None
+        error = None
+
+        # The hedge wait is inside the try too, a caller cancelled while waiting cancels the request with it
+        try:
+            if self.hedge:
+                done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay())
+                if not done:
+                    result.hedges += 1
+                    self.hedges += 1
+                    tasks.add(asyncio.create_task(self.call(client, result, args, schema)))
+                    started.extend(tasks - set(started))
+
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif task.result().parsed is not None:
+                        return task.result()
+                    else:
+                        response = task.result()
+        finally:
+            # Requests still running are cancelled. Ones that finished alongside the winner have their error
+            # retrieved, so it is never logged as "Task exception was never retrieved"
+            for task in started:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()
+
+        if response is None:
+            raise error
+
+        return response
+
+
+    async def generate(self, user_prompt, system_prompt, model, api, thinking_tokens, temperature, output_tokens,
+                       schema=StudentProgressReport):
+        client = self.client_factory(api)
+        result = AgentResult(None)
+        start = time.perf_counter()
+        args = (user_prompt, system_prompt, model, api, thinking_tokens, temperature, output_tokens)
+
+        for attempt in range(self.max_attempts):
+            try:
+                result.response = await self.hedged_call(client, result, args, schema)
+                if result.response.parsed is not None:
+                    break
+                logger.error(f"[FAIL] LLM Response is not parsed, attempt {attempt + 1} of {self.max_attempts}")
+            except Exception as e:
+                if not retryable(e) or attempt + 1 == self.max_attempts:
+                    raise
+                logger.warning(f"[FAIL] LLM call failed, attempt {attempt + 1} of {self.max_attempts}: {e}")
+
+            if attempt + 1 < self.max_attempts:
+                result.retries += 1
+                self.retries += 1
+                await asyncio.sleep(self.backoff(attempt))
+
+        result.seconds = time.perf_counter() - start
+
+        return result
+
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'retries': self.retries,
+            'hedges': self.hedges,
+            'hedge_delay': round(self.hedge_delay(), 3)
+        }
+
+
+gemini_agent = GeminiAgent()
@@ -1,60 +1,48 @@
 import pandas as pd
 import seaborn as sns
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.colors import LinearSegmentedColormap
+from matplotlib.figure import Figure
+from heatmaps import flatten_data, write_image, BLUE_SHADES
 import json
+import io
 
-def flatten_data(data: dict) -> dict:
-    flat_dict = {}
-
-    for k,v in data.items():
-        if k != "Full Length Exams - Section Wise":
-            for k1, v1 in v.items():
-                for k2, v2 in v1.items():
-                    if k2 == 'summary':
-                        for k3, v3 in v2.items():
-                            if k1 in flat_dict.keys():
-                                flat_dict[k1].update(
-                                    {k3: v3['Avg Score for Attempted Tests'] * (v3['Completion'] / 100)})
-                            else:
-                                flat_dict[k1] = {
-                                    k3: v3['Avg Score for Attempted Tests'] * (v3['Completion'] / 100)}
-    return flat_dict
-
-
-def generate_df(file_path):
+def generate_heatmap(file_path, output_path, title: str, size):
+    # A subject heatmap from its saved JSON, rendered as PNG by render_heatmap
     with open(file_path, 'r') as f:
         data = json.load(f)
 
-    flat_dict = flatten_data(data)
-
-    df = pd.DataFrame.from_dict(flat_dict, orient='index')
+    render_heatmap(data, title, size, output_path)
 
-    return df
+    return "Heatmap Saved"
 
 
-def generate_heatmap(file_path, output_path, title: str, size):
-    colors = ['#0C203B', '#2D72D2', '#EAF1FB']
-
+def render_heatmap(data: dict, title: str, size, output_path=None) -> bytes:
+    # Drawn on its own Figure and Agg canvas instead of pyplot's global state, so renders can run side by side
+    # in threads or processes. data is a subject in its stored form
     custom_cmap = LinearSegmentedColormap.from_list(
         'Blue Shades',
-        colors,
+        BLUE_SHADES,
         N=256
     )
 
-    plt.figure(figsize=size)
-    plt.title(title,
-              fontsize=20,
-              pad=23,
-              )
+    figure = Figure(figsize=size)
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+
+    ax.set_title(title,
+                 fontsize=20,
+                 pad=23,
+                 )
 
-    ax = sns.heatmap(generate_df(file_path),
-                     vmin=0.0,
-                     vmax=100.0,
-                     cmap=custom_cmap,
-                     annot=True,
-                     fmt='.1f',
-                     cbar_kws={'label': 'Progress (%)'})
+    sns.heatmap(pd.DataFrame.from_dict(flatten_data(data), orient='index'),
+                vmin=0.0,
+                vmax=100.0,
+                cmap=custom_cmap,
+                annot=True,
+                fmt='.1f',
+                cbar_kws={'label': 'Progress (%)'},
+                ax=ax)
 
     ax.set(xlabel="Difficulty Level", ylabel="Topics")
 
@@ -70,9 +58,13 @@ def generate_heatmap(file_path, output_path, title: str, size):
     ax.yaxis.label.set_size(16)
     ax.yaxis.labelpad = 10
 
-    plt.savefig(output_path,
-                bbox_inches='tight')
+    buffer = io.BytesIO()
+    figure.savefig(buffer,
+                   format='png',
+                   bbox_inches='tight')
+    image = buffer.getvalue()
 
-    plt.close()
+    if output_path is not None:
+        write_image(output_path, image)
 
-    return "Heatmap Saved"
\ No newline at end of file
+    return image
@@ -0,0 +1,269 @@
+from report_cache import cache_key
+from xml.sax.saxutils import escape
+from collections import OrderedDict
+import threading
+import hashlib
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# Heatmap settings, overridable through the environment. HEATMAP_FORMAT=svg skips matplotlib entirely
+HEATMAP_FORMAT = os.getenv('HEATMAP_FORMAT', 'png')
+HEATMAP_CACHE_DIR = os.getenv('HEATMAP_CACHE_DIR', 'Data/heatmap_cache')
+HEATMAP_CACHE_MAX_ENTRIES = int(os.getenv('HEATMAP_CACHE_MAX_ENTRIES', 4096))
+
+# The 'Blue Shades' colormap used by every heatmap, from no progress to full progress
+BLUE_SHADES = ['#0C203B', '#2D72D2', '#EAF1FB']
+
+
+def flatten_data(data: dict) -> dict:
+    flat_dict = {}
+
+    for k,v in data.items():
+        if k != "Full Length Exams - Section Wise":
+            for k1, v1 in v.items():
+                for k2, v2 in v1.items():
+                    if k2 == 'summary':
+                        for k3, v3 in v2.items():
+                            if k1 in flat_dict.keys():
+                                flat_dict[k1].update(
+                                    {k3: v3['Avg Score for Attempted Tests'] * (v3['Completion'] / 100)})
+                            else:
+                                flat_dict[k1] = {
+                                    k3: v3['Avg Score for Attempted Tests'] * (v3['Completion'] / 100)}
+    return flat_dict
+
+
+def write_image(output_path, image):
+    # Written to a temp file first, so the image route never serves half an image
+    temp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as fp:
+        fp.write(image)
+    os.replace(temp_path, output_path)
+
+
+def read_image(path):
+    with open(path, 'rb') as fp:
+        return fp.read(), os.fstat(fp.fileno()).st_mtime
+
+
+def image_version(image):
+    # Content hash used in heatmap URLs and as their ETag
+    return hashlib.sha256(image).hexdigest()[:16]
+
+
+def hex_color(color):
+    return tuple(int(color[i:i + 2], 16) for i in (1, 3, 5))
+
+
+def shade(value):
+    # Same 256 step linear blend as LinearSegmentedColormap.from_list over BLUE_SHADES
+    step = min(max(int(value / 100 * 256), 0), 255) / 255
+    position = step * (len(BLUE_SHADES) - 1)
+    index = min(int(position), len(BLUE_SHADES) - 2)
+    start, end = hex_color(BLUE_SHADES[index]), hex_color(BLUE_SHADES[index + 1])
+    fraction = position - index
+
+    return tuple(round(a + (b - a) * fraction) for a, b in zip(start, end))
+
+
+def text_color(rgb):
+    # seaborn's rule for annotations: dark text on light cells, light text on dark cells
+    linear = [c / 255 / 12.92 if c / 255 <= 0.03928 else ((c / 255 + 0.055) / 1.055) ** 2.4 for c in rgb]
+    luminance = 0.2126 * linear[0] + 0.7152 * linear[1] + 0.0722 * linear[2]
+
+    return "#262626" if luminance > 0.408 else "#ffffff"
+
+
+def render_svg(flat: dict, title: str, size) -> bytes:
+    # A grid of annotated cells in the heatmap palette, without matplotlib. Not pixel-identical to the PNG
+    topics = list(flat)
+    levels = list(dict.fromkeys(level for values in flat.values() for level in values))
+
+    width, height = size[0] * 100, size[1] * 100
+    label_width = max([len(topic) for topic in topics] + [0]) * 6 + 10
+    left, top = 40 + label_width, 110
+    grid_width, grid_height = width * 0.6, height * 0.77
+    cell_width = grid_width / max(len(levels), 1)
+    cell_height = grid_height / max(len(topics), 1)
+    bar_left = left + grid_width + 20
+    total_width, total_height = bar_left + 80, top + grid_height + 20
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{total_width:.0f}" height="{total_height:.0f}" '
+        f'viewBox="0 0 {total_width:.0f} {total_height:.0f}" font-family="DejaVu Sans, Arial, sans-serif">',
+        f'<rect width="100%" height="100%" fill="#ffffff"/>',
+        f'<text x="{left + grid_width / 2:.1f}" y="30" font-size="20" text-anchor="middle">{escape(title)}</text>',
+        f'<text x="{left + grid_width / 2:.1f}" y="65" font-size="16" text-anchor="middle">Difficulty Level</text>',
+        f'<text transform="translate(16 {top + grid_height / 2:.1f}) rotate(-90)" font-size="16" '
+        f'text-anchor="middle">Topics</text>'
+    ]
+
+    for column, level in enumerate(levels):
+        parts.append(f'<text x="{left + (column + 0.5) * cell_width:.1f}" y="{top - 10}" font-size="12" '
+                     f'text-anchor="middle">{escape(str(level))}</text>')
+
+    for row, topic in enumerate(topics):
+        y = top + row * cell_height
+        parts.append(f'<text x="{left - 6}" y="{y + cell_height / 2:.1f}" font-size="10" text-anchor="end" '
+                     f'dominant-baseline="middle">{escape(str(topic))}</text>')
+
+        for column, level in enumerate(levels):
+            value = flat[topic].get(level)
+            # Missing cells stay blank, like NaN in the seaborn heatmap
+            if value is None or value != value:
+                continue
+            rgb = shade(value)
+            x = left + column * cell_width
+            parts.append(f'<rect x="{x:.1f}" y="{y:.1f}" width="{cell_width:.1f}" height="{cell_height:.1f}" '
+                         f'fill="rgb{rgb}"/>')
+            parts.append(f'<text x="{x + cell_width / 2:.1f}" y="{y + cell_height / 2:.1f}" font-size="10" '
+                         f'text-anchor="middle" dominant-baseline="middle" fill="{text_color(rgb)}">{value:.1f}</text>')
+
+    # Colorbar, 0 at the bottom
+    parts.append('<defs><linearGradient id="bar" x1="0" y1="1" x2="0" y2="0">' +
+                 "".join(f'<stop offset="{i / (len(BLUE_SHADES) - 1):.2f}" stop-color="{color}"/>'
+                         for i, color in enumerate(BLUE_SHADES)) +
+                 '</linearGradient></defs>')
+    parts.append(f'<rect x="{bar_left:.1f}" y="{top}" width="20" height="{grid_height:.1f}" fill="url(#bar)"/>')
+
+    for tick in range(0, 101, 20):
+        y = top + grid_height * (1 - tick / 100)
+        parts.append(f'<text x="{bar_left + 26:.1f}" y="{y:.1f}" font-size="10" dominant-baseline="middle">{tick}</text>')
+
+    parts.append(f'<text transform="translate({bar_left + 66:.1f} {top + grid_height / 2:.1f}) rotate(-90)" '
+                 f'font-size="12" text-anchor="middle">Progress (%)</text>')
+    parts.append('</svg>')
+
+    return "\n".join(parts).encode()
+
+
+class HeatmapCache:
+    # Rendered images on disk, keyed by the numbers actually drawn, so a report whose per-topic progress is
+    # unchanged (or matches another student's) never renders again. Looked up and filled by the app's process only
+    # (renders in the process pool return their image to it), so hits, misses and the eviction order are all here
+
+    def __init__(self, directory=HEATMAP_CACHE_DIR, max_entries=HEATMAP_CACHE_MAX_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        # Cached keys, least recently used first, listed from the directory on first use
+        self.files = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.enabled():
+            os.makedirs(self.directory, exist_ok=True)
+
+
+    def enabled(self):
+        return bool(self.directory) and self.max_entries > 0
+
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+
+    def load_files(self):
+        # Oldest first by modification time, hits touch their file so the order survives a restart. Called with the
+        # lock held
+        if self.files is None:
+            files = [f for f in os.scandir(self.directory) if not f.name.endswith(".tmp")]
+            self.files = OrderedDict((f.name, None) for f in sorted(files, key=lambda f: f.stat().st_mtime))
+
+
+    def get(self, key):
+        if not self.enabled():
+            return None
+
+        try:
+            with open(self.path(key), 'rb') as fp:
+                image = fp.read()
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.load_files()
+            self.files[key] = None
+            self.files.move_to_end(key)
+            self.hits += 1
+
+        return image
+
+
+    def set(self, key, image):
+        if not self.enabled():
+            return
+
+        write_image(self.path(key), image)
+
+        evicted = []
+        with self.lock:
+            self.load_files()
+            self.files[key] = None
+            self.files.move_to_end(key)
+            while len(self.files) > self.max_entries:
+                evicted.append(self.files.popitem(last=False)[0])
+            self.evictions += len(evicted)
+
+        for old in evicted:
+            try:
+                os.remove(self.path(old))
+            except FileNotFoundError:
+                pass
+
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+heatmap_cache = HeatmapCache()
+
+
+def heatmap_key(data: dict, title: str, size, format=HEATMAP_FORMAT) -> str:
+    # The flattened numbers, their order, the title, the size and the format
+    flat = flatten_data(data)
+    return cache_key([[topic, list(values.items())] for topic, values in flat.items()], title, list(size), format)
+
+
+def render(data: dict, title: str, size, format=HEATMAP_FORMAT) -> bytes:
+    # Uncached, in whichever thread or process runs it. PNG is identical to generate_heatmap
+    if format == 'svg':
+        return render_svg(flatten_data(data), title, size)
+
+    # Imported here, so SVG deployments never load matplotlib or seaborn
+    from generate_heatmaps import render_heatmap
+    return render_heatmap(data, title, size)
+
+
+def cached_heatmap(data: dict, title: str, size, format=HEATMAP_FORMAT):
+    # The cache key and the cached image, None on a miss
+    key = heatmap_key(data, title, size, format)
+    return key, heatmap_cache.get(key)
+
+
+def save_heatmap(key, image, output_path=None, rendered=True):
+    # A rendered image goes into the cache, and the image to output_path
+    if rendered:
+        heatmap_cache.set(key, image)
+
+    if output_path is not None:
+        write_image(output_path, image)
+
+
+def heatmap(data: dict, title: str, size, output_path=None, format=HEATMAP_FORMAT) -> bytes:
+    # A subject heatmap as PNG or SVG, reused from the cache when its key is unchanged
+    key, image = cached_heatmap(data, title, size, format)
+    rendered = image is None
+
+    if rendered:
+        image = render(data, title, size, format)
+    save_heatmap(key, image, output_path, rendered)
+
+    return image
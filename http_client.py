@@ -0,0 +1,109 @@
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+import threading
+import requests
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# Upstream client settings, overridable through the environment
+CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.getenv('UPSTREAM_READ_TIMEOUT', 15))
+MAX_RETRIES = int(os.getenv('UPSTREAM_MAX_RETRIES', 3))
+BACKOFF_FACTOR = float(os.getenv('UPSTREAM_BACKOFF_FACTOR', 0.3))
+BACKOFF_JITTER = float(os.getenv('UPSTREAM_BACKOFF_JITTER', 0.5))
+POOL_CONNECTIONS = int(os.getenv('UPSTREAM_POOL_CONNECTIONS', 10))
+POOL_MAXSIZE = int(os.getenv('UPSTREAM_POOL_MAXSIZE', 64))
+
+_session = None
+_session_lock = threading.Lock()
+
+# Connection counters for the calling thread, so concurrent requests don't mix their stats
+_stats = threading.local()
+
+
+class CountingPoolMixin:
+
+    def _new_conn(self):
+        _stats.new_connections = getattr(_stats, 'new_connections', 0) + 1
+        return super()._new_conn()
+
+    def _make_request(self, *args, **kwargs):
+        _stats.requests = getattr(_stats, 'requests', 0) + 1
+        return super()._make_request(*args, **kwargs)
+
+
+class CountingHTTPConnectionPool(CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class PooledAdapter(HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool
+        }
+
+
+def build_session():
+    # Only idempotent GETs are retried; backoff grows exponentially with a random jitter on top
+    retry = Retry(
+        total=MAX_RETRIES,
+        allowed_methods=frozenset(['GET']),
+        status_forcelist=(429, 500, 502, 503, 504),
+        backoff_factor=BACKOFF_FACTOR,
+        backoff_jitter=BACKOFF_JITTER,
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+
+    adapter = PooledAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        pool_block=True,
+        max_retries=retry
+    )
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def get_session():
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = build_session()
+
+    return _session
+
+
+def get(url, headers, timeout=None):
+    _stats.new_connections = 0
+    _stats.requests = 0
+
+    response = get_session().get(url, headers=headers, timeout=timeout or (CONNECT_TIMEOUT, READ_TIMEOUT))
+
+    attempts = _stats.requests
+    new_connections = _stats.new_connections
+    status = "[OK]" if response.ok else "[FAIL]"
+    logger.info(f"{status} GET {url} status={response.status_code} attempts={attempts} "
+                f"new_connections={new_connections} reused_connections={max(attempts - new_connections, 0)} "
+                f"elapsed={response.elapsed.total_seconds():.3f}s")
+
+    response.raise_for_status()
+
+    return response
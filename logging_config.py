@@ -0,0 +1,130 @@
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from contextlib import contextmanager
+import contextvars
+import logging
+import atexit
+import queue
+import json
+import os
+
+
+# Logging settings, overridable through the environment
+LOG_FILE = os.getenv('LOG_FILE', 'Data/logs/logger.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+# json for one JSON object per line in the log file, text for the previous format
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', 5))
+# Payloads (model responses, reports) are logged at INFO on the 'payloads' logger, so they are off by default
+LOG_PAYLOAD_LEVEL = os.getenv('LOG_PAYLOAD_LEVEL', 'WARNING')
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# Request fields added to every record logged while they are set
+CONTEXT_FIELDS = ('request_id', 'job_id', 'user_id', 'class_id')
+
+_context = contextvars.ContextVar('log_context', default={})
+_listener = None
+
+payload_logger = logging.getLogger('payloads')
+
+
+@contextmanager
+def log_context(**fields):
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        try:
+            _context.reset(token)
+        except ValueError:
+            # An async generator closed from another context, that context never saw the fields
+            pass
+
+
+def log_payload(message, payload):
+    # The payload is only turned into text if payloads are logged, and then by the listener thread
+    if payload_logger.isEnabledFor(logging.INFO):
+        payload_logger.info("%s %s", message, payload)
+
+
+class ContextFilter(logging.Filter):
+    # Runs in the thread that logs, where the request's context is still set
+
+    def filter(self, record):
+        record.__dict__.update(_context.get())
+        return True
+
+
+class DeferredQueueHandler(QueueHandler):
+    # QueueHandler formats the message before queueing it. Here only the traceback is rendered, while it still
+    # exists, and the message is built by the listener thread. Arguments must not be changed after logging them
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+
+def setup_logging():
+    # Handlers run on a background listener thread, the logging call only puts the record on a queue
+    global _listener
+    if _listener is not None:
+        return
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(TEXT_FORMAT))
+    handlers = [console]
+
+    if LOG_FILE:
+        if os.path.dirname(LOG_FILE):
+            os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+        # Rotated by size into logger.log.1 ... logger.log.<LOG_BACKUPS>
+        log_file = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+        log_file.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+        handlers.append(log_file)
+
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    payload_logger.setLevel(LOG_PAYLOAD_LEVEL)
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    # Writes out what is still queued
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,177 @@
+from contextlib import contextmanager
+import threading
+import time
+
+
+# Latency buckets in seconds, from a cache hit to a slow Gemini call
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def sample(name, labels, value):
+    # One line of the Prometheus text format. labels: list of (name, value)
+    label_text = ",".join(f'{k}="{escape(v)}"' for k, v in labels)
+    return f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}"
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+
+        return [sample(self.name, list(zip(self.labels, labels)), value) for labels, value in values.items()]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> per bucket counts, sum, count
+        self.values = {}
+        self.lock = threading.Lock()
+
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts, total, count = self.values.get(labels, ([0] * len(self.buckets), 0.0, 0))
+            counts = [n + (value <= bound) for n, bound in zip(counts, self.buckets)]
+            self.values[labels] = (counts, total + value, count + 1)
+
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+
+        lines = []
+        for labels, (counts, total, count) in values.items():
+            labels = list(zip(self.labels, labels))
+            lines.extend(sample(f"{self.name}_bucket", labels + [("le", bound)], n)
+                         for bound, n in zip(self.buckets, counts))
+            lines.append(sample(f"{self.name}_bucket", labels + [("le", "+Inf")], count))
+            lines.append(sample(f"{self.name}_sum", labels, round(total, 6)))
+            lines.append(sample(f"{self.name}_count", labels, count))
+
+        return lines
+
+
+class Stats:
+    # Exposes a stats() dictionary of an existing component at scrape time, so nothing is counted twice.
+    # Keys in counters are counters (named <prefix>_<key>_total), the rest are gauges, and a nested dictionary
+    # becomes one gauge labelled by its keys
+
+    def __init__(self, prefix, help, stats, counters=(), label='key'):
+        self.prefix = prefix
+        self.help = help
+        self.stats = stats
+        self.counters = counters
+        self.label = label
+
+
+    def render(self):
+        lines = []
+
+        for key, value in self.stats().items():
+            kind = 'counter' if key in self.counters else 'gauge'
+            name = f"{self.prefix}_{key}_total" if kind == 'counter' else f"{self.prefix}_{key}"
+            lines.append(f"# HELP {name} {self.help}, {key.replace('_', ' ')}")
+            lines.append(f"# TYPE {name} {kind}")
+            if isinstance(value, dict):
+                lines.extend(sample(name, [(self.label, k)], v) for k, v in value.items())
+            else:
+                lines.append(sample(name, [], value))
+
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+
+    def stats(self, prefix, help, stats, counters=(), label='key'):
+        self.metrics.append(Stats(prefix, help, stats, counters, label))
+
+
+    def render(self):
+        lines = []
+
+        for metric in self.metrics:
+            if isinstance(metric, Stats):
+                lines.extend(metric.render())
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Registry()
+
+
+class Timings:
+    # Durations of the stages of one report, for its meta_data, each also observed in a histogram labelled by stage
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = time.perf_counter()
+        self.stages = {}
+
+
+    @contextmanager
+    def span(self, stage, part=None):
+        # part splits a stage that runs more than once, e.g. one heatmap per subject
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.histogram.observe(seconds, stage)
+            if part is None:
+                self.stages[stage] = round(self.stages.get(stage, 0) + seconds, 4)
+            else:
+                self.stages.setdefault(stage, {})[part] = round(seconds, 4)
+
+
+    async def timed(self, stage, part, awaitable):
+        with self.span(stage, part):
+            return await awaitable
+
+
+    def meta_data(self):
+        return {**self.stages, 'total': round(time.perf_counter() - self.start, 4)}
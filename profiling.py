@@ -0,0 +1,235 @@
+from contextlib import contextmanager
+import contextvars
+import threading
+import cProfile
+import logging
+import pstats
+import hmac
+import json
+import time
+import uuid
+import io
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# Profiling settings, overridable through the environment. Profiling is off unless PROFILE_TOKEN is set, a request
+# is then profiled when it sends the token in the X-Profile header. Never in the query string, which access logs
+# record, and never without the token: a profiled report costs more than a plain one
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN')
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'Data/profiles')
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', 50))
+PROFILE_TTL = float(os.getenv('PROFILE_TTL', 7 * 24 * 3600))
+# Functions listed in a profile summary, by cumulative time
+PROFILE_TOP = int(os.getenv('PROFILE_TOP', 40))
+
+_profile = contextvars.ContextVar('request_profile', default=None)
+
+# Set while a thread runs under a profiler, a nested hook in the same thread only adds its wall time
+_active = threading.local()
+
+
+def profiling_enabled():
+    return bool(PROFILE_TOKEN)
+
+
+def authorized(token):
+    return profiling_enabled() and token is not None and hmac.compare_digest(token, PROFILE_TOKEN)
+
+
+class RequestProfile:
+    # The profile of one report. Work the request runs on threads (aggregation, prompts, trends, heatmaps) runs
+    # under cProfile in whichever thread picks it up, and the profiles are merged on save. The event loop is
+    # shared with other requests, so async steps (upstream fetch, Gemini calls) get their wall time instead
+
+    def __init__(self, user_id, class_id):
+        self.id = uuid.uuid4().hex[:16]
+        self.user_id = user_id
+        self.class_id = class_id
+        self.created = time.time()
+        self.start = time.perf_counter()
+        self.profilers = []
+        self.hooks = {}
+        self.stages = None
+        self.lock = threading.Lock()
+
+
+    @contextmanager
+    def activate(self):
+        token = _profile.set(self)
+        try:
+            yield self
+        finally:
+            _profile.reset(token)
+
+
+    def record(self, name, seconds, profiled=True):
+        with self.lock:
+            hook = self.hooks.setdefault(name, {'calls': 0, 'seconds': 0.0, 'unprofiled': 0})
+            hook['calls'] += 1
+            hook['seconds'] += seconds
+            hook['unprofiled'] += not profiled
+
+
+    def run(self, name, func, *args, **kwargs):
+        start = time.perf_counter()
+
+        if getattr(_active, 'profiling', False):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+
+        # Python 3.12+ allows one active profiler per process. While another thread or request holds it (the
+        # heatmaps render in parallel), the hook only gets its wall time, counted as unprofiled
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start, profiled=False)
+
+        _active.profiling = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            _active.profiling = False
+            self.record(name, time.perf_counter() - start)
+            with self.lock:
+                self.profilers.append(profiler)
+
+
+    async def timed(self, name, awaitable):
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+
+    def functions(self, stats):
+        # Top functions by cumulative time, summed over the threads
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP]
+
+        return [{
+            'function': f"{os.path.basename(file)}:{line}({name})",
+            'calls': calls,
+            'own_seconds': round(own, 6),
+            'cumulative_seconds': round(cumulative, 6)
+        } for (file, line, name), (_, calls, own, cumulative, _) in rows]
+
+
+    def save(self, status, directory=PROFILE_DIR):
+        # <id>.json is the summary served by /profiles, <id>.prof the merged cProfile data for pstats or snakeviz
+        os.makedirs(directory, exist_ok=True)
+
+        with self.lock:
+            profilers = list(self.profilers)
+            hooks = {name: {**hook, 'seconds': round(hook['seconds'], 4)} for name, hook in self.hooks.items()}
+
+        summary = {
+            'id': self.id,
+            'user_id': self.user_id,
+            'class_id': self.class_id,
+            'created': self.created,
+            'seconds': round(time.perf_counter() - self.start, 4),
+            'status': status,
+            'stages': self.stages,
+            'hooks': hooks,
+            'functions': []
+        }
+
+        if profilers:
+            stats = pstats.Stats(*profilers, stream=io.StringIO())
+            stats.dump_stats(os.path.join(directory, f"{self.id}.prof"))
+            summary['functions'] = self.functions(stats)
+
+        with open(os.path.join(directory, f"{self.id}.json"), "w") as fp:
+            json.dump(summary, fp, indent=2)
+
+        logger.info(f"[OK] Saved profile {self.id} for user={self.user_id}, class={self.class_id} "
+                    f"in {summary['seconds']}s")
+        prune_profiles(directory)
+
+        return summary
+
+
+def current_profile():
+    return _profile.get()
+
+
+class Profiled:
+    # A function that runs under the request's profile when the request is being profiled, and as is otherwise.
+    # Picklable when the function is, so it can still be sent to a process pool (where it is not profiled)
+
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+
+
+    def __call__(self, *args, **kwargs):
+        profile = _profile.get()
+        if profile is None:
+            return self.func(*args, **kwargs)
+
+        return profile.run(self.name, self.func, *args, **kwargs)
+
+
+async def profiled_async(name, awaitable):
+    profile = _profile.get()
+    if profile is None:
+        return await awaitable
+
+    return await profile.timed(name, awaitable)
+
+
+def prune_profiles(directory=PROFILE_DIR, max_files=PROFILE_MAX_FILES, ttl=PROFILE_TTL):
+    # Keeps the newest max_files profiles, none older than ttl
+    now = time.time()
+    summaries = sorted((entry for entry in os.scandir(directory) if entry.name.endswith('.json')),
+                       key=lambda entry: entry.stat().st_mtime, reverse=True)
+
+    for index, entry in enumerate(summaries):
+        if index >= max_files or now - entry.stat().st_mtime > ttl:
+            profile_id = entry.name[:-len('.json')]
+            for path in (entry.path, os.path.join(directory, f"{profile_id}.prof")):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+def list_profiles(directory=PROFILE_DIR):
+    # Newest first, without the function tables
+    if not os.path.isdir(directory):
+        return []
+
+    profiles = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.json'):
+            summary = read_profile(entry.name[:-len('.json')], directory)
+            if summary is not None:
+                profiles.append({k: v for k, v in summary.items() if k != 'functions'})
+
+    return sorted(profiles, key=lambda profile: profile['created'], reverse=True)
+
+
+def read_profile(profile_id, directory=PROFILE_DIR):
+    # IDs are hex, anything else is not a profile (and never a path)
+    if not profile_id.isalnum():
+        return None
+
+    try:
+        with open(os.path.join(directory, f"{profile_id}.json"), "r") as fp:
+            return json.load(fp)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def profile_data_path(profile_id, directory=PROFILE_DIR):
+    path = os.path.join(directory, f"{profile_id}.prof")
+    return path if profile_id.isalnum() and os.path.isfile(path) else None
@@ -0,0 +1,114 @@
+from dataclasses import dataclass, field
+import math
+
+
+# Marks a score or completion that has no data behind it (nothing attempted, or no tests at that level)
+NO_ATTEMPT = math.nan
+
+DIFFICULTIES = ("Easy", "Medium", "Hard")
+
+
+def is_missing(value):
+    return isinstance(value, float) and math.isnan(value)
+
+
+def percent_display(value, missing="No Attempt"):
+    return missing if is_missing(value) else f"{value: .0f}%"
+
+
+def percent_stored(value, missing=0):
+    # Matches the rounding of the display string, so stored and displayed numbers always agree
+    return missing if is_missing(value) else float(round(value))
+
+
+@dataclass(slots=True)
+class OverallMetric:
+    value: float
+    unit: str = ""
+
+    def display(self):
+        if self.unit == "Mins":
+            return f"{self.value: .0f} Mins"
+        elif self.unit == "%":
+            return percent_display(self.value)
+        return self.value
+
+    def stored(self):
+        if self.unit == "%":
+            return percent_stored(self.value)
+        return self.display()
+
+
+@dataclass(slots=True)
+class OverallProgress:
+    metrics: dict = field(default_factory=dict)
+
+    def display(self):
+        return {k: v.display() for k, v in self.metrics.items()}
+
+    def stored(self):
+        return {k: v.stored() for k, v in self.metrics.items()}
+
+
+@dataclass(slots=True)
+class DifficultyProgress:
+    avg_score: float = NO_ATTEMPT
+    completion: float = NO_ATTEMPT
+
+    def display(self):
+        return {
+            "Avg Score for Attempted Tests": percent_display(self.avg_score),
+            "Completion": percent_display(self.completion, "0%")
+        }
+
+    def stored(self):
+        return {
+            "Avg Score for Attempted Tests": percent_stored(self.avg_score),
+            "Completion": percent_stored(self.completion, 0.0)
+        }
+
+
+@dataclass(slots=True)
+class TopicProgress:
+    # "<test name> Score" -> rounded percentage, or NO_ATTEMPT
+    scores: dict
+    # Difficulty -> DifficultyProgress. Full length exams have no breakdown, only their test scores
+    summary: dict = None
+
+    def display(self):
+        scores = {k: percent_display(v) for k, v in self.scores.items()}
+        if self.summary is None:
+            return {"summary": scores}
+        return {"details": scores, "summary": {k: v.display() for k, v in self.summary.items()}}
+
+    def stored(self):
+        scores = {k: percent_stored(v) for k, v in self.scores.items()}
+        if self.summary is None:
+            return {"summary": scores}
+        return {"details": scores, "summary": {k: v.stored() for k, v in self.summary.items()}}
+
+
+@dataclass(slots=True)
+class SubjectProgress:
+    # Section name -> topic name -> TopicProgress
+    sections: dict = field(default_factory=dict)
+
+    def display(self):
+        return {section: {name: topic.display() for name, topic in topics.items()}
+                for section, topics in self.sections.items()}
+
+    def stored(self):
+        return {section: {name: topic.stored() for name, topic in topics.items()}
+                for section, topics in self.sections.items()}
+
+
+@dataclass(slots=True)
+class StudentProgress:
+    overall: OverallProgress = field(default_factory=OverallProgress)
+    # Course name -> subject name -> SubjectProgress
+    courses: dict = field(default_factory=dict)
+
+    def display(self):
+        return {"overall_progress": self.overall.display()} | \
+               {course: {subject: progress.display() for subject, progress in subjects.items()}
+                for course, subjects in self.courses.items()}
@@ -0,0 +1,163 @@
+from progress_model import DIFFICULTIES, is_missing
+import re
+
+
+# One line per topic: average score and completion for each difficulty, then the individual tests
+TABLE_HEADER = "topic | " + " | ".join(f"{d.lower()} avg, done" for d in DIFFICULTIES) + " | tests"
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+# Stored summary fields and their short labels in the table header
+METRICS = {"Avg Score for Attempted Tests": "avg", "Completion": "done"}
+
+# Trends are only worth sending from the third attempt on, the second is covered by the change list
+TREND_MIN_ATTEMPTS = 3
+TREND_TOPICS = 8
+TREND_POINTS = 4
+
+
+def estimate_tokens(text):
+    # Rough local count, close enough to compare prompt layouts: words split every ~4 characters,
+    # punctuation counts on its own, whitespace is folded into its neighbours
+    return sum(1 + (len(piece) - 1) // 4 for piece in TOKEN_PATTERN.findall(text))
+
+
+def number(value):
+    if is_missing(value):
+        return "-"
+    elif isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def test_name(key):
+    # Details are keyed "<test name> Score"
+    return key[:-len(" Score")] if key.endswith(" Score") else key
+
+
+def format_tests(scores):
+    attempted = [f"{test_name(k)} {number(v)}" for k, v in scores.items() if not is_missing(v)]
+    unattempted = [test_name(k) for k, v in scores.items() if is_missing(v)]
+
+    parts = []
+    if attempted:
+        parts.append("attempted: " + ", ".join(attempted))
+    if unattempted:
+        parts.append("not attempted: " + ", ".join(unattempted))
+
+    return "; ".join(parts) or "-"
+
+
+def format_topic(name, topic):
+    if topic.summary is None:
+        levels = " | ".join("n/a" for _ in DIFFICULTIES)
+    else:
+        levels = " | ".join(f"{number(topic.summary[d].avg_score)}, {number(topic.summary[d].completion)}"
+                            if d in topic.summary else "-, -" for d in DIFFICULTIES)
+
+    return f"{name} | {levels} | {format_tests(topic.scores)}"
+
+
+def format_overall(overall):
+    return "; ".join(f"{k}: {str(v).strip()}" for k, v in overall.display().items())
+
+
+def format_subject(subject):
+    lines = []
+
+    for section, topics in subject.sections.items():
+        lines.append(f"[{section}]")
+        lines.extend(format_topic(name, topic) for name, topic in topics.items())
+
+    return "\n".join(lines)
+
+
+def format_progress(overall, subjects):
+    # subjects: subject name -> SubjectProgress. Scores and completion are percentages, "-" is no attempt
+    blocks = [f"Overall: {format_overall(overall)}", TABLE_HEADER]
+
+    for name, subject in subjects.items():
+        blocks.append(f"## {name}\n{format_subject(subject)}")
+
+    return "\n".join(blocks)
+
+
+def change(label, before, after):
+    return f"{label} {'new' if before is None else number(before)}->{number(after)}"
+
+
+def topic_changes(topic, before):
+    stored = topic.stored()
+    changes = []
+
+    if topic.summary is None:
+        scores, previous_scores = stored["summary"], before.get("summary", {})
+    else:
+        for difficulty, values in stored["summary"].items():
+            previous_values = before.get("summary", {}).get(difficulty, {})
+            for metric, label in METRICS.items():
+                if previous_values.get(metric) != values[metric]:
+                    changes.append(change(f"{difficulty.lower()} {label}", previous_values.get(metric), values[metric]))
+        scores, previous_scores = stored["details"], before.get("details", {})
+
+    for key, value in scores.items():
+        if previous_scores.get(key) != value:
+            changes.append(change(test_name(key), previous_scores.get(key), value))
+
+    return changes
+
+
+def format_changes(overall, subjects, previous):
+    # Only what moved since the previous report. previous holds the saved snapshot, where a missing value
+    # was written as 0, so both sides are compared in that stored form
+    lines = []
+
+    previous_overall = previous.get("overall_progress", {})
+    overall_changes = [change(k, previous_overall.get(k), v) for k, v in overall.stored().items()
+                       if previous_overall.get(k) != v]
+    if overall_changes:
+        lines.append("Overall: " + "; ".join(overall_changes))
+
+    for name, subject in subjects.items():
+        previous_sections = previous.get(name, {})
+
+        for section, topics in subject.sections.items():
+            for topic_name, topic in topics.items():
+                before = previous_sections.get(section, {}).get(topic_name)
+                if before is None:
+                    lines.append(f"{name} / {section} / {topic_name}: new topic")
+                    continue
+
+                changes = topic_changes(topic, before)
+                if changes:
+                    lines.append(f"{name} / {section} / {topic_name}: " + "; ".join(changes))
+
+    return "\n".join(lines) or "No changes since the previous report."
+
+
+def series(values):
+    return "->".join("-" if v is None else number(v) for v in values[-TREND_POINTS:])
+
+
+def format_trend(record):
+    streak = record["streak"]
+    direction = f", up {streak} in a row" if streak > 0 else f", down {-streak} in a row" if streak < 0 else ""
+
+    return (f"{record['subject']} / {record['section']} / {record['topic']} {record['difficulty'].lower()}: "
+            f"{series(record['progress'])} ({'+' if record['slope'] > 0 else ''}{number(record['slope'])}/attempt{direction})")
+
+
+def format_trends(trends, subjects=None, limit=TREND_TOPICS):
+    # Subject averages, then the fastest moving topics, instead of a snapshot per attempt.
+    # subjects optionally narrows both to some subjects
+    if trends is None or trends["attempts"] < TREND_MIN_ATTEMPTS:
+        return None
+
+    lines = [f"{subject} average: {series(values)}" for subject, values in trends["subjects"].items()
+             if subjects is None or subject in subjects]
+
+    moving = [record for record in trends["topics"] if record["slope"] and (subjects is None or record["subject"] in subjects)]
+    moving.sort(key=lambda record: abs(record["slope"]), reverse=True)
+    lines.extend(format_trend(record) for record in moving[:limit])
+
+    return "\n".join(lines)
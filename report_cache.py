@@ -0,0 +1,179 @@
+from collections import OrderedDict
+import threading
+import hashlib
+import logging
+import json
+import time
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# Cache settings, overridable through the environment. REPORT_CACHE_DIR enables the disk-backed store
+CACHE_MAX_ENTRIES = int(os.getenv('REPORT_CACHE_MAX_ENTRIES', 1024))
+CACHE_TTL = float(os.getenv('REPORT_CACHE_TTL', 7 * 24 * 3600))
+CACHE_DIR = os.getenv('REPORT_CACHE_DIR')
+
+
+def cache_key(*parts):
+    # Stable across processes and restarts, unlike hash()
+    digest = hashlib.sha256()
+
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+        digest.update(b"\0")
+
+    return digest.hexdigest()
+
+
+class ReportCache:
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, directory=CACHE_DIR):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.entries = OrderedDict()
+        # Keys stored on disk, least recently used first, so writes evict without listing the directory
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self.load_files()
+
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+
+    def load_files(self):
+        # Once at start, oldest first by modification time. Entries another process writes to the same directory
+        # later are not counted until the next start
+        files = [f for f in os.scandir(self.directory) if f.name.endswith(".json")]
+        for f in sorted(files, key=lambda f: f.stat().st_mtime):
+            self.files[f.name[:-len(".json")]] = None
+
+
+    def expired(self, created):
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+
+    def read_disk(self, key):
+        try:
+            with open(self.path(key), "r") as fp:
+                entry = json.load(fp)
+        except FileNotFoundError:
+            with self.lock:
+                self.files.pop(key, None)
+            return None
+        except json.JSONDecodeError:
+            return None
+
+        if self.expired(entry['created']):
+            with self.lock:
+                self.files.pop(key, None)
+            self.remove_disk(key)
+            return None
+
+        return entry
+
+
+    def write_disk(self, key, entry):
+        # Written to a temp file first, so a concurrent reader never sees half an entry
+        temp_path = f"{self.path(key)}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as fp:
+            json.dump(entry, fp)
+        os.replace(temp_path, self.path(key))
+
+
+    def remove_disk(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+    def get(self, key):
+        if self.max_entries <= 0:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and self.expired(entry['created']):
+                del self.entries[key]
+                entry = None
+
+            if entry is not None:
+                return self.hit(key)
+
+        # Read outside the lock, other lookups and writes go on meanwhile
+        entry = self.read_disk(key) if self.directory else None
+
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.store(key, entry)
+            self.files[key] = None
+            return self.hit(key)
+
+
+    def hit(self, key):
+        self.entries.move_to_end(key)
+        if key in self.files:
+            self.files.move_to_end(key)
+        self.hits += 1
+        return self.entries[key]['value']
+
+
+    def store(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            # With a disk store the entry is only dropped from memory, not lost
+            if not self.directory:
+                self.evictions += 1
+
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+
+        entry = {'created': time.time(), 'value': value}
+        evicted = []
+
+        with self.lock:
+            self.store(key, entry)
+            if not self.directory:
+                return
+
+            self.files[key] = None
+            self.files.move_to_end(key)
+            while len(self.files) > self.max_entries:
+                evicted.append(self.files.popitem(last=False)[0])
+            self.evictions += len(evicted)
+
+        # The files are written and removed outside the lock
+        self.write_disk(key, entry)
+        for old in evicted:
+            self.remove_disk(old)
+
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'disk_entries': len(self.files)
+        }
+
+
+report_cache = ReportCache()
@@ -0,0 +1,309 @@
+from report_pipeline import generate_report
+from metrics import metrics
+from logging_config import log_context
+from fastapi.encoders import jsonable_encoder
+from dataclasses import dataclass, asdict
+from pydantic import BaseModel, Field
+from collections import OrderedDict
+import threading
+import contextvars
+import asyncio
+import logging
+import uuid
+import json
+import time
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# Job queue settings, overridable through the environment. An empty REPORT_JOB_DIR keeps jobs in memory only.
+# Finished jobs are kept for REPORT_JOB_TTL seconds, and at most the newest REPORT_JOB_MAX of them
+JOB_WORKERS = int(os.getenv('REPORT_JOB_WORKERS', 4))
+JOB_DIR = os.getenv('REPORT_JOB_DIR', 'Data/jobs')
+JOB_TTL = float(os.getenv('REPORT_JOB_TTL', 24 * 3600))
+JOB_MAX = int(os.getenv('REPORT_JOB_MAX', 500))
+
+NO_RESULT = "No parsed response received from the model"
+
+
+class ReportJobRequest(BaseModel):
+    user: str = Field(description="User ID the report is generated for")
+    course: str = Field(description="Course/class ID the report is generated for")
+
+
+@dataclass(slots=True)
+class Job:
+    id: str
+    user: str
+    course: str
+    status: str = 'queued'
+    created: float = 0.0
+    started: float = None
+    finished: float = None
+    result: dict = None
+    error: str = None
+
+    @property
+    def key(self):
+        return self.user, self.course
+
+    def active(self):
+        return self.status in ('queued', 'running')
+
+
+class JobQueue:
+    # Report generation as background jobs. A request for a user/course that already has a job queued or running
+    # gets that job instead of a new one, so repeated refreshes and polling dashboards share one job ID. The
+    # generation itself is shared with every other path (the report and stream endpoints, batches) by report_events
+
+    def __init__(self, workers=JOB_WORKERS, directory=JOB_DIR, ttl=JOB_TTL, max_jobs=JOB_MAX,
+                 handler=generate_report):
+        self.worker_count = workers
+        self.directory = directory
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.handler = handler
+        self.jobs = {}
+        # IDs of the finished jobs, oldest first, so expiring never scans the whole table
+        self.finished = OrderedDict()
+        # The queued or running job of each user/course
+        self.active = {}
+        self.events = {}
+        self.loop = None
+        self.queue = None
+        self.workers = []
+        self.writes = None
+        self.write_task = None
+        self.loaded = False
+        self.deduplicated = 0
+
+
+    def path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+
+    def write(self, job_id, job):
+        # job None removes the file. Written to a temp file first, so a reader never sees half a job
+        if job is None:
+            try:
+                os.remove(self.path(job_id))
+            except FileNotFoundError:
+                pass
+            return
+
+        temp_path = f"{self.path(job_id)}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as fp:
+            json.dump(asdict(job), fp)
+        os.replace(temp_path, self.path(job_id))
+
+
+    def persist(self, job_id, job):
+        if not self.directory:
+            return
+
+        # While the workers run, files are written by the writer task, in order and off the event loop
+        if self.writes is None:
+            self.write(job_id, job)
+        else:
+            self.writes.put_nowait((job_id, job))
+
+
+    async def writer(self):
+        while True:
+            job_id, job = await self.writes.get()
+            try:
+                await asyncio.to_thread(self.write, job_id, job)
+            except OSError as e:
+                logger.warning(f"[FAIL] Save report job {job_id}: {e}")
+            finally:
+                self.writes.task_done()
+
+
+    def save(self, job):
+        self.persist(job.id, job)
+
+
+    def remove(self, job_id):
+        self.jobs.pop(job_id, None)
+        self.events.pop(job_id, None)
+        self.finished.pop(job_id, None)
+        self.persist(job_id, None)
+
+
+    def load(self):
+        self.loaded = True
+        if not self.directory:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path, "r") as fp:
+                    job = Job(**json.load(fp))
+            except (json.JSONDecodeError, TypeError):
+                logger.warning(f"[FAIL] Load report job {entry.name}, skipped")
+                continue
+            self.jobs[job.id] = job
+
+        for job in sorted(self.jobs.values(), key=lambda job: job.finished or 0):
+            if not job.active():
+                self.finished[job.id] = None
+        self.expire()
+
+        logger.info(f"[OK] Loaded {len(self.jobs)} report jobs from {self.directory}")
+
+
+    def expire(self):
+        # Oldest finished first, until the rest are within the TTL and the count
+        now = time.time()
+
+        while self.finished:
+            job = self.jobs[next(iter(self.finished))]
+            if len(self.finished) <= self.max_jobs and (self.ttl <= 0 or now - job.finished <= self.ttl):
+                break
+            self.remove(job.id)
+
+
+    def start(self):
+        # Workers belong to the running event loop, they are started on first use or from the app's startup
+        loop = asyncio.get_running_loop()
+        if self.loop is loop:
+            return
+
+        if not self.loaded:
+            self.load()
+
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.writes = asyncio.Queue()
+        # Created in an empty context, a worker started on first use would otherwise log under that request's fields
+        self.workers = [contextvars.Context().run(loop.create_task, self.worker()) for _ in range(self.worker_count)]
+        self.write_task = contextvars.Context().run(loop.create_task, self.writer())
+        self.active = {}
+
+        # Jobs left queued or running, by a restart or by a previous event loop, are picked up again
+        for job in sorted(self.jobs.values(), key=lambda job: job.created):
+            if job.active():
+                job.status = 'queued'
+                self.enqueue(job)
+
+        logger.info(f"[OK] Started {self.worker_count} report job workers")
+
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+        # Interrupted jobs were saved as queued, those writes finish before the writer stops
+        if self.write_task is not None:
+            await self.writes.join()
+            self.write_task.cancel()
+            await asyncio.gather(self.write_task, return_exceptions=True)
+
+        self.workers = []
+        self.write_task = None
+        self.writes = None
+        self.loop = None
+
+
+    def enqueue(self, job):
+        self.active[job.key] = job.id
+        self.events[job.id] = asyncio.Event()
+        self.queue.put_nowait(job)
+
+
+    def submit(self, user_id, class_id):
+        # Returns the job and whether it was joined rather than created
+        self.start()
+        self.expire()
+
+        job_id = self.active.get((user_id, class_id))
+        if job_id is not None:
+            self.deduplicated += 1
+            logger.info(f"[OK] Join report job {job_id} for user={user_id}, class={class_id}")
+            return self.jobs[job_id], True
+
+        job = Job(uuid.uuid4().hex, user_id, class_id, created=time.time())
+        self.jobs[job.id] = job
+        self.save(job)
+        self.enqueue(job)
+        logger.info(f"[OK] Queue report job {job.id} for user={user_id}, class={class_id}")
+
+        return job, False
+
+
+    async def wait(self, job):
+        event = self.events.get(job.id)
+        if event is not None:
+            await event.wait()
+        return job
+
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.run(job)
+            finally:
+                self.queue.task_done()
+
+
+    async def run(self, job):
+        job.status = 'running'
+        job.started = time.time()
+        self.save(job)
+
+        try:
+            with log_context(job_id=job.id):
+                result = await self.handler(job.user, job.course)
+            job.result = jsonable_encoder(result)
+            job.status = 'done' if result is not None else 'failed'
+            job.error = None if result is not None else NO_RESULT
+        except asyncio.CancelledError:
+            # Shutting down, the job stays queued on disk and is picked up again on the next start
+            job.status = 'queued'
+            self.save(job)
+            raise
+        except Exception as e:
+            logger.exception(f"[FAIL] Report job {job.id} for user={job.user}, class={job.course}")
+            job.status = 'failed'
+            job.error = f"{type(e).__name__}: {e}"
+
+        job.finished = time.time()
+        self.save(job)
+        logger.info(f"[OK] Report job {job.id} {job.status} in {job.finished - job.started:.1f}s")
+
+        if self.active.get(job.key) == job.id:
+            del self.active[job.key]
+        self.events.pop(job.id).set()
+
+        self.finished[job.id] = None
+        self.expire()
+
+
+    def get(self, job_id):
+        if not self.loaded:
+            self.load()
+        return self.jobs.get(job_id)
+
+
+    def stats(self):
+        statuses = {}
+        for job in self.jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+
+        return {
+            'workers': self.worker_count,
+            'queued': self.queue.qsize() if self.queue is not None else 0,
+            'jobs': statuses,
+            'deduplicated': self.deduplicated
+        }
+
+
+job_queue = JobQueue()
+metrics.stats('report_jobs', "Report jobs", job_queue.stats, counters=('deduplicated',), label='status')
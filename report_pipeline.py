@@ -0,0 +1,538 @@
+from data_processing import *
+from heatmaps import render, cached_heatmap, save_heatmap, image_version, HEATMAP_FORMAT
+from urllib.parse import quote
+from sat_agent import *
+from report_cache import cache_key, report_cache
+from attempt_store import attempt_writer
+from prompt_format import estimate_tokens, format_changes
+from gemini_client import gemini_agent
+from heatmaps import heatmap_cache
+from upstream_cache import upstream_cache
+from metrics import metrics, Timings
+from logging_config import log_context, log_payload
+from profiling import Profiled, profiled_async, current_profile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+import multiprocessing
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+MODEL = 'gemini-2.5-flash-lite'
+THINKING_TOKENS = 1024
+TEMPERATURE = 0.2
+OUTPUT_TOKENS = 16000
+SUMMARY_OUTPUT_TOKENS = 4000
+
+SUBJECTS = ['Mathematics', 'Writing', 'Reading']
+
+# Processes rendering heatmaps (and aggregating, in batches), overridable through the environment
+CPU_WORKERS = int(os.getenv('CPU_WORKERS', os.cpu_count() or 1))
+
+_cpu_pool = None
+
+# Part of the report cache keys, so a schema change never serves reports in the old shape
+SECTION_SCHEMA = SectionAnalysis.model_json_schema()
+SUMMARY_SCHEMA = ReportSummary.model_json_schema()
+
+# Usage metadata fields counted in gemini_tokens_total
+TOKEN_FIELDS = {'promptTokenCount': 'prompt', 'cachedContentTokenCount': 'cached', 'candidatesTokenCount': 'output',
+                'thoughtsTokenCount': 'thinking'}
+
+REPORTS = metrics.counter('reports_total', "Reports by outcome", ['status'])
+REPORT_SECONDS = metrics.histogram('report_seconds', "Time to generate a whole report")
+STAGE_SECONDS = metrics.histogram('report_stage_seconds', "Time spent in each stage of a report", ['stage'])
+SECTIONS = metrics.counter('report_sections_total', "Report sections by how they were produced", ['status'])
+TOKENS = metrics.counter('gemini_tokens_total', "Gemini tokens used by new (not cached) report parts", ['kind'])
+CACHED_TOKENS = metrics.counter('report_cache_tokens_total',
+                                "Gemini tokens of report parts served from the report cache, not spent again", ['kind'])
+metrics.stats('report_cache', "Report cache", report_cache.stats, counters=('hits', 'misses', 'evictions'))
+metrics.stats('heatmap_cache', "Heatmap cache", heatmap_cache.stats, counters=('hits', 'misses', 'evictions'))
+metrics.stats('gemini', "Gemini calls", gemini_agent.stats, counters=('calls', 'retries', 'hedges'))
+metrics.stats('attempt_writer', "Attempt writes", attempt_writer.stats, counters=('written', 'failed'))
+metrics.stats('upstream_cache', "Upstream payload cache", upstream_cache.stats,
+              counters=('hits', 'stale', 'misses', 'revalidated', 'updated', 'evictions', 'refresh_errors'))
+if context_cache is not None:
+    metrics.stats('context_cache', "Context cache", context_cache.stats,
+                  counters=('created', 'refreshed', 'fallbacks', 'cached_tokens'))
+
+
+def aggregate_progress(user_id, class_id, payloads):
+    return data_segregation(FetchStudentData(user_id, class_id, payloads).master_loop())
+
+
+def load_trends(user_id, class_id, performance_data):
+    # numpy is only needed here, it is loaded with the first report that has a history (or by warmup)
+    from trends import student_trends
+    return student_trends(user_id, class_id, performance_data)
+
+
+def plan_sections(performance_data, latest, trends=None):
+    # Sections whose data is unchanged since the previous report reuse its analysis, the rest get a prompt each.
+    # latest is the last attempt, None before the first one
+    attempt = latest is not None
+    previous = latest['progress'] if attempt else None
+    last_report = latest['report'] if attempt else None
+    overall = performance_data['overall_progress']
+    reused, prompts = {}, {}
+
+    for subject in SUBJECTS:
+        progress = performance_data[subject]
+        section = last_report['sections'].get(subject.lower()) if last_report else None
+
+        if section is not None and previous[subject] == progress.stored():
+            reused[subject] = section
+        else:
+            changes = format_changes(overall, {subject: progress}, previous) if attempt else None
+            prompts[subject] = generate_section_prompt(subject, progress, overall, changes, trends)
+
+    summary_changes = format_changes(overall, {}, previous) if attempt else None
+
+    return reused, prompts, summary_changes
+
+
+def total_usage(parts):
+    usages = [part['token_usage'] for part in parts if part['token_usage'] is not None]
+    if not usages:
+        return None
+
+    return {field: sum(usage.get(field) or 0 for usage in usages)
+            for field in ['promptTokenCount', 'cachedContentTokenCount', 'candidatesTokenCount', 'thoughtsTokenCount',
+                          'totalTokenCount']}
+
+
+async def generate_part(user_prompt, system_prompt, schema, schema_key, output_tokens, llm_limit=None):
+    # One Gemini call, reused from the report cache when every input to the model is unchanged.
+    # Returns the part (None if never parsed) and the call statistics (None on a cache hit)
+    cache_id = cache_key(MODEL, THINKING_TOKENS, TEMPERATURE, output_tokens, schema_key, system_prompt, user_prompt)
+    cached = await asyncio.to_thread(report_cache.get, cache_id)
+
+    if cached is not None:
+        for field, kind in TOKEN_FIELDS.items():
+            CACHED_TOKENS.inc(kind, amount=(cached['token_usage'] or {}).get(field) or 0)
+        return cached, None
+
+    key = os.getenv('GEMINI_API')
+
+    # Retried with backoff (and optionally hedged) by the shared client wrapper
+    async with llm_limit or nullcontext():
+        llm_result = await profiled_async('agent', gemini_agent.generate(user_prompt, system_prompt, MODEL, key,
+                                                                         THINKING_TOKENS, TEMPERATURE, output_tokens,
+                                                                         schema))
+
+    response = llm_result.response
+    if response.parsed is None:
+        logger.error("[FAIL] Max retries reach, no parsed response received")
+        log_payload("[FAIL] Unparsed response:", response)
+        return None, llm_result
+
+    part = {
+        'output': response.parsed.model_dump(),
+        'id': response.response_id,
+        'token_usage': response.usage_metadata.model_dump(mode='json', by_alias=True)
+        if response.usage_metadata is not None else None
+    }
+    for field, kind in TOKEN_FIELDS.items():
+        TOKENS.inc(kind, amount=(part['token_usage'] or {}).get(field) or 0)
+    log_payload(f"[OK] Response Parsed ({schema.__name__}):", part['output'])
+    await asyncio.to_thread(report_cache.set, cache_id, part)
+
+    return part, llm_result
+
+
+def cpu_pool():
+    # One process pool for every report and batch, created on first use and shut down with the app, so its workers
+    # (and their matplotlib imports) stay warm. Spawned rather than forked, the parent already runs threads and an
+    # event loop
+    global _cpu_pool
+    if _cpu_pool is None:
+        _cpu_pool = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _cpu_pool
+
+
+async def shutdown_cpu_pool():
+    # Waits for running renders on a thread, never on the event loop
+    global _cpu_pool
+    pool, _cpu_pool = _cpu_pool, None
+    if pool is not None:
+        await asyncio.to_thread(pool.shutdown, cancel_futures=True)
+
+
+async def run_cpu_bound(executor, func, *args):
+    # Without an executor the work still leaves the event loop, on the default thread pool
+    if executor is None:
+        return await asyncio.to_thread(func, *args)
+
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def heatmap_image(executor, data, title, size, output_path):
+    # The heatmap cache is read and filled in this process, only a render goes to the executor
+    key, image = await asyncio.to_thread(cached_heatmap, data, title, size, HEATMAP_FORMAT)
+    rendered = image is None
+
+    if rendered:
+        image = await run_cpu_bound(executor, Profiled('generate_heatmap', render), data, title, size, HEATMAP_FORMAT)
+    await asyncio.to_thread(save_heatmap, key, image, output_path, rendered)
+
+    return image
+
+
+class Generation:
+    # One report being generated, shared by every caller asking for its user/course. Its events are kept, so a
+    # caller that joins late still gets all of them, and it is cancelled once every caller has gone away
+
+    def __init__(self):
+        self.events = []
+        self.error = None
+        self.done = False
+        self.callers = 0
+        self.changed = asyncio.Event()
+        self.task = None
+
+
+    def publish(self, event):
+        self.events.append(event)
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+    def finish(self, error=None):
+        self.error = error
+        self.done = True
+        self.changed.set()
+
+
+    async def follow(self):
+        index = 0
+
+        while True:
+            if index < len(self.events):
+                yield self.events[index]
+                index += 1
+            elif self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            else:
+                await self.changed.wait()
+
+
+# Reports being generated, by (user_id, class_id). Every path that generates a report (the report and stream
+# endpoints, jobs, batches, profiled requests) goes through report_events, so a user/course is generated once at a
+# time, with one set of Gemini calls and one saved attempt
+generations = {}
+joined = 0
+
+
+def in_flight(user_id, class_id):
+    return (user_id, class_id) in generations
+
+
+async def report_events(user_id, class_id, fetch_limit=None, llm_limit=None, cpu_executor=None):
+    # Yields (event, data) as each part of the report becomes available: the progress data, the trends, each
+    # section's analysis, the summary, the heatmap URLs and finally the meta data. Stops early if the model never
+    # returns a parsed response.
+    # fetch_limit and llm_limit are optional semaphores bounding the upstream and Gemini calls,
+    # cpu_executor optionally moves aggregation and heatmap rendering to a process pool. A caller that joins a
+    # report already being generated gets that report, generated with the first caller's limits
+    global joined
+    key = (user_id, class_id)
+    generation = generations.get(key)
+
+    if generation is None:
+        generation = Generation()
+        generations[key] = generation
+        generation.task = asyncio.create_task(generate_events(generation, user_id, class_id, fetch_limit, llm_limit,
+                                                              cpu_executor))
+    else:
+        joined += 1
+        logger.info(f"[OK] Join report generation for user={user_id}, class={class_id}")
+
+    generation.callers += 1
+    try:
+        async for event in generation.follow():
+            yield event
+    finally:
+        generation.callers -= 1
+        if generation.callers == 0 and not generation.done:
+            generation.task.cancel()
+
+
+async def generate_events(generation, user_id, class_id, fetch_limit, llm_limit, cpu_executor):
+    # Runs the stages once for every caller of the generation, which is done (and forgotten) when they finish
+    timings = Timings(STAGE_SECONDS)
+    status = 'no_result'
+    error = None
+
+    try:
+        with log_context(user_id=user_id, class_id=class_id):
+            async for event, data in report_stages(user_id, class_id, fetch_limit, llm_limit, cpu_executor, timings):
+                if event == 'meta_data':
+                    status = 'ok'
+                generation.publish((event, data))
+    except asyncio.CancelledError as e:
+        status = 'cancelled'
+        error = e
+        raise
+    except Exception as e:
+        # Raised to every caller, the stage that failed has logged it
+        status = 'error'
+        error = e
+    finally:
+        if generations.get((user_id, class_id)) is generation:
+            del generations[(user_id, class_id)]
+        generation.finish(error)
+        REPORTS.inc(status)
+        REPORT_SECONDS.observe(time.perf_counter() - timings.start)
+        # A profiled request keeps the stage timings with its profile
+        profile = current_profile()
+        if profile is not None:
+            profile.stages = timings.meta_data()
+
+
+def generation_stats():
+    return {'in_flight': len(generations), 'joined': joined}
+
+
+metrics.stats('report_generations', "Report generations", generation_stats, counters=('joined',))
+
+
+async def report_stages(user_id, class_id, fetch_limit, llm_limit, cpu_executor, timings):
+    # The stages of report_events, each timed into timings
+
+    # Initiate Data Processing
+    try:
+        async with fetch_limit or nullcontext():
+            with timings.span('fetch'):
+                payloads = await profiled_async('fetch', fetch_student_payloads_async(user_id, class_id))
+        logger.info(f"[OK] Instantiate Data Class for user={user_id}, class={class_id}")
+    except Exception as e:
+        logger.exception(f"[FAIL] Instantiate Data Class for user={user_id}, class={class_id}")
+        raise
+
+    # Acquire Data
+    try:
+        with timings.span('aggregation'):
+            performance_data = await run_cpu_bound(cpu_executor, Profiled('FetchStudentData', aggregate_progress),
+                                                   user_id, class_id, payloads)
+        logger.info(f"[OK] Acquire performance data for user={user_id}, class={class_id}")
+    except Exception as e:
+        logger.exception(f"[FAIL] Acquire performance data for user={user_id}, class={class_id}")
+        raise
+
+    yield 'progress', {k: v.display() for k, v in performance_data.items()}
+
+    # Get SAT Exam Details
+    try:
+        with timings.span('context'):
+            context = await asyncio.to_thread(get_context)
+        logger.info(f"[OK] Get context for SAT Exam")
+    except Exception as e:
+        logger.exception(f"[FAIL] Get context for SAT Exam")
+        raise
+
+    # Segregate Student Progress
+    overall_progress = performance_data['overall_progress']
+    mathematics = performance_data['Mathematics']
+    writing = performance_data['Writing']
+    reading = performance_data['Reading']
+
+    # Load the previous attempt once, after a save of this student's last report still in the background has landed
+    try:
+        with timings.span('history'):
+            await asyncio.to_thread(attempt_writer.wait, user_id, class_id)
+            latest = await asyncio.to_thread(latest_attempt, user_id, class_id)
+        attempt = latest is not None
+        logger.info(f"[OK] Find previous attempt data for user={user_id}, class={class_id}")
+    except Exception as e:
+        logger.exception(f"[FAIL] Find previous attempt data for user={user_id}, class={class_id}")
+        raise
+
+    # Trends over the attempt history, once there are two distinct attempts
+    try:
+        with timings.span('trends'):
+            trends = await asyncio.to_thread(Profiled('trends', load_trends), user_id, class_id,
+                                             performance_data) if attempt else None
+        logger.info(f"[OK] Compute trends for user={user_id}, class={class_id}, "
+                    f"attempts={trends['attempts'] if trends else 0}")
+    except Exception as e:
+        logger.exception(f"[FAIL] Compute trends for user={user_id}, class={class_id}")
+        raise
+
+    yield 'trends', trends
+
+    # Generate Prompts. The system prompt is shared by every call, the user prompt is split per section
+    try:
+        with timings.span('prompt'):
+            system_prompt = generate_system_prompt(context, attempt)
+            reused_sections, section_prompts, summary_changes = await asyncio.to_thread(
+                Profiled('plan_sections', plan_sections), performance_data, latest, trends)
+        logger.info(f"[OK] Generate prompt if attempt status is {attempt}, reused={list(reused_sections)}, "
+                    f"estimated_tokens={ {k: estimate_tokens(v) for k, v in section_prompts.items()} }")
+    except Exception as e:
+        logger.exception(f"[FAIL] Generate prompt if attempt status is {attempt}")
+        raise
+
+    # Get the section analyses from Agent concurrently, each sent on as soon as it is ready, then a short summary
+    # and roadmap over them. Parts that finish are cached even if another fails, so a retry only regenerates
+    # what is missing
+    # Tokens are only counted for parts generated by this report. Parts from the report cache keep the usage of the
+    # call that made them, it is returned separately
+    llm_results = {}
+    parts = []
+    cached_parts = []
+    sections = {}
+
+    for subject, section in reused_sections.items():
+        sections[subject] = section
+        SECTIONS.inc('reused')
+        yield 'section', {'subject': subject, 'status': 'reused', 'analysis': section}
+
+    try:
+        tasks = {asyncio.create_task(timings.timed('llm', subject, generate_part(prompt, system_prompt, SectionAnalysis,
+                                                                                 SECTION_SCHEMA, OUTPUT_TOKENS,
+                                                                                 llm_limit))): subject
+                 for subject, prompt in section_prompts.items()}
+        pending = set(tasks)
+        error = None
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                subject = tasks[task]
+                if task.exception() is not None:
+                    error = error or task.exception()
+                    continue
+
+                part, llm_result = task.result()
+                if llm_result is not None:
+                    llm_results[subject] = llm_result.meta_data()
+                if part is None:
+                    logger.error(f"[FAIL] No {subject} analysis for user={user_id}, class={class_id}")
+                    continue
+
+                (parts if llm_result is not None else cached_parts).append(part)
+                sections[subject] = create_section_dictionary(part['output'])
+                SECTIONS.inc('cached' if llm_result is None else 'generated')
+                yield 'section', {'subject': subject, 'status': 'cached' if llm_result is None else 'generated',
+                                  'analysis': sections[subject]}
+
+        if error is not None:
+            raise error
+        if len(sections) < len(SUBJECTS):
+            return
+
+        # Report order is fixed, whichever sections were reused or generated
+        sections = {subject: sections[subject] for subject in SUBJECTS}
+
+        summary_prompt = generate_summary_prompt(overall_progress, sections, summary_changes, trends)
+        summary, llm_result = await timings.timed('llm', 'summary',
+                                                  generate_part(summary_prompt, system_prompt, ReportSummary,
+                                                                SUMMARY_SCHEMA, SUMMARY_OUTPUT_TOKENS, llm_limit))
+        if llm_result is not None:
+            llm_results['summary'] = llm_result.meta_data()
+        if summary is None:
+            logger.error(f"[FAIL] No report summary for user={user_id}, class={class_id}")
+            return
+        (parts if llm_result is not None else cached_parts).append(summary)
+
+        logger.info(f"[OK] Call Agent for user={user_id}, class={class_id}, {llm_results}, {report_cache.stats()}")
+    except Exception as e:
+        logger.exception(f"[FAIL] Call Agent for user={user_id}, class={class_id}")
+        raise
+
+    yield 'summary', summary['output']
+
+    report_dict = assemble_report(summary['output'], sections)
+
+    # Save the attempt, written behind by the attempt writer so the heatmaps and the response don't wait for it
+    try:
+        with timings.span('persistence'):
+            subjects_name_list, subjects_details_list = await asyncio.to_thread(save_attempt, user_id, class_id,
+                                                                                performance_data, report_dict)
+        logger.info(f"[OK] Save data for user={user_id}, class={class_id}")
+    except Exception as e:
+        logger.exception(f"[FAIL] Save data for user={user_id}, class={class_id}")
+        raise
+
+    # Generate Subject Progress Heatmaps straight from the progress data in memory. matplotlib holds the GIL while it
+    # draws, so with more than one CPU the three run side by side in the process pool (the shared one, or the batch's
+    # share of it). With one CPU a pool only adds overhead, they render on threads. Unchanged heatmaps come from the
+    # heatmap cache
+    try:
+        math_heatmap_output_path = f'Data/saved_progress_report/{user_id}-{class_id}/previous/heatmaps/math_heatmap.{HEATMAP_FORMAT}'
+        math_title = "SAT Math Progress Heatmap"
+        math_fig_size = (8, 14)
+
+        writing_heatmap_output_path = f'Data/saved_progress_report/{user_id}-{class_id}/previous/heatmaps/writing_heatmap.{HEATMAP_FORMAT}'
+        writing_title = "SAT Writing Progress Heatmap"
+        writing_fig_size = (8,8)
+
+        reading_heatmap_output_path = f'Data/saved_progress_report/{user_id}-{class_id}/previous/heatmaps/reading_heatmap.{HEATMAP_FORMAT}'
+        reading_title = "SAT Reading Progress Heatmap"
+        reading_fig_size = (8,4)
+
+        executor = cpu_executor if cpu_executor is not None or CPU_WORKERS < 2 else cpu_pool()
+
+        math_image, writing_image, reading_image = await asyncio.gather(
+            timings.timed('heatmap', 'math', heatmap_image(executor, mathematics.stored(), math_title,
+                                                           math_fig_size, math_heatmap_output_path)), # Math
+            timings.timed('heatmap', 'writing', heatmap_image(executor, writing.stored(), writing_title,
+                                                              writing_fig_size, writing_heatmap_output_path)), # Writing
+            timings.timed('heatmap', 'reading', heatmap_image(executor, reading.stored(), reading_title,
+                                                              reading_fig_size, reading_heatmap_output_path)), # Reading
+        )
+
+        logger.info(f"[OK] Generate Heatmaps for user={user_id}, class={class_id}")
+    except Exception as e:
+        logger.exception(f"[FAIL] Generate Heatmaps for user={user_id}, class={class_id}")
+        raise
+
+    # One route serves every student's heatmaps, the content hash in ?v= lets browsers and CDNs cache them for good
+    images_url = f"/images/{quote(user_id, safe='')}/{quote(class_id, safe='')}"
+
+    yield 'heatmaps', {
+        'math' : f"{images_url}/{os.path.basename(math_heatmap_output_path)}?v={image_version(math_image)}",
+        'writing' : f"{images_url}/{os.path.basename(writing_heatmap_output_path)}?v={image_version(writing_image)}",
+        'reading' : f"{images_url}/{os.path.basename(reading_heatmap_output_path)}?v={image_version(reading_image)}",
+    }
+
+    logger.info(f"[OK] Report Generated for user={user_id}, class={class_id}")
+
+    yield 'meta_data', {
+        'data_analyzed': subjects_name_list,
+        "id": summary['id'],
+        'token_usage': total_usage(parts),
+        'cached_usage': total_usage(cached_parts),
+        'cached': not llm_results,
+        'sections': {subject: 'reused' if subject in reused_sections else
+                     'generated' if subject in llm_results else 'cached' for subject in SUBJECTS},
+        'llm': llm_results,
+        'timings': timings.meta_data()
+    }
+
+
+async def generate_report(user_id, class_id, fetch_limit=None, llm_limit=None, cpu_executor=None):
+    # The whole report at once, assembled from the same events the streaming endpoint sends
+    report, sections = {}, {}
+
+    async for event, data in report_events(user_id, class_id, fetch_limit, llm_limit, cpu_executor):
+        if event == 'section':
+            sections[data['subject']] = data['analysis']
+        else:
+            report[event] = data
+
+    if 'meta_data' not in report:
+        return None
+
+    return {
+        'report_json': assemble_report(report['summary'], {subject: sections[subject] for subject in SUBJECTS}),
+        'heatmaps': report['heatmaps'],
+        'trends': report['trends'],
+        'meta_data': report['meta_data']
+    }
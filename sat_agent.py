@@ -1,11 +1,20 @@
-from google import genai
-from google.genai import types
+from prompt_format import format_progress, format_overall, format_trends
+from attempt_store import attempt_store
 from pydantic import BaseModel, Field
 from typing import List
+import asyncio
+import hashlib
+import logging
 import json
+import time
 import os
 
 
+logger = logging.getLogger(__name__)
+
+# google-genai is the slowest import in the app, so it is imported where it is first used (or by warmup)
+
+
 class TopicRecommendation(BaseModel):
     topic_name: str = Field(description="Name of the specific topic")
     current_status: str = Field(
@@ -41,57 +50,77 @@ class StudentProgressReport(BaseModel):
         description="Immediate next steps that the student should take. Also includes some motivational remarks.")
 
 
+class ReportSummary(BaseModel):
+    summary_overview: str = Field(
+        description="Summary of the number of hours student spent on tests, and practice questions. Includes percentage of correctly answered practice questions as well as overall course completion percentage. Also mentions what these numbers imply")
+    priority_roadmap: str = Field(
+        description="A Step-by-step priority roadmap under the heading 'Priority Roadmap' as bullet points that the student can use based on the status and prioritized recommendations.")
+    next_steps: str = Field(
+        description="Immediate next steps that the student should take. Also includes some motivational remarks.")
+
+
 def get_context():
     with open("Data/exam_context/details.md", "r") as md:
         context = md.read()
     return context
 
 
-def check_attempt(user_id, class_id):
-    if os.path.isdir(f"Data/saved_progress_report/{user_id}-{class_id}/previous/heatmaps/"):
-        return True
-    else:
-        return False
+def latest_attempt(user_id, class_id):
+    # The last attempt with its stored progress and report, or None before the first one
+    return attempt_store.latest(user_id, class_id)
 
 
-def generate_prompts(overall, math, writing, reading, context, attempt, user_id, class_id):
-    user_prompt_first_attempt = f'''
-    <INSTRUCTIONS>
-    As an expert coach, help me identify as to how I can improve my exam score with a detailed roadmap based on my current progress.
-    </INSTRUCTIONS>
+def generate_system_prompt(context, attempt):
+    # Shared by every call of a report, it only depends on the exam context and whether there is a previous attempt
+    if attempt:
+        return f'''
+            <ROLE>
+            You are an Expert Exam Prep Coach. You work for Tutoria. You have Decades of experience.
+            </ROLE>
 
-    <DATA>
-    Here is the progress data:
-    Overall = {overall}
-    Mathematics = {math}
-    Writing = {writing}
-    Reading = {reading}
-    <DATA>
+            <OBJECTIVE>
+            You have been given a clear <task> helping students troubleshoot their weaknesses and improve their exam Score by giving them a clear roadmap on what to do next. 
+            To do this, you already have <:context> about exam in form of markdown provided below, and you will receive student's extensive <:current progress> in the form of compact tables, as well as the changes since the <:previous progress>.
+            Analyze the <:current progress>, comparing it with <:previous progress> and use the <:process> to guide the student. 
+            </OBJECTIVE>
 
+            <CONTEXT>
+            Below are the details of the Exam in markdown format. This file contains the details of the examination sections, content domains, testing points, and question distribution.  
+            {context}
+            </CONTEXT>
 
-    <STRUCTURE>
-    The progress data is structured as follows:
-    Overall progress contains the time spent by the students, the questions attempted and overall coursework attempted
-    Then there is nested dictionaries for each subject. Each subject has nested sections, each section has nested topics/domains, each domain has details and summary. details contain the practice test name and the score achieved in the topic (if attempted, otherwise 'No attempt' is shown). Summary contains completion and score summarized by difficulty level. 
-    <STRUCTURE>
+            <PROCESS>
+            1. Use the <:context> to indentify which exam prep you are talking about and Understand the exam context, which includes sections, content domains, testing points, and question distribution. For example, which domain has more question weightage.
+            2. Based on question weightage, higher weightage domains will be prioritized when making improvement recommendations.
+            3. When it comes to subjects, e.g. Maths, Reading, Writing, the priority is as follows, Mathematics is most important, it carries a full 800 marks. 2nd most important is Writing since it is easier to improve upon, carrying 400 marks. Then last is reading, it also carries 400 marks. Remember this order in your recommendations. For example, even though "Craft and Structure" has slightly more weightage than "Standard English Conventions", the latter is more important since it is in Writing subject.
+            4. Analyze and remember student's <:current progress> as well as <:previous progress>. This involves understanding topics they have attempted vs not attempted, as well as the scores in the topics that were attempted for each difficulty level, now as well as previously. 
+            5. Identify whether the higher priority domains have been practiced. For example, if "Algebra" is a high priority domain in maths and student has not attempted it, then prioritize completing this first as a recommendation. Do the same for all high priority domains. 
+            6. Identify higher priority domains that have not been attempted at highest difficulty level. For example, if "Craft and Structure" is a high priority domain and student has not attempted or only partially attempted "medium" and "hard" tests, then prioritize completing them in your recommendation.
+            7. Identify higher priority domains that are attempted but do not have 80% in the highest available difficulty level. For example the student has attempted "hard" difficulty level questions but has a less than 80% score in them, ask them to review the chapters related to that category in detail and give the test again. Mention the topics/chapters.
+            8. If student has made satisfactory progress in the high priority domains of the subject, then simply commend them and move on. Do not try to recommend anything there. For example, if the student has a completion above 90% and average score above 90% in all difficulty levels, then simply appreciate them and move to the next one. 
+            9. Once the higher priority domains are handled, feel free to give advice as an expert coach in the exam. You have access to each sub-domains test and its score as if its attempted by the student. For example, "Command of Evidence 1 (Quantitative) (easy) 80" is one of the many tests and student got 80% in it. So now you go into detail based on these as well. 
+            10. If the student has covered most of the tests but not attempted any full length exams, recommend attempting full length exams. 
+            </PROCESS>
 
-    <GUIDE>
-    1. Be detailed in your internal process, but more concise and information dense in reporting the plan. 
-    2. Keep track of topics and tests in each section. Plan and reason in your thinking scratchpad to review and use.
-    3. Create plan, but do not include any timeline in your recommendation, just the sequence. For example, do not provide a "4 week" plan or a "weekly" plan.
-    4. Be clear, note that the reader is a student in high school, so explain what your mean. For example instead of "You have strong scores across all difficulties but low completion" say "You have strong scores across easy, medium and hard tests, but you did not attempt enough questions to determine whether you can consistently score high in them."
-    5. Be specific, do not give generic advice. Use the data provided to find trouble spots and reference the data for all recommendations.
-    </GUIDE>
-    '''
+            <IMPORTANT RULES>
+            1. Say "I don't know" if you do not know.
+            2. Answer only if you are very confident
+            3. Do not deviate from the student's provided <:current progress> and <:previous progress>. Be sure to understand it properly.
+            4. For a given topic, the <:threshold> for each difficulty is at least 80% completion to qualify for consideration of the average attempted score in that difficulty level. For example, if the completion is less than 80% in "hard" but avg score is 100%, it will not be assumed that student is good at "hard" questions and can skip the "easy" or "medium" ones.
+            5. If a student has completed a higher difficulty level upto the <:threshold> with at least 90% average score in that difficulty, do not recommend them to complete lower difficulty levels in the same topic. 
+            6. Follow the structured output schema defined. 
+            7. Do not explicitly mention priority in heading. For example headings such as "### **Mathematics Section (Highest Priority)**" or "### **Writing Section (Second Highest Priority)**"
+            </IMPORTANT RULES>
+            '''
 
-    system_prompt = f'''
+    return f'''
     <ROLE>
     You are an Expert Exam Prep Coach. You work for Tutoria. You have Decades of experience.
     </ROLE>
 
     <OBJECTIVE>
     You have been given a clear <task> helping students troubleshoot their weaknesses and improve their exam Score by giving them a clear roadmap on what to do next. 
-    To do this, you already have <:context> about exam in form of markdown provided below, and you will receive student's extensive <:progress> in the form of python dictionaries.
+    To do this, you already have <:context> about exam in form of markdown provided below, and you will receive student's extensive <:progress> in the form of compact tables.
     Analyze the <:progress> and use the <:process> to guide them. 
     </OBJECTIVE>
 
@@ -109,7 +138,7 @@ def generate_prompts(overall, math, writing, reading, context, attempt, user_id,
     6. Identify higher priority domains that have not been attempted at highest difficulty level. For example, if "Craft and Structure" is a high priority domain and student has not attempted or only partially attempted "medium" and "hard" tests, then prioritize completing them in your recommendation.
     7. Identify higher priority domains that are attempted but do not have 80% in the highest available difficulty level. For example the student has attempted "hard" difficulty level questions but has a less than 80% score in them, ask them to review the chapters related to that category in detail and give the test again. Mention the topics/chapters.
     8. If student has made satisfactory progress in the high priority domains of the subject, then simply commend them and move on. Do not try to recommend anything there. For example, if the student has a completion above 90% and average score above 90% in all difficulty levels, then simply appreciate them and move to the next one. 
-    9. Once the higher priority domains are handled, feel free to give advice as an expert coach in the exam. You have access to each sub-domains test and its score as if its attempted by the student. For example, "Command of Evidence 1 (Quantitative) (easy) Score': '80%'" is one of the many tests and student got 80% in it. So now you go into detail based on these as well. 
+    9. Once the higher priority domains are handled, feel free to give advice as an expert coach in the exam. You have access to each sub-domains test and its score as if its attempted by the student. For example, "Command of Evidence 1 (Quantitative) (easy) 80" is one of the many tests and student got 80% in it. So now you go into detail based on these as well. 
     10. If the student has covered most of the tests but not attempted any full length exams, recommend attempting full length exams. 
     </PROCESS>
 
@@ -124,111 +153,248 @@ def generate_prompts(overall, math, writing, reading, context, attempt, user_id,
     </IMPORTANT RULES>
     '''
 
-    if attempt:
-        with open(f"Data/saved_progress_report/{user_id}-{class_id}/previous/MATHEMATICS.json", "r") as math_file, \
-                open(f"Data/saved_progress_report/{user_id}-{class_id}/previous/READING.json", "r") as reading_file, \
-                open(f"Data/saved_progress_report/{user_id}-{class_id}/previous/WRITING.json", "r") as writing_file, \
-                open(f"Data/saved_progress_report/{user_id}-{class_id}/previous/OVERALL_PROGRESS.json",
-                     "r") as overall_file:
-            prev_overall_data = json.load(overall_file)
-            prev_math_data = json.load(math_file)
-            prev_writing_data = json.load(writing_file)
-            prev_reading_data = json.load(reading_file)
-
-        user_prompt_subsequent_attempt = f'''
-            <INSTRUCTIONS>
-            As an expert coach, help me identify as to how I can improve my exam score with a detailed roadmap based on my current progress vs my previous progress.
-            </INSTRUCTIONS>
-
-            <DATA>
-            Here is the current progress data:
-            Overall = {overall}
-            Mathematics = {math}
-            Writing = {writing}
-            Reading = {reading}
-
-            Here is the previous progress data:
-            Previous_Overall = {prev_overall_data}
-            Previous_Mathematics = {prev_math_data}
-            Previous_Writing = {prev_writing_data}
-            Previous_Reading = {prev_reading_data}
-            <DATA>
-
-
-            <STRUCTURE>
-            The progress data is structured as follows:
-            Overall progress contains the time spent by the students, the questions attempted and overall coursework attempted
-            Then there is nested dictionaries for each subject. Each subject has nested sections, each section has nested topics/domains, each domain has details and summary. details contain the practice test name and the score achieved in the topic (if attempted, otherwise 'No attempt' is shown). Summary contains completion and score summarized by difficulty level. 
-            <STRUCTURE>
-
-            <GUIDE>
-            1. Be detailed in your internal process, but more concise and information dense in reporting the plan. 
-            2. Keep track of topics and tests in each section. Plan and reason in your thinking scratchpad to review and use.
-            3. Create plan, but do not include any timeline in your recommendation, just the sequence. For example, do not provide a "4 week" plan or a "weekly" plan.
-            4. Be clear, note that the reader is a student in high school, so explain what your mean. For example instead of "You have strong scores across all difficulties but low completion" say "You have strong scores across easy, medium and hard tests, but you did not attempt enough questions to determine whether you can consistently score high in them."
-            5. Be specific, do not give generic advice. Use the data provided to find trouble spots and reference the data for all recommendations.
-            </GUIDE>
-            '''
-        system_prompt = f'''
-            <ROLE>
-            You are an Expert Exam Prep Coach. You work for Tutoria. You have Decades of experience.
-            </ROLE>
 
-            <OBJECTIVE>
-            You have been given a clear <task> helping students troubleshoot their weaknesses and improve their exam Score by giving them a clear roadmap on what to do next. 
-            To do this, you already have <:context> about exam in form of markdown provided below, and you will receive student's extensive <:current progress> as well as <:previous progress> in the form of separate python dictionaries.
-            Analyze the <:current progress>, comparing it with <:previous progress> and use the <:process> to guide the student. 
-            </OBJECTIVE>
+def generate_section_prompt(subject, progress, overall, changes=None, trends=None):
+    # One section of the report. The system prompt is shared with the full report, so its cache is reused
+    comparison = " compared to my previous progress" if changes is not None else ""
+    previous = f"""
 
-            <CONTEXT>
-            Below are the details of the Exam in markdown format. This file contains the details of the examination sections, content domains, testing points, and question distribution.  
-            {context}
-            </CONTEXT>
+    Here is what changed since the previous progress data:
+    {changes}""" if changes is not None else ""
+    history = format_trends(trends, [subject])
+    history = f"""
 
-            <PROCESS>
-            1. Use the <:context> to indentify which exam prep you are talking about and Understand the exam context, which includes sections, content domains, testing points, and question distribution. For example, which domain has more question weightage.
-            2. Based on question weightage, higher weightage domains will be prioritized when making improvement recommendations.
-            3. When it comes to subjects, e.g. Maths, Reading, Writing, the priority is as follows, Mathematics is most important, it carries a full 800 marks. 2nd most important is Writing since it is easier to improve upon, carrying 400 marks. Then last is reading, it also carries 400 marks. Remember this order in your recommendations. For example, even though "Craft and Structure" has slightly more weightage than "Standard English Conventions", the latter is more important since it is in Writing subject.
-            4. Analyze and remember student's <:current progress> as well as <:previous progress>. This involves understanding topics they have attempted vs not attempted, as well as the scores in the topics that were attempted for each difficulty level, now as well as previously. 
-            5. Identify whether the higher priority domains have been practiced. For example, if "Algebra" is a high priority domain in maths and student has not attempted it, then prioritize completing this first as a recommendation. Do the same for all high priority domains. 
-            6. Identify higher priority domains that have not been attempted at highest difficulty level. For example, if "Craft and Structure" is a high priority domain and student has not attempted or only partially attempted "medium" and "hard" tests, then prioritize completing them in your recommendation.
-            7. Identify higher priority domains that are attempted but do not have 80% in the highest available difficulty level. For example the student has attempted "hard" difficulty level questions but has a less than 80% score in them, ask them to review the chapters related to that category in detail and give the test again. Mention the topics/chapters.
-            8. If student has made satisfactory progress in the high priority domains of the subject, then simply commend them and move on. Do not try to recommend anything there. For example, if the student has a completion above 90% and average score above 90% in all difficulty levels, then simply appreciate them and move to the next one. 
-            9. Once the higher priority domains are handled, feel free to give advice as an expert coach in the exam. You have access to each sub-domains test and its score as if its attempted by the student. For example, "Command of Evidence 1 (Quantitative) (easy) Score': '80%'" is one of the many tests and student got 80% in it. So now you go into detail based on these as well. 
-            10. If the student has covered most of the tests but not attempted any full length exams, recommend attempting full length exams. 
-            </PROCESS>
+    Here is how my progress moved over my last attempts:
+    {history}""" if history is not None else ""
 
-            <IMPORTANT RULES>
-            1. Say "I don't know" if you do not know.
-            2. Answer only if you are very confident
-            3. Do not deviate from the student's provided <:current progress> and <:previous progress>. Be sure to understand it properly.
-            4. For a given topic, the <:threshold> for each difficulty is at least 80% completion to qualify for consideration of the average attempted score in that difficulty level. For example, if the completion is less than 80% in "hard" but avg score is 100%, it will not be assumed that student is good at "hard" questions and can skip the "easy" or "medium" ones.
-            5. If a student has completed a higher difficulty level upto the <:threshold> with at least 90% average score in that difficulty, do not recommend them to complete lower difficulty levels in the same topic. 
-            6. Follow the structured output schema defined. 
-            7. Do not explicitly mention priority in heading. For example headings such as "### **Mathematics Section (Highest Priority)**" or "### **Writing Section (Second Highest Priority)**"
-            </IMPORTANT RULES>
-            '''
+    user_prompt = f'''
+    <INSTRUCTIONS>
+    As an expert coach, analyze only the {subject} section of my progress and help me identify as to how I can improve my score in it{comparison}. The other sections are analyzed separately.
+    </INSTRUCTIONS>
+
+    <DATA>
+    Here is the progress data:
+    {format_progress(overall, {subject: progress})}{previous}{history}
+    <DATA>
+
+
+    <STRUCTURE>
+    The progress data is structured as follows:
+    Overall progress contains the time spent by the students, the questions attempted and overall coursework attempted
+    Then there is a table for the {subject} section. It has domains in square brackets, and each domain has one line per topic with the columns named in the header line. For each difficulty level the line gives the average score of the attempted tests and the completion, both in percent ("-" means no attempt, "n/a" means there is no difficulty breakdown, as for full length exams). The last column lists the attempted tests with their score in percent, followed by the tests that were not attempted. 
+    The changes, if any, list only the topics whose values moved since the previous progress data, as previous->current. A previous value of 0 can also mean it was not attempted back then. Topics that are not listed are unchanged.
+    The trends, if any, give progress (average score weighted by completion, in percent) over the last attempts, oldest to latest, then the change per attempt and how many attempts in a row it went up or down.
+    <STRUCTURE>
+
+    <GUIDE>
+    1. Be detailed in your internal process, but more concise and information dense in reporting the plan. 
+    2. Keep track of topics and tests in the section. Plan and reason in your thinking scratchpad to review and use.
+    3. Do not include any timeline in your recommendation, just the sequence. For example, do not provide a "4 week" plan or a "weekly" plan.
+    4. Be clear, note that the reader is a student in high school, so explain what your mean. For example instead of "You have strong scores across all difficulties but low completion" say "You have strong scores across easy, medium and hard tests, but you did not attempt enough questions to determine whether you can consistently score high in them."
+    5. Be specific, do not give generic advice. Use the data provided to find trouble spots and reference the data for all recommendations.
+    </GUIDE>
+    '''
+
+    return user_prompt
+
+
+def generate_summary_prompt(overall, sections, changes=None, trends=None):
+    # sections: subject name -> section dictionary (as in create_section_dictionary), already analyzed
+    analysis = "\n\n".join(
+        f"## {subject}\nOverview: {section['overview']}\n"
+        + "".join(f"Domain {name}: {domain['domain_overview']}\n" for name, domain in section['subject_domains'].items())
+        + f"Recommendations: {section['section_recommendation']}"
+        for subject, section in sections.items())
+    previous = f"""
+
+    Here is what changed since the previous progress data:
+    {changes}""" if changes is not None else ""
+    history = format_trends(trends)
+    history = f"""
+
+    Here is how my progress moved over my last attempts:
+    {history}""" if history is not None else ""
+
+    user_prompt = f'''
+    <INSTRUCTIONS>
+    As an expert coach, summarize my progress and give me a prioritized roadmap and next steps, based on my overall progress and the section analyses below.
+    </INSTRUCTIONS>
+
+    <DATA>
+    Overall: {format_overall(overall)}{previous}{history}
+
+    Section analyses:
+    {analysis}
+    <DATA>
+
+    <GUIDE>
+    1. Keep the priority order of the sections and domains from the <:process> in the roadmap.
+    2. Do not repeat the section analyses, refer to them.
+    3. Do not include any timeline in your recommendation, just the sequence.
+    4. Be clear, note that the reader is a student in high school.
+    </GUIDE>
+    '''
+
+    return user_prompt
+
+
+# Explicit context caching of the system prompt, overridable through the environment
+CONTEXT_CACHE_ENABLED = os.getenv('GEMINI_CONTEXT_CACHE', '1') != '0'
+CONTEXT_CACHE_TTL = int(os.getenv('GEMINI_CONTEXT_CACHE_TTL', 3600))
+CONTEXT_CACHE_REFRESH = int(os.getenv('GEMINI_CONTEXT_CACHE_REFRESH', 300))
+CONTEXT_CACHE_RETRY = int(os.getenv('GEMINI_CONTEXT_CACHE_RETRY', 600))
+
+
+class ContextCache:
+    # The system prompt (exam context plus PROCESS/RULES) is the same for every student, so it is uploaded once
+    # as cached content and referenced by name. Handles are refreshed before they expire, and if caching is
+    # unavailable (e.g. the prompt is under the model's minimum) it is not retried for a while.
+
+    def __init__(self, ttl=CONTEXT_CACHE_TTL, refresh_margin=CONTEXT_CACHE_REFRESH, retry_after=CONTEXT_CACHE_RETRY):
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        self.handles = {}
+        self.unavailable = {}
+        self.lock = asyncio.Lock()
+        self.created = 0
+        self.refreshed = 0
+        self.fallbacks = 0
+        self.cached_tokens = 0
+
+
+    def key(self, model, system_prompt):
+        return model, hashlib.sha256(system_prompt.encode()).hexdigest()
+
+
+    def fresh(self, key):
+        handle = self.handles.get(key)
+        if handle is not None and handle[1] - time.monotonic() > self.refresh_margin:
+            return handle[0]
+        return None
+
+
+    async def handle(self, client, model, system_prompt):
+        key = self.key(model, system_prompt)
+
+        if self.unavailable.get(key, 0) > time.monotonic():
+            return None
+
+        name = self.fresh(key)
+        if name is not None:
+            return name
+
+        async with self.lock:
+            name = self.fresh(key)
+            if name is not None:
+                return name
+
+            from google.genai import errors, types
 
-        return user_prompt_subsequent_attempt, system_prompt
+            handle = self.handles.get(key)
+            ttl = f"{self.ttl}s"
 
-    else:
-        return user_prompt_first_attempt, system_prompt
+            try:
+                if handle is not None and handle[1] > time.monotonic():
+                    try:
+                        await client.aio.caches.update(name=handle[0], config=types.UpdateCachedContentConfig(ttl=ttl))
+                        name = handle[0]
+                        self.refreshed += 1
+                    except errors.APIError:
+                        name = None
 
+                if name is None:
+                    cache = await client.aio.caches.create(model=model, config=types.CreateCachedContentConfig(
+                        system_instruction=system_prompt,
+                        display_name="sat-agent-system-prompt",
+                        ttl=ttl
+                    ))
+                    name = cache.name
+                    self.created += 1
+            except Exception as e:
+                logger.warning(f"[FAIL] Create context cache for model={model}, sending the full prompt instead: {e}")
+                self.handles.pop(key, None)
+                self.unavailable[key] = time.monotonic() + self.retry_after
+                self.fallbacks += 1
+                return None
 
-def agent(user_prompt: str, system_prompt: str, model: str, api, thinking_tokens: int = 2000, temperature: float = 0.5,
-          output_tokens: int = 10000):
-    client = genai.Client(api_key=api)
+            self.handles[key] = (name, time.monotonic() + self.ttl)
+            logger.info(f"[OK] Context cache {name} ready for model={model}")
 
+            return name
+
+
+    def invalidate(self, model, system_prompt):
+        self.handles.pop(self.key(model, system_prompt), None)
+
+
+    def record_usage(self, usage_metadata):
+        if usage_metadata is not None and usage_metadata.cached_content_token_count:
+            self.cached_tokens += usage_metadata.cached_content_token_count
+
+
+    def stats(self):
+        return {
+            'handles': len(self.handles),
+            'created': self.created,
+            'refreshed': self.refreshed,
+            'fallbacks': self.fallbacks,
+            'cached_tokens': self.cached_tokens
+        }
+
+
+context_cache = ContextCache() if CONTEXT_CACHE_ENABLED else None
+
+
+def build_configuration(system_prompt: str, thinking_tokens: int, temperature: float, output_tokens: int,
+                        cached_content: str = None, response_schema=StudentProgressReport):
+    from google.genai import types
+
+    # With cached content the system prompt lives in the cache, the API rejects sending it twice
     configuration = types.GenerateContentConfig(
         temperature=temperature,
         maxOutputTokens=output_tokens,
-        systemInstruction=system_prompt,
+        systemInstruction=None if cached_content else system_prompt,
+        cachedContent=cached_content,
         thinkingConfig=types.ThinkingConfig(thinking_budget=thinking_tokens),
         response_mime_type="application/json",
-        response_schema=StudentProgressReport
+        response_schema=response_schema
     )
 
-    response = client.models.generate_content(
+    return configuration
+
+
+async def agent_async(user_prompt: str, system_prompt: str, model: str, api, thinking_tokens: int = 2000,
+                      temperature: float = 0.5, output_tokens: int = 10000, client=None, prompt_cache=context_cache,
+                      response_schema=StudentProgressReport):
+    from google import genai
+    from google.genai import errors
+
+    client = client or genai.Client(api_key=api)
+
+    cache_name = await prompt_cache.handle(client, model, system_prompt) if prompt_cache else None
+
+    if cache_name:
+        try:
+            response = await client.aio.models.generate_content(
+                model=model,
+                contents=user_prompt,
+                config=build_configuration(system_prompt, thinking_tokens, temperature, output_tokens, cache_name,
+                                           response_schema)
+            )
+            prompt_cache.record_usage(response.usage_metadata)
+            return response
+        except errors.ClientError as e:
+            # A cache that expired or was deleted server side, send the full prompt and recreate it next time
+            if e.code not in (400, 403, 404):
+                raise
+            logger.warning(f"[FAIL] Use context cache {cache_name}, retrying with the full prompt: {e}")
+            prompt_cache.invalidate(model, system_prompt)
+
+    configuration = build_configuration(system_prompt, thinking_tokens, temperature, output_tokens,
+                                        response_schema=response_schema)
+
+    response = await client.aio.models.generate_content(
         model=model,
         contents=user_prompt,
         config=configuration
@@ -237,39 +403,36 @@ def agent(user_prompt: str, system_prompt: str, model: str, api, thinking_tokens
     return response
 
 
-def create_dictionary(data):
-    report_dict = {
-        'summary_overview': data.summary_overview,
-        "sections": {},
-        "priority_roadmap": data.priority_roadmap,
-        "next_steps": data.next_steps
+def create_section_dictionary(section):
+    section_dict = {
+        "overview": section['section_overview'],
+        "section_recommendation": section['general_recommendations'],
+        'subject_domains': {}
     }
 
-    output_dict = data.model_dump()
+    for domain in section['domains']:
+        domain_name = str(domain['domain_name']).lower().replace(' ', '_')
+        section_dict['subject_domains'][domain_name] = {
+            'domain_overview': domain['domain_overview'],
+            'domain_topics': {}
+        }
 
-    for sections in output_dict['sections']:
-        section_name = str(sections['section_name']).lower().replace(" ", "_")
-        report_dict['sections'].update({
-            section_name: {
-                "overview": sections['section_overview'],
-                "section_recommendation": sections['general_recommendations'],
-                'subject_domains': {}
-            }
-        })
+        for topic in domain['topics']:
+            topic_name = str(topic['topic_name']).lower().replace(' ', '_')
 
-        for domain in sections['domains']:
-            domain_name = str(domain['domain_name']).lower().replace(' ', '_')
-            report_dict['sections'][section_name]['subject_domains'][domain_name] = {
-                'domain_overview': domain['domain_overview'],
-                'domain_topics': {}
+            section_dict['subject_domains'][domain_name]['domain_topics'][topic_name] = {
+                'topic_current_status': topic['current_status'],
+                'topic_recommendations': topic['recommendations']
             }
 
-            for topic in domain['topics']:
-                topic_name = str(topic['topic_name']).lower().replace(' ', '_')
+    return section_dict
 
-                report_dict['sections'][section_name]['subject_domains'][domain_name]['domain_topics'][topic_name] = {
-                    'topic_current_status': topic['current_status'],
-                    'topic_recommendations': topic['recommendations']
-                }
 
-    return report_dict
\ No newline at end of file
+def assemble_report(summary, sections):
+    # The report dictionary, from a ReportSummary dump and section dictionaries keyed by subject
+    return {
+        'summary_overview': summary['summary_overview'],
+        "sections": {subject.lower().replace(" ", "_"): section for subject, section in sections.items()},
+        "priority_roadmap": summary['priority_roadmap'],
+        "next_steps": summary['next_steps']
+    }
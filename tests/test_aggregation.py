@@ -0,0 +1,81 @@
+from data_processing import FetchStudentData, data_segregation
+from benchmark_fakes import synthetic_payloads
+import pytest
+import json
+import os
+
+
+# Payloads of a few synthetic students with the progress the original aggregation (master_loop and
+# clean_percentage_values, before the single pass) produced for them: as shown in prompts, and as saved
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "aggregation.json")
+
+with open(FIXTURE, "r") as fp:
+    STUDENTS = json.load(fp)
+
+
+def aggregate(payloads):
+    return data_segregation(FetchStudentData("user", "class", payloads).master_loop())
+
+
+@pytest.mark.parametrize("student", STUDENTS, ids=[student['name'] for student in STUDENTS])
+def test_display_matches_original(student):
+    display = {k: v.display() for k, v in aggregate(student['payloads']).items()}
+
+    # Key order too, prompts and reports list topics in it
+    assert json.dumps(display) == json.dumps(student['display'])
+
+
+@pytest.mark.parametrize("student", STUDENTS, ids=[student['name'] for student in STUDENTS])
+def test_stored_matches_original(student):
+    stored = {k: v.stored() for k, v in aggregate(student['payloads']).items()}
+
+    assert stored == student['stored']
+
+
+class Name(str):
+    # A topic name that counts how often it is compared, the original pass compared names for every test it looked up
+    comparisons = 0
+
+    def __eq__(self, other):
+        Name.comparisons += 1
+        return str.__eq__(self, other)
+
+    __hash__ = str.__hash__
+
+
+def counted(value):
+    if isinstance(value, dict):
+        return {k: Name(v) if k == 'name' and isinstance(v, str) else counted(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [counted(v) for v in value]
+    return value
+
+
+def comparisons_per_test(topics, tests):
+    payloads = counted(synthetic_payloads(topics, tests, quizzes=0, exams=0))
+    Name.comparisons = 0
+    FetchStudentData("user", "class", payloads).master_loop()
+    return Name.comparisons / (3 * topics * tests)
+
+
+def test_cost_per_test_stays_flat():
+    # 40 times the tests per topic. The original pass checked each test against a list of the topic's tests, about 17
+    # name comparisons per test at the small size and over 600 at the large one; a linear pass stays flat
+    small = comparisons_per_test(10, 40)
+    large = comparisons_per_test(10, 1600)
+
+    assert large <= max(small, 1)
+
+
+def test_overall_progress_compiled_once(monkeypatch):
+    calls = []
+    compile_overall_progress = FetchStudentData.compile_overall_progress
+
+    def counting(self, *args, **kwargs):
+        calls.append(1)
+        return compile_overall_progress(self, *args, **kwargs)
+
+    monkeypatch.setattr(FetchStudentData, 'compile_overall_progress', counting)
+    FetchStudentData("user", "class", synthetic_payloads(10, 400, quizzes=0, exams=0)).master_loop()
+
+    assert len(calls) == 1
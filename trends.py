@@ -0,0 +1,200 @@
+from attempt_store import attempt_store
+from progress_model import DIFFICULTIES
+from collections import OrderedDict
+import numpy as np
+import threading
+import time
+import os
+
+
+# Trend settings, overridable through the environment
+TREND_MAX_ATTEMPTS = int(os.getenv('TREND_MAX_ATTEMPTS', 20))
+TREND_CACHE_MAX_ENTRIES = int(os.getenv('TREND_CACHE_MAX_ENTRIES', 4096))
+
+SUBJECTS = ["Mathematics", "Writing", "Reading"]
+
+# (store path, attempt ID) -> parsed snapshot rows. Saved attempts never change, so entries never go stale
+_snapshot_cache = OrderedDict()
+_snapshot_lock = threading.Lock()
+
+
+def read_snapshot(progress):
+    # One saved snapshot as columns: (subject, section, topic), difficulty code, completion, score
+    topics, difficulties, completion, score = [], [], [], []
+
+    for subject in SUBJECTS:
+        for section, section_topics in progress.get(subject, {}).items():
+            for topic, values in section_topics.items():
+                # Full length exams only carry test scores, there is no difficulty breakdown to aggregate
+                if "details" not in values:
+                    continue
+
+                for difficulty, summary in values["summary"].items():
+                    topics.append((subject, section, topic))
+                    difficulties.append(DIFFICULTIES.index(difficulty))
+                    completion.append(summary["Completion"])
+                    score.append(summary["Avg Score for Attempted Tests"])
+
+    return topics, difficulties, completion, score
+
+
+def attempt_rows(store, attempt_id):
+    key = (store.path, attempt_id)
+
+    with _snapshot_lock:
+        if key in _snapshot_cache:
+            _snapshot_cache.move_to_end(key)
+            return _snapshot_cache[key]
+
+    rows = read_snapshot(store.get(attempt_id)['progress'])
+
+    with _snapshot_lock:
+        _snapshot_cache[key] = rows
+        while len(_snapshot_cache) > TREND_CACHE_MAX_ENTRIES:
+            _snapshot_cache.popitem(last=False)
+
+    return rows
+
+
+def history_arrays(snapshots):
+    # Snapshot rows -> topic keys, and completion and score arrays shaped (attempts, topics, difficulties).
+    # NaN where a topic was not part of an attempt
+    columns = {}
+    for topics, _, _, _ in snapshots:
+        for topic in topics:
+            columns.setdefault(topic, len(columns))
+
+    shape = (len(snapshots), len(columns), len(DIFFICULTIES))
+    completion, score = np.full(shape, np.nan), np.full(shape, np.nan)
+
+    for attempt, (topics, difficulties, completion_values, score_values) in enumerate(snapshots):
+        index = [columns[topic] for topic in topics]
+        completion[attempt, index, difficulties] = completion_values
+        score[attempt, index, difficulties] = score_values
+
+    return list(columns), completion, score
+
+
+def distinct_attempts(completion, score):
+    # Re-running a report without new activity saves the same snapshot again, those repeats are not attempts
+    values = np.concatenate([completion, score], axis=2)
+    same = (values[1:] == values[:-1]) | (np.isnan(values[1:]) & np.isnan(values[:-1]))
+
+    keep = np.ones(len(values), dtype=bool)
+    keep[1:] = ~same.all(axis=(1, 2))
+
+    return keep
+
+
+def slopes(progress):
+    # Least squares slope of each (topic, difficulty) series against the attempt number, skipping gaps
+    x = np.arange(len(progress), dtype=np.float64)[:, None, None]
+    valid = ~np.isnan(progress)
+    count = valid.sum(axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = (x * valid).sum(axis=0) / count
+        y_mean = np.nansum(progress, axis=0) / count
+        dx = np.where(valid, x - x_mean, 0)
+        slope = (dx * np.nan_to_num(progress - y_mean)).sum(axis=0) / (dx ** 2).sum(axis=0)
+
+    return np.where(count >= 2, slope, np.nan)
+
+
+def streaks(progress):
+    # Consecutive latest attempts moving the same way: +n improving, -n declining, 0 flat or new
+    if len(progress) < 2:
+        return np.zeros(progress.shape[1:], dtype=np.int64)
+
+    direction = np.sign(np.nan_to_num(np.diff(progress, axis=0)))
+    last = direction[-1]
+    run = np.cumprod((direction[::-1] == last) & (last != 0), axis=0).sum(axis=0)
+
+    return (last * run).astype(np.int64)
+
+
+def compute_trends(completion, score):
+    # Saved snapshots store "No Attempt" as 0, so a score only counts where something was completed.
+    # Progress is the heatmap measure, average score weighted by completion
+    score = np.where(completion > 0, score, np.nan)
+    progress = np.nan_to_num(score) * completion / 100
+
+    delta = progress[-1] - progress[-2] if len(progress) > 1 else np.full(progress.shape[1:], np.nan)
+
+    return {
+        'progress': progress,
+        'score': score,
+        'completion': completion,
+        'delta': delta,
+        'slope': slopes(progress),
+        'streak': streaks(progress)
+    }
+
+
+def rounded(value):
+    return None if np.isnan(value) else round(float(value), 1)
+
+
+def trend_records(topics, trends):
+    # Topics and difficulties seen in at least two attempts, as plain values for the response and prompts
+    records = []
+
+    for column, (subject, section, topic) in enumerate(topics):
+        for level, difficulty in enumerate(DIFFICULTIES):
+            slope = trends['slope'][column, level]
+            if np.isnan(slope):
+                continue
+            records.append({
+                'subject': subject,
+                'section': section,
+                'topic': topic,
+                'difficulty': difficulty,
+                'progress': [rounded(v) for v in trends['progress'][:, column, level]],
+                'delta': rounded(trends['delta'][column, level]),
+                'slope': rounded(slope),
+                'streak': int(trends['streak'][column, level])
+            })
+
+    return records
+
+
+def subject_series(topics, progress):
+    # Mean progress over each subject's topics and difficulties, per attempt
+    series = {}
+
+    for subject in SUBJECTS:
+        mask = np.array([topic[0] == subject for topic in topics], dtype=bool)
+        if not mask.any():
+            continue
+        values = progress[:, mask, :]
+        count = (~np.isnan(values)).sum(axis=(1, 2))
+        means = np.nansum(values, axis=(1, 2)) / np.maximum(count, 1)
+        series[subject] = [rounded(v) if n else None for v, n in zip(means, count)]
+
+    return series
+
+
+def student_trends(user_id, class_id, performance_data, store=attempt_store, limit=TREND_MAX_ATTEMPTS):
+    # Trends over the saved attempts plus the current progress, None until there are two distinct attempts
+    attempts = store.attempt_ids(user_id, class_id, limit - 1)
+    if not attempts:
+        return None
+
+    snapshots = [attempt_rows(store, attempt_id) for attempt_id, _ in attempts]
+    snapshots.append(read_snapshot({k: v.stored() for k, v in performance_data.items()}))
+    created = np.array([created for _, created in attempts] + [time.time()])
+
+    topics, completion, score = history_arrays(snapshots)
+    keep = distinct_attempts(completion, score)
+    if keep.sum() < 2:
+        return None
+
+    completion, score, created = completion[keep], score[keep], created[keep]
+    trends = compute_trends(completion, score)
+
+    return {
+        'attempts': int(keep.sum()),
+        'since': float(created[0]),
+        'subjects': subject_series(topics, trends['progress']),
+        'topics': trend_records(topics, trends)
+    }
@@ -0,0 +1,183 @@
+from concurrent.futures import ThreadPoolExecutor
+from report_cache import cache_key
+from collections import OrderedDict
+from dataclasses import dataclass
+import http_client
+import threading
+import logging
+import json
+import time
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# Upstream cache settings, overridable through the environment. By default every use revalidates the payload with a
+# conditional GET, so a report never misses a test the student just finished and a 304 still saves the transfer.
+# Opt-in: a payload younger than UPSTREAM_CACHE_FRESH seconds is used as is, and for UPSTREAM_CACHE_STALE seconds
+# after that it is still used while a conditional GET refreshes it in the background. 0 entries disables the cache
+UPSTREAM_CACHE_FRESH = float(os.getenv('UPSTREAM_CACHE_FRESH', 0))
+UPSTREAM_CACHE_STALE = float(os.getenv('UPSTREAM_CACHE_STALE', 0))
+UPSTREAM_CACHE_MAX_ENTRIES = int(os.getenv('UPSTREAM_CACHE_MAX_ENTRIES', 3000))
+UPSTREAM_CACHE_MAX_BYTES = int(os.getenv('UPSTREAM_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+UPSTREAM_REFRESH_WORKERS = int(os.getenv('UPSTREAM_REFRESH_WORKERS', 4))
+
+
+@dataclass(slots=True)
+class CachedPayload:
+    body: bytes
+    etag: str = None
+    last_modified: str = None
+    # time.monotonic() of the last 200 or 304 for it
+    checked: float = 0.0
+
+
+class UpstreamCache:
+    # The raw student API responses with their validators, in memory and bounded by entries and bytes (LRU).
+    # Payloads are parsed on every use, so a caller can never change a cached one
+
+    def __init__(self, fresh=UPSTREAM_CACHE_FRESH, stale=UPSTREAM_CACHE_STALE, max_entries=UPSTREAM_CACHE_MAX_ENTRIES,
+                 max_bytes=UPSTREAM_CACHE_MAX_BYTES, refresh_workers=UPSTREAM_REFRESH_WORKERS):
+        self.fresh = fresh
+        self.stale = stale
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.refresh_workers = refresh_workers
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.refreshing = set()
+        self.executor = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.updated = 0
+        self.evictions = 0
+        self.refresh_errors = 0
+
+
+    def enabled(self):
+        return self.max_entries > 0 and self.max_bytes > 0
+
+
+    def get_json(self, url, headers, timeout=None):
+        if not self.enabled():
+            return http_client.get(url, headers, timeout).json()
+
+        # The token is part of the key, a payload is only served to the credentials it was fetched with
+        key = cache_key(url, headers.get('Authorization'))
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                age = time.monotonic() - entry.checked
+                if age <= self.fresh:
+                    self.hits += 1
+                    return json.loads(entry.body)
+                if age <= self.fresh + self.stale:
+                    self.stale_hits += 1
+                    self.refresh_later(key, url, headers, timeout)
+                    return json.loads(entry.body)
+            else:
+                self.misses += 1
+
+        return json.loads(self.fetch(key, url, headers, timeout, entry).body)
+
+
+    def fetch(self, key, url, headers, timeout, entry=None):
+        # A conditional GET when there is a cached payload, a 304 keeps it and resets its age
+        if entry is not None:
+            headers = dict(headers)
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+
+        response = http_client.get(url, headers, timeout)
+
+        if response.status_code == 304 and entry is not None:
+            with self.lock:
+                entry.checked = time.monotonic()
+                self.revalidated += 1
+                self.store(key, entry)
+            return entry
+
+        fetched = CachedPayload(response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                                time.monotonic())
+
+        with self.lock:
+            if entry is not None:
+                self.updated += 1
+            if 'no-store' not in response.headers.get('Cache-Control', ''):
+                self.store(key, fetched)
+
+        return fetched
+
+
+    def store(self, key, entry):
+        # Called with the lock held. A payload larger than the whole budget is not kept
+        if key in self.entries:
+            self.bytes -= len(self.entries.pop(key).body)
+
+        if len(entry.body) > self.max_bytes:
+            return
+
+        self.entries[key] = entry
+        self.bytes += len(entry.body)
+
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= len(evicted.body)
+            self.evictions += 1
+
+
+    def refresh_later(self, key, url, headers, timeout):
+        # Called with the lock held. One background refresh per payload at a time
+        if key in self.refreshing:
+            return
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.refresh_workers, thread_name_prefix='upstream-refresh')
+
+        self.refreshing.add(key)
+        self.executor.submit(self.refresh, key, url, headers, timeout)
+
+
+    def refresh(self, key, url, headers, timeout):
+        try:
+            with self.lock:
+                entry = self.entries.get(key)
+            self.fetch(key, url, headers, timeout, entry)
+        except Exception as e:
+            # The stale payload stays, the next request past the stale window revalidates it in line
+            with self.lock:
+                self.refresh_errors += 1
+            logger.warning(f"[FAIL] Refresh upstream payload {url}: {e}")
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'stale': self.stale_hits,
+            'misses': self.misses,
+            'revalidated': self.revalidated,
+            'updated': self.updated,
+            'evictions': self.evictions,
+            'refresh_errors': self.refresh_errors,
+            'entries': len(self.entries),
+            'bytes': self.bytes
+        }
+
+
+upstream_cache = UpstreamCache()
@@ -0,0 +1,38 @@
+from heatmaps import HEATMAP_FORMAT
+import importlib
+import logging
+import time
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# WARMUP=0 leaves every heavy import to the first request that needs it
+WARMUP_ENABLED = os.getenv('WARMUP', '1') != '0'
+
+
+def heavy_modules():
+    # google-genai for every report, numpy for trends, pandas for cohort analytics, matplotlib/seaborn for PNG heatmaps
+    modules = ['google.genai', 'trends', 'cohort_analytics']
+
+    if HEATMAP_FORMAT != 'svg':
+        modules.append('generate_heatmaps')
+
+    return modules
+
+
+def warm_up(modules=None):
+    timings = {}
+
+    for name in modules or heavy_modules():
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except Exception:
+            logger.exception(f"[FAIL] Warm up {name}")
+            continue
+        timings[name] = round(time.perf_counter() - start, 3)
+
+    logger.info(f"[OK] Warm up finished {timings}")
+
+    return timings